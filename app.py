@@ -8,9 +8,19 @@ import traceback
 import time
 import requests
 import csv
-from PIL import Image
+import threading
+import hashlib
+import hmac
+import secrets
+import struct
+import concurrent.futures
+import queue
+import collections
+import sqlite3
+import math
+from PIL import Image, ImageFilter
 import io
-from flask_socketio import SocketIO, emit
+from flask_socketio import SocketIO, emit, join_room, leave_room
 from pyngrok import ngrok
 import random
 from dotenv import load_dotenv
@@ -36,6 +46,28 @@ except ImportError as e:
     logging.error("Please run: pip install openai")
     sys.exit(1)
 
+# websocket-client is optional; without it ComfyUI progress falls back to HTTP polling
+try:
+    import websocket
+except ImportError:
+    websocket = None
+    logging.warning("websocket-client not installed, ComfyUI progress will use HTTP polling")
+    logging.warning("For live progress run: pip install websocket-client")
+
+# redis is optional; it is only needed to share presence between several server processes
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# numpy is optional; without it the server keeps no shared copy of the mask
+try:
+    import numpy as np
+except ImportError:
+    np = None
+    logging.warning("numpy not installed, late joiners will not receive the shared mask")
+    logging.warning("To enable the shared mask run: pip install numpy")
+
 from config import config
 
 # Set up logging
@@ -64,28 +96,482 @@ app = Flask(__name__,
            template_folder='.'
 )
 
+# Scale-out settings: with a message queue (e.g. redis://localhost:6379/0) several server
+# processes share Socket.IO rooms; presence then has to live in Redis too
+SOCKETIO_MESSAGE_QUEUE = os.getenv('SOCKETIO_MESSAGE_QUEUE')
+PRESENCE_STORE = os.getenv('PRESENCE_STORE', 'redis' if SOCKETIO_MESSAGE_QUEUE else 'memory')  # 'memory' or 'redis'
+PRESENCE_REDIS_URL = os.getenv('PRESENCE_REDIS_URL', SOCKETIO_MESSAGE_QUEUE or 'redis://localhost:6379/0')
+# Seconds a process's Redis heartbeat lives; users of a process that misses it are removed by the others
+PRESENCE_HEARTBEAT_TTL = int(os.getenv('PRESENCE_HEARTBEAT_TTL', '30'))
+
+# 'threading' for local development; serve.py switches to 'eventlet' (or 'gevent') for production
+SOCKETIO_ASYNC_MODE = os.getenv('SOCKETIO_ASYNC_MODE', 'threading')
+
 # Initialize SocketIO with proper configuration
 socketio = SocketIO(app, 
                    cors_allowed_origins="*",
-                   async_mode='threading',
+                   async_mode=SOCKETIO_ASYNC_MODE,
                    logger=True,
                    engineio_logger=True,
                    ping_timeout=60,
-                   ping_interval=25)
+                   ping_interval=25,
+                   message_queue=SOCKETIO_MESSAGE_QUEUE)
+
+def run_blocking(func, *args, **kwargs):
+    """Call func in a real OS thread when running on an event loop, so CPU-bound work
+    (Pillow, numpy) and clients that aren't monkey-patchable don't stall every socket"""
+    if SOCKETIO_ASYNC_MODE == 'eventlet':
+        from eventlet import tpool
+        return tpool.execute(func, *args, **kwargs)
+    if SOCKETIO_ASYNC_MODE == 'gevent':
+        import gevent
+        return gevent.get_hub().threadpool.apply(func, args, kwargs)
+    return func(*args, **kwargs)
+
+MAX_USER_INDEX = 255  # User indexes are one byte in binary drawing events
+
+class MemoryPresenceStore:
+    """Connected users, session rooms and per-room user indexes for a single server process
+
+    Reads look like a dict of sid -> user data. Writes go through
+    update_user/join/leave so that RedisPresenceStore can offer the same
+    interface across processes.
+    """
+
+    def __init__(self):
+        self.users = {}
+        # Session code -> sids in that session's room; drawing and presence events stay inside a room
+        self.rooms = collections.defaultdict(set)
+        self.indexes = collections.defaultdict(dict)
+        self.versions = collections.defaultdict(int)
+        self.listeners = collections.defaultdict(list)
+        self.lock = threading.Lock()
+
+    def __contains__(self, sid):
+        return sid in self.users
+
+    def __getitem__(self, sid):
+        return self.users[sid]
+
+    def __setitem__(self, sid, data):
+        self.users[sid] = dict(data)
+
+    def __delitem__(self, sid):
+        del self.users[sid]
+
+    def __len__(self):
+        return len(self.users)
+
+    def get(self, sid, default=None):
+        return self.users.get(sid, default)
+
+    def items(self):
+        return list(self.users.items())
+
+    def update_user(self, sid, **fields):
+        if sid in self.users:
+            self.users[sid].update(fields)
+
+    def join(self, room, sid):
+        with self.lock:
+            self.rooms[room].add(sid)
+
+    def leave(self, room, sid):
+        with self.lock:
+            members = self.rooms.get(room)
+            if members is not None:
+                members.discard(sid)
+                if not members:
+                    del self.rooms[room]
+
+    def members(self, room):
+        with self.lock:
+            return set(self.rooms.get(room, ()))
+
+    def room_size(self, room):
+        with self.lock:
+            return len(self.rooms.get(room, ()))
+
+    def room_users(self, room):
+        return {sid: self.users[sid] for sid in self.members(room) if sid in self.users}
+
+    def sessions(self):
+        with self.lock:
+            return {room: len(members) for room, members in self.rooms.items()}
+
+    def version(self, room):
+        with self.lock:
+            return self.versions.get(room, 0)
+
+    def bump_version(self, room):
+        """Next presence version for the room; every join, leave and user update gets one"""
+        with self.lock:
+            self.versions[room] += 1
+            return self.versions[room]
+
+    def claim_index(self, room, sid):
+        """Lowest free user index in the room, or None once all MAX_USER_INDEX + 1 are taken"""
+        with self.lock:
+            taken = self.indexes[room]
+            for index in range(MAX_USER_INDEX + 1):
+                if index not in taken:
+                    taken[index] = sid
+                    return index
+        return None
+
+    def release_index(self, room, index, sid):
+        with self.lock:
+            taken = self.indexes.get(room, {})
+            if taken.get(index) == sid:
+                del taken[index]
+            if not taken:
+                self.indexes.pop(room, None)
+
+    def heartbeat(self):
+        pass
+
+    def reap(self):
+        """Users left behind by dead processes; a single process never has any"""
+        return []
+
+    def publish(self, channel, message):
+        for callback in self.listeners[channel]:
+            callback(message)
+
+    def publish_logged(self, channel, log, message, reset=False):
+        """publish(); a single process never needs the log, so it isn't kept"""
+        self.publish(channel, message)
+        return 0
+
+    def read_log(self, log):
+        return None, []
+
+    def compact_log(self, log, last_id, snapshot):
+        return False
+
+    def subscribe(self, channel, callback):
+        self.listeners[channel].append(callback)
+
+class RedisPresenceStore:
+    """MemoryPresenceStore's interface on top of Redis, shared by every server process
+
+    Each user is a hash of JSON-encoded fields so updates are single HSETs.
+    Users connected to this process are also cached locally; only the owning
+    process ever changes a user, so the cache cannot go stale. Every process
+    keeps a heartbeat key alive; reap() removes the users of processes whose
+    heartbeat has expired, so a crashed worker leaves no ghosts behind.
+    """
+
+    def __init__(self, url, prefix='codesign', client=None):
+        self.client = client or redis.Redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+        self.process_id = uuid.uuid4().hex
+        self.local = {}
+        self.listeners = collections.defaultdict(list)
+        self.pubsub = None
+        self.lock = threading.Lock()
+        self.heartbeat()
+
+    def _key(self, *parts):
+        return ':'.join((self.prefix,) + parts)
+
+    def __contains__(self, sid):
+        return sid in self.local or bool(self.client.sismember(self._key('users'), sid))
+
+    def __getitem__(self, sid):
+        user = self.get(sid)
+        if user is None:
+            raise KeyError(sid)
+        return user
+
+    def __setitem__(self, sid, data):
+        self.local[sid] = dict(data)
+        pipe = self.client.pipeline()
+        pipe.sadd(self._key('users'), sid)
+        pipe.hset(self._key('owners'), sid, self.process_id)
+        pipe.hset(self._key('user', sid), mapping={field: json.dumps(value) for field, value in data.items()})
+        pipe.execute()
+
+    def __delitem__(self, sid):
+        self.local.pop(sid, None)
+        pipe = self.client.pipeline()
+        pipe.srem(self._key('users'), sid)
+        pipe.hdel(self._key('owners'), sid)
+        pipe.delete(self._key('user', sid))
+        pipe.execute()
+
+    def __len__(self):
+        return self.client.scard(self._key('users'))
+
+    def get(self, sid, default=None):
+        if sid in self.local:
+            return self.local[sid]
+        fields = self.client.hgetall(self._key('user', sid))
+        return {field: json.loads(value) for field, value in fields.items()} if fields else default
+
+    def items(self):
+        return list(self._load(self.client.smembers(self._key('users'))).items())
+
+    def update_user(self, sid, **fields):
+        if sid in self.local:
+            self.local[sid].update(fields)
+        self.client.hset(self._key('user', sid), mapping={field: json.dumps(value) for field, value in fields.items()})
+
+    def join(self, room, sid):
+        pipe = self.client.pipeline()
+        pipe.sadd(self._key('room', room), sid)
+        pipe.sadd(self._key('rooms'), room)
+        pipe.execute()
+
+    def leave(self, room, sid):
+        self.client.srem(self._key('room', room), sid)
+        if not self.client.scard(self._key('room', room)):
+            self.client.srem(self._key('rooms'), room)
 
-# Store connected users and their colors
-connected_users = {}
+    def members(self, room):
+        return set(self.client.smembers(self._key('room', room)))
+
+    def room_size(self, room):
+        return self.client.scard(self._key('room', room))
+
+    def room_users(self, room):
+        return self._load(self.members(room))
+
+    def sessions(self):
+        rooms = list(self.client.smembers(self._key('rooms')))
+        pipe = self.client.pipeline()
+        for room in rooms:
+            pipe.scard(self._key('room', room))
+        return dict(zip(rooms, pipe.execute()))
+
+    def version(self, room):
+        return int(self.client.get(self._key('version', room)) or 0)
+
+    def bump_version(self, room):
+        return self.client.incr(self._key('version', room))
+
+    def claim_index(self, room, sid):
+        # HSETNX makes each claim atomic across processes
+        for index in range(MAX_USER_INDEX + 1):
+            if self.client.hsetnx(self._key('indexes', room), index, sid):
+                return index
+        return None
+
+    def release_index(self, room, index, sid):
+        if self.client.hget(self._key('indexes', room), index) == sid:
+            self.client.hdel(self._key('indexes', room), index)
+
+    def heartbeat(self):
+        self.client.set(self._key('process', self.process_id), int(time.time()), ex=PRESENCE_HEARTBEAT_TTL)
+
+    def reap(self):
+        """Remove users whose process stopped heartbeating; returns their (sid, room, index)"""
+        owners = self.client.hgetall(self._key('owners'))
+        processes = list(set(owners.values()) - {self.process_id})
+        if not processes:
+            return []
+        pipe = self.client.pipeline()
+        for process_id in processes:
+            pipe.exists(self._key('process', process_id))
+        dead = {process_id for process_id, alive in zip(processes, pipe.execute()) if not alive}
+        reaped = []
+        for sid, process_id in owners.items():
+            # HDEL succeeds for one process only, so each ghost is removed and announced once
+            if process_id not in dead or not self.client.hdel(self._key('owners'), sid):
+                continue
+            user = self.get(sid) or {}
+            room, index = user.get('room'), user.get('index')
+            if room is not None:
+                self.leave(room, sid)
+                if index is not None:
+                    self.release_index(room, index, sid)
+            pipe = self.client.pipeline()
+            pipe.srem(self._key('users'), sid)
+            pipe.delete(self._key('user', sid))
+            pipe.execute()
+            reaped.append((sid, room, index))
+        if reaped:
+            logging.warning(f"Removed {len(reaped)} users left behind by {len(dead)} stopped server processes")
+        return reaped
+
+    def publish(self, channel, message):
+        self.client.publish(self._key('events', channel), json.dumps(message))
+
+    def publish_logged(self, channel, log, message, reset=False):
+        """Publish message and append it to a shared log in one transaction; returns the log's length
+
+        The log therefore holds exactly the messages published so far, in
+        delivery order, for processes that start later. reset empties the log
+        and its snapshot first.
+        """
+        payload = json.dumps(message)
+        pipe = self.client.pipeline()
+        if reset:
+            pipe.delete(self._key('log', log), self._key('log', log, 'snapshot'))
+            pipe.incr(self._key('log', log, 'epoch'))
+        pipe.rpush(self._key('log', log), payload)
+        pipe.publish(self._key('events', channel), payload)
+        return pipe.execute()[-2]
+
+    def read_log(self, log):
+        """(snapshot or None, messages logged after it)"""
+        pipe = self.client.pipeline()
+        pipe.get(self._key('log', log, 'snapshot'))
+        pipe.lrange(self._key('log', log), 0, -1)
+        snapshot, messages = pipe.execute()
+        return json.loads(snapshot) if snapshot else None, [json.loads(message) for message in messages]
+
+    def compact_log(self, log, last_id, snapshot):
+        """Replace the log up to the message with id last_id by snapshot; False if another process got there first"""
+        key = self._key('log', log)
+        with self.client.pipeline() as pipe:
+            try:
+                # A reset or another compaction bumps the epoch; appends only add to the tail, which LTRIM keeps
+                pipe.watch(self._key('log', log, 'epoch'))
+                ids = [json.loads(message).get('id') for message in pipe.lrange(key, 0, -1)]
+                if last_id not in ids:
+                    pipe.unwatch()
+                    return False
+                pipe.multi()
+                pipe.set(self._key('log', log, 'snapshot'), json.dumps(snapshot))
+                pipe.ltrim(key, ids.index(last_id) + 1, -1)
+                pipe.incr(self._key('log', log, 'epoch'))
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                return False
+
+    def subscribe(self, channel, callback):
+        """Call callback(message) for every message published on the channel by any process"""
+        with self.lock:
+            if self.pubsub is None:
+                self.pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            self.listeners[channel].append(callback)
+            self.pubsub.subscribe(**{self._key('events', channel): self._dispatch})
+            if not getattr(self.pubsub, 'thread', None):
+                self.pubsub.thread = self.pubsub.run_in_thread(sleep_time=0.01, daemon=True)
+
+    def _dispatch(self, message):
+        channel = message['channel'][len(self._key('events')) + 1:]
+        payload = json.loads(message['data'])
+        for callback in self.listeners[channel]:
+            try:
+                callback(payload)
+            except Exception as e:
+                logging.error(f"Error handling {channel} presence event: {str(e)}")
+
+    def _load(self, sids):
+        sids = list(sids)
+        remote = [sid for sid in sids if sid not in self.local]
+        pipe = self.client.pipeline()
+        for sid in remote:
+            pipe.hgetall(self._key('user', sid))
+        users = {sid: self.local[sid] for sid in sids if sid in self.local}
+        for sid, fields in zip(remote, pipe.execute() if remote else []):
+            if fields:
+                users[sid] = {field: json.loads(value) for field, value in fields.items()}
+        return users
+
+def create_presence_store():
+    if PRESENCE_STORE == 'redis':
+        if redis is None:
+            logging.error("PRESENCE_STORE=redis needs the redis package: pip install redis")
+            sys.exit(1)
+        logging.info(f"Using Redis presence store at {PRESENCE_REDIS_URL}")
+        return RedisPresenceStore(PRESENCE_REDIS_URL)
+    if SOCKETIO_MESSAGE_QUEUE:
+        logging.warning("SOCKETIO_MESSAGE_QUEUE is set but presence is in memory; users on other processes won't be listed")
+    return MemoryPresenceStore()
+
+# Store connected users and their colors (and their session room and user index)
+connected_users = create_presence_store()
+DEFAULT_SESSION = os.getenv('DEFAULT_SESSION', 'main')  # Room for clients that don't give a session code
 
 # Add a counter for total users
 total_users = 0
 
+# Milliseconds of brush segments batched into one broadcast frame; 0 relays every segment as it arrives
+STROKE_FRAME_INTERVAL_MS = int(os.getenv('STROKE_FRAME_INTERVAL_MS', '25'))
+STROKE_STATS_WINDOW = 10  # Seconds of traffic averaged by /api/stroke-stats
+# Send brush frames, user_drawing and mask_cleared as compact binary attachments instead of JSON
+BINARY_DRAWING_EVENTS = os.getenv('BINARY_DRAWING_EVENTS', '1') == '1'
+# Shared mask raster: longest side in pixels, and log segments kept before the snapshot is re-encoded
+MASK_RASTER_MAX_SIZE = int(os.getenv('MASK_RASTER_MAX_SIZE', '1024'))
+MASK_SNAPSHOT_EVERY = int(os.getenv('MASK_SNAPSHOT_EVERY', '500'))
+MASK_LOG_MAX = int(os.getenv('MASK_LOG_MAX', '2000'))  # Mask events kept in the shared log before it is folded into a snapshot
+# submissions.csv stays the append-only record; SQLite (WAL) keeps an indexed copy for paginated reads
+SUBMISSIONS_CSV_PATH = os.path.join(os.path.dirname(__file__), 'submissions.csv')
+SUBMISSIONS_DB_PATH = os.getenv('SUBMISSIONS_DB', os.path.join(os.path.dirname(__file__), 'submissions.db'))
+SUBMISSIONS_PAGE_MAX = int(os.getenv('SUBMISSIONS_PAGE_MAX', '500'))  # Largest page /api/submissions returns
+SUBMISSIONS_DB_CONNECTIONS = int(os.getenv('SUBMISSIONS_DB_CONNECTIONS', '4'))  # SQLite connections shared by all requests
+SUBMISSION_WRITE_BATCH = int(os.getenv('SUBMISSION_WRITE_BATCH', '256'))  # Most rows appended per fsync
+# Map clusters: grid cell size in screen pixels, and the deepest zoom kept precomputed (deeper ones are built per request)
+CLUSTER_CELL_PX = int(os.getenv('CLUSTER_CELL_PX', '64'))
+CLUSTER_MAX_ZOOM = int(os.getenv('CLUSTER_MAX_ZOOM', '16'))
+# Per-connection token buckets for high-frequency events, as event=rate/burst with rate in events per second
+SOCKET_EVENT_LIMITS = {
+    name.strip(): tuple(float(value) for value in limit.split('/'))
+    for name, limit in (item.split('=') for item in os.getenv(
+        'SOCKET_EVENT_LIMITS',
+        'brush_stroke=240/480,update_brush_size=10/20,location_updated=4/8,debug_ping=2/5').split(',') if item.strip())
+}
+# Brush frames a client may leave unacknowledged before it stops getting them until it catches up
+SLOW_CONSUMER_BACKLOG = int(os.getenv('SLOW_CONSUMER_BACKLOG', '256'))
+FRAME_ACK_EVERY = int(os.getenv('FRAME_ACK_EVERY', '32'))  # Brush frames sent to a client between acknowledgement probes
+MAX_BRUSH_SIZE = int(os.getenv('MAX_BRUSH_SIZE', '200'))  # Largest size update_brush_size accepts
+
 # ComfyUI settings
 COMFYUI_API_URL = "http://127.0.0.1:8188"  # Base URL
+# Comma-separated ComfyUI instances to spread generation across; the first is the primary
+COMFYUI_API_URLS = [url.strip().rstrip('/') for url in os.getenv('COMFYUI_API_URLS', COMFYUI_API_URL).split(',') if url.strip()]
 COMFYUI_MODELS_PATH = r"C:\Users\fauxi\OneDrive\Documents\ComfyUI\ComfyUI_windows_portable\ComfyUI\models"
 COMFYUI_OUTPUT_PATH = r"C:\Users\fauxi\OneDrive\Documents\ComfyUI\ComfyUI_windows_portable\ComfyUI\output"
 
+COMFYUI_JOB_TIMEOUT = int(os.getenv('COMFYUI_JOB_TIMEOUT', '60'))  # Seconds to wait for a prompt to finish
+# Seconds between /history checks while waiting on a prompt with the event stream up, in case an event was missed
+COMFYUI_HISTORY_RECONCILE_INTERVAL = float(os.getenv('COMFYUI_HISTORY_RECONCILE_INTERVAL', '5'))
+COMFYUI_OBJECT_INFO_TTL = int(os.getenv('COMFYUI_OBJECT_INFO_TTL', '300'))  # Seconds before /object_info is refetched
+COMFYUI_HEALTH_INTERVAL = int(os.getenv('COMFYUI_HEALTH_INTERVAL', '5'))  # Seconds between /queue probes of each backend
+COMFYUI_EJECT_FAILURES = int(os.getenv('COMFYUI_EJECT_FAILURES', '3'))  # Consecutive failures before a backend is ejected
+COMFYUI_READMIT_SUCCESSES = int(os.getenv('COMFYUI_READMIT_SUCCESSES', '2'))  # Consecutive good probes before it is re-admitted
+COMFYUI_AFFINITY_SLACK = int(os.getenv('COMFYUI_AFFINITY_SLACK', '2'))  # Extra queued prompts tolerated to keep a checkpoint warm
+
+# Default inpainting model and KSampler settings
+DEFAULT_CHECKPOINT = "juggernautXL_juggXIByRundiffusion.safetensors"
+DEFAULT_SAMPLER_SETTINGS = {
+    "sampler_name": "dpmpp_2m",  # Changed from euler to dpmpp_2m for better quality
+    "scheduler": "karras",  # Changed from normal to karras for better quality
+    "steps": 30,  # Increased from 20 to 30 for better detail
+    "cfg": 8.5,  # Increased from 7 to 8.5 for better prompt adherence
+    "denoise": 0.85  # Reduced from 1 to 0.85 for better preservation of original image context
+}
+
+# Encoding used for preprocessed images sent to ComfyUI: 'png' (fast zlib level) or 'webp' (lossless)
+PREPROCESS_FORMAT = os.getenv('PREPROCESS_FORMAT', 'png')
+
+# Crop-and-stitch settings: pixels of context around the mask, smallest crop side, seam feather radius
+MASK_CROP_PADDING = int(os.getenv('MASK_CROP_PADDING', '64'))
+MASK_CROP_MIN_SIZE = int(os.getenv('MASK_CROP_MIN_SIZE', '512'))
+MASK_CROP_FEATHER = int(os.getenv('MASK_CROP_FEATHER', '4'))
+MASK_CROP_MAX_AREA = float(os.getenv('MASK_CROP_MAX_AREA', '0.5'))  # Fraction of the frame above which cropping is skipped
+
+# Result cache settings for deterministic (fixed seed) generation
+DETERMINISTIC_SEED = int(os.getenv('DETERMINISTIC_SEED', '123456789'))
+RESULT_CACHE_DIR = os.getenv('RESULT_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'result_cache'))
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv('RESULT_CACHE_MAX_ENTRIES', '200'))
+
+# Generation job queue settings
+GENERATION_WORKERS = int(os.getenv('GENERATION_WORKERS', str(2 * len(COMFYUI_API_URLS))))  # Jobs run against ComfyUI at once
+GENERATION_QUEUE_MAX = int(os.getenv('GENERATION_QUEUE_MAX', '32'))  # Pending jobs before /api/process returns 503
+GENERATION_JOB_RETENTION = int(os.getenv('GENERATION_JOB_RETENTION', '600'))  # Seconds a finished job stays queryable
+MAX_VARIANTS = int(os.getenv('MAX_VARIANTS', '4'))  # Upper bound on variants per /api/process request
+GENERATION_MAX_IN_FLIGHT_PER_USER = int(os.getenv('GENERATION_MAX_IN_FLIGHT_PER_USER', '1'))  # Running jobs per session
+GENERATION_CANCEL_SUPERSEDED = os.getenv('GENERATION_CANCEL_SUPERSEDED', '1') == '1'  # A new request cancels the user's queued ones
+GENERATION_LANES = ('facilitator', 'participant')  # Scheduling lanes, highest priority first
+FACILITATOR_KEY = os.getenv('FACILITATOR_KEY')  # Shared secret that moves a session into the facilitator lane
+
 # Add debug logging for ComfyUI paths
-logging.info(f"ComfyUI API URL: {COMFYUI_API_URL}")
+logging.info(f"ComfyUI API URLs: {COMFYUI_API_URLS}")
 logging.info(f"ComfyUI Models Path: {COMFYUI_MODELS_PATH}")
 logging.info(f"ComfyUI Output Path: {COMFYUI_OUTPUT_PATH}")
 logging.info(f"Models directory exists: {os.path.exists(COMFYUI_MODELS_PATH)}")
@@ -133,11 +619,94 @@ except Exception as e:
 # Add debug logging
 logging.info("Firebase initialization completed")
 
+def session_code(value):
+    """Normalize a client-supplied session code; anything empty means the default session"""
+    code = ''.join(ch for ch in str(value or '').strip().lower() if ch.isalnum() or ch in '-_')[:32]
+    return code or DEFAULT_SESSION
+
+def session_users(room):
+    """connected_users restricted to one session's room"""
+    return connected_users.room_users(room)
+
+def presence_entry(user_id, data):
+    return {
+        'id': user_id,
+        'color': data['color'],
+        'brush_size': data['brush_size'],
+        'connected_at': data['connected_at'],
+        'index': data['index']
+    }
+
+def users_list_payload(room):
+    """Presence snapshot; user_joined/user_left/user_updated deltas continue from its version"""
+    # Read the version first: a snapshot may then be newer than its version, never older,
+    # and replaying a delta the snapshot already contains is harmless
+    version = connected_users.version(room)
+    users = session_users(room)
+    return {
+        'session': room,
+        'version': version,
+        'users': [presence_entry(uid, data) for uid, data in users.items()],
+        'total_users': len(users)
+    }
+
+def emit_presence_delta(event, room, payload, skip_sid=None):
+    """Broadcast one presence change to the room under the room's next version"""
+    payload.update(version=connected_users.bump_version(room), total_users=connected_users.room_size(room))
+    socketio.emit(event, payload, to=room, skip_sid=skip_sid)
+
+def enter_session(user_id, room):
+    """Put a connected user in a session's room and announce them to it"""
+    join_room(room)
+    connected_users.join(room, user_id)
+    # Small integer that stands in for the sid in binary drawing events
+    connected_users.update_user(user_id, room=room, index=connected_users.claim_index(room, user_id))
+    user = connected_users[user_id]
+    
+    # First tell the rest of the room about the new user
+    emit_presence_delta('user_joined', room, {'user': presence_entry(user_id, user)}, skip_sid=user_id)
+    
+    # Then send the current state to the newly connected user
+    emit('users_list', users_list_payload(room))
+    
+    # Bring the late joiner's mask up to date with what has already been drawn
+    emit_mask_state(room)
+
+def exit_session(user_id):
+    """Take a user out of their session's room and tell the remaining members"""
+    user = connected_users[user_id]
+    room = user.get('room')
+    if room is None:
+        return
+    index = user.get('index')
+    leave_room(room)
+    connected_users.leave(room, user_id)
+    if index is not None:
+        connected_users.release_index(room, index, user_id)
+    connected_users.update_user(user_id, room=None, index=None)
+    emit_presence_delta('user_left', room, {'user_id': user_id, 'index': index})
+
+def presence_heartbeat():
+    """Keep this process's presence alive and announce users of stopped processes as having left"""
+    while True:
+        try:
+            connected_users.heartbeat()
+            for user_id, room, index in connected_users.reap():
+                if room is not None:
+                    emit_presence_delta('user_left', room, {'user_id': user_id, 'index': index})
+        except Exception as e:
+            logger.error(f"Error in presence heartbeat: {str(e)}")
+        socketio.sleep(PRESENCE_HEARTBEAT_TTL / 3)
+
+if isinstance(connected_users, RedisPresenceStore):
+    socketio.start_background_task(presence_heartbeat)
+
 # WebSocket event handlers
 @socketio.on('connect')
 def handle_connect():
     user_id = request.sid
-    logger.info(f"New WebSocket connection from {request.remote_addr} with ID: {user_id}")
+    room = session_code(request.args.get('session'))
+    logger.info(f"New WebSocket connection from {request.remote_addr} with ID: {user_id} in session {room}")
     
     # Assign a random color to the user
     colors = ['#FF0000', '#00FF00', '#0000FF', '#FFFF00', '#FF00FF', '#00FFFF']
@@ -145,63 +714,849 @@ def handle_connect():
     connected_users[user_id] = {
         'color': user_color,
         'brush_size': 5,
-        'connected_at': time.strftime('%Y-%m-%d %H:%M:%S')
+        'connected_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'room': None,
+        'index': None,
+        # Socket ids are public in presence lists; HTTP requests prove they come from this socket with the token
+        'token': secrets.token_urlsafe(16)
     }
+    emit('socket_token', {'token': connected_users[user_id]['token']})
+    enter_session(user_id, room)
     
-    logger.info(f"Connected users: {connected_users}")
-    
-    # First broadcast the new user to all clients
-    emit('user_connected', {
-        'user_id': user_id, 
-        'color': user_color,
-        'brush_size': 5,
-        'total_users': len(connected_users)
-    }, broadcast=True)
-    
-    # Then send the current state to the newly connected user
-    emit('users_list', {
-        'users': [
-            {
-                'id': uid,
-                'color': data['color'],
-                'brush_size': data['brush_size'],
-                'connected_at': data['connected_at']
-            }
-            for uid, data in connected_users.items()
-        ],
-        'total_users': len(connected_users)
-    })
+    logger.info(f"Connected users: {len(connected_users)} in {len(connected_users.sessions())} sessions")
+
+@socketio.on('join_session')
+def handle_join_session(data):
+    try:
+        user_id = request.sid
+        if user_id not in connected_users:
+            return {'status': 'error', 'message': 'Unknown user'}
+        room = session_code((data or {}).get('session'))
+        if connected_users[user_id]['room'] != room:
+            exit_session(user_id)
+            enter_session(user_id, room)
+            logger.info(f"User {user_id} moved to session {room}")
+        return {'status': 'success', 'session': room}
+    except Exception as e:
+        logger.error(f"Error in handle_join_session: {str(e)}")
+        logger.error(traceback.format_exc())
+        return {'status': 'error', 'message': str(e)}
 
 @socketio.on('disconnect')
-def handle_disconnect():
+def handle_disconnect(reason=None):
+    # Newer python-socketio releases pass the disconnect reason
     user_id = request.sid
     logger.info(f"WebSocket disconnection from {request.remote_addr} with ID: {user_id}")
     
     if user_id in connected_users:
+        # Tell the remaining members of the session
+        exit_session(user_id)
         del connected_users[user_id]
-        logger.info(f"Connected users after disconnect: {connected_users}")
-        
-        # Broadcast updated user list to all remaining clients
-        emit('users_list', {
-            'users': [
-                {
-                    'id': uid,
-                    'color': data['color'],
-                    'brush_size': data['brush_size'],
-                    'connected_at': data['connected_at']
+        socket_limits.forget(user_id)
+        logger.info(f"Connected users after disconnect: {len(connected_users)}")
+
+# Binary drawing events (little-endian). Every message starts with a version byte and a type byte.
+# Coordinates are uint16 fractions of the sender's canvas size, brush sizes uint16 quarter pixels,
+# and users are identified by their one-byte index from connected_users instead of the sid.
+DRAWING_WIRE_VERSION = 1
+WIRE_SEGMENT = 1  # client -> server: flags, size, canvas w/h, x, y, lastX, lastY
+WIRE_STROKE_FRAME = 2  # server -> clients: count, then per stroke user, flags, size, canvas w/h, n, n points
+WIRE_USER_DRAWING = 3  # server -> clients: user, is_drawing
+WIRE_MASK_CLEARED = 4  # server -> clients: user
+WIRE_FLAG_ERASER = 0x01
+WIRE_FLAG_FROM_MODAL = 0x02
+WIRE_HEADER = struct.Struct('<BB')
+WIRE_SEGMENT_BODY = struct.Struct('<BHHH4H')
+WIRE_STROKE_HEADER = struct.Struct('<BBHHHH')
+def _quantize(value, extent):
+    return max(0, min(65535, int(round(value / max(extent, 1) * 65535))))
+
+def _dequantize(value, extent):
+    return round(value * extent / 65535, 2)
+
+def _wire_flags(tool, is_from_modal):
+    return (WIRE_FLAG_ERASER if tool == 'eraser' else 0) | (WIRE_FLAG_FROM_MODAL if is_from_modal else 0)
+
+def _wire_tool(flags):
+    return 'eraser' if flags & WIRE_FLAG_ERASER else 'brush'
+
+def encode_segment(segment):
+    width, height = segment['canvasWidth'], segment['canvasHeight']
+    return WIRE_HEADER.pack(DRAWING_WIRE_VERSION, WIRE_SEGMENT) + WIRE_SEGMENT_BODY.pack(
+        _wire_flags(segment.get('tool'), segment.get('isFromModal')),
+        max(0, min(65535, int(round(segment['brushSize'] * 4)))),
+        width, height,
+        _quantize(segment['x'], width), _quantize(segment['y'], height),
+        _quantize(segment['lastX'], width), _quantize(segment['lastY'], height))
+
+def encode_stroke_frame(strokes):
+    """Pack aggregated strokes; each needs a 'user_index' alongside the brush_frame JSON fields"""
+    parts = [WIRE_HEADER.pack(DRAWING_WIRE_VERSION, WIRE_STROKE_FRAME), struct.pack('<H', len(strokes))]
+    for stroke in strokes:
+        width, height = stroke['canvasWidth'], stroke['canvasHeight']
+        points = stroke['points']
+        parts.append(WIRE_STROKE_HEADER.pack(
+            stroke['user_index'],
+            _wire_flags(stroke.get('tool'), stroke.get('isFromModal')),
+            max(0, min(65535, int(round(stroke['brushSize'] * 4)))),
+            width, height, len(points) // 2))
+        parts.append(struct.pack(f'<{len(points)}H', *[
+            _quantize(value, width if index % 2 == 0 else height) for index, value in enumerate(points)]))
+    return b''.join(parts)
+
+def encode_user_drawing(user_index, is_drawing):
+    return WIRE_HEADER.pack(DRAWING_WIRE_VERSION, WIRE_USER_DRAWING) + struct.pack('<BB', user_index, int(is_drawing))
+
+def encode_mask_cleared(user_index):
+    return WIRE_HEADER.pack(DRAWING_WIRE_VERSION, WIRE_MASK_CLEARED) + struct.pack('<B', user_index)
+
+def decode_drawing_event(data):
+    """Decode any binary drawing event into the dict form of its JSON counterpart plus 'type'"""
+    version, event_type = WIRE_HEADER.unpack_from(data, 0)
+    if version != DRAWING_WIRE_VERSION:
+        raise ValueError(f"Unsupported drawing wire version {version}")
+    offset = WIRE_HEADER.size
+    if event_type == WIRE_SEGMENT:
+        flags, size, width, height, x, y, last_x, last_y = WIRE_SEGMENT_BODY.unpack_from(data, offset)
+        return {
+            'type': 'brush_stroke',
+            'x': _dequantize(x, width), 'y': _dequantize(y, height),
+            'lastX': _dequantize(last_x, width), 'lastY': _dequantize(last_y, height),
+            'brushSize': size / 4, 'tool': _wire_tool(flags),
+            'canvasWidth': width, 'canvasHeight': height,
+            'isFromModal': bool(flags & WIRE_FLAG_FROM_MODAL)
+        }
+    if event_type == WIRE_STROKE_FRAME:
+        (count,) = struct.unpack_from('<H', data, offset)
+        offset += 2
+        strokes = []
+        for _ in range(count):
+            user_index, flags, size, width, height, point_count = WIRE_STROKE_HEADER.unpack_from(data, offset)
+            offset += WIRE_STROKE_HEADER.size
+            values = struct.unpack_from(f'<{point_count * 2}H', data, offset)
+            offset += point_count * 4
+            strokes.append({
+                'user_index': user_index, 'tool': _wire_tool(flags), 'brushSize': size / 4,
+                'canvasWidth': width, 'canvasHeight': height,
+                'isFromModal': bool(flags & WIRE_FLAG_FROM_MODAL),
+                'points': [_dequantize(value, width if index % 2 == 0 else height)
+                           for index, value in enumerate(values)]
+            })
+        return {'type': 'brush_frame', 'strokes': strokes}
+    if event_type == WIRE_USER_DRAWING:
+        user_index, is_drawing = struct.unpack_from('<BB', data, offset)
+        return {'type': 'user_drawing', 'user_index': user_index, 'is_drawing': bool(is_drawing)}
+    if event_type == WIRE_MASK_CLEARED:
+        (user_index,) = struct.unpack_from('<B', data, offset)
+        return {'type': 'mask_cleared', 'user_index': user_index}
+    raise ValueError(f"Unknown drawing event type {event_type}")
+
+def parse_brush_segment(data):
+    """A JSON brush_stroke payload as the segment dict decode_drawing_event produces
+
+    Coordinates must be finite numbers and canvas sizes whole numbers the wire
+    format can carry; ValueError otherwise. Unknown fields are dropped.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("brush stroke must be an object")
+    segment = {}
+    for field in ('x', 'y', 'lastX', 'lastY', 'brushSize'):
+        value = data.get(field, 5 if field == 'brushSize' else None)
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            raise ValueError(f"{field} must be a finite number, got {value!r}")
+        segment[field] = value
+    for field in ('canvasWidth', 'canvasHeight'):
+        value = data.get(field)
+        if (isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value)
+                or value != int(value)):
+            raise ValueError(f"{field} must be a whole number, got {value!r}")
+        if not 1 <= value <= 65535:
+            raise ValueError(f"{field} {value} is out of range")
+        segment[field] = int(value)
+    segment['tool'] = 'eraser' if data.get('tool') == 'eraser' else 'brush'
+    segment['isFromModal'] = bool(data.get('isFromModal'))
+    return segment
+
+class StrokeAggregator:
+    """Buffers brush segments per room and broadcasts them as one brush_frame per tick
+
+    Consecutive segments from the same user with the same tool and size are
+    merged into a single polyline, so a frame carries one entry per active
+    stroke instead of one message per mousemove. Traffic is counted both as
+    sent and as the per-segment relay would have sent it.
+    """
+
+    STROKE_FIELDS = ('tool', 'brushSize', 'canvasWidth', 'canvasHeight', 'isFromModal')
+
+    def __init__(self, interval_ms):
+        self.interval = interval_ms / 1000
+        self.rooms = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        # (time, segments in, bytes in, relay messages, relay bytes, frame messages, frame bytes) per tick
+        self.samples = collections.deque()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = socketio.start_background_task(self._run)
+
+    def add(self, room, user_id, color, segment, recipients, size=None):
+        """Buffer one segment; recipients is how many clients the relay would have sent it to
+
+        size is the segment's wire size when it arrived binary-encoded.
+        """
+        self.start()
+        with self.lock:
+            pending = self.rooms.setdefault(room, {'strokes': [], 'users': set(), 'recipients': 0,
+                                                   'segments': 0, 'bytes_in': 0, 'relay_bytes': 0})
+            stroke = self._open_stroke(pending['strokes'], user_id, segment)
+            if stroke is None:
+                stroke = {'user_id': user_id, 'color': color, 'points': [segment['lastX'], segment['lastY']]}
+                stroke.update({field: segment.get(field) for field in self.STROKE_FIELDS})
+                pending['strokes'].append(stroke)
+            stroke['points'] += [segment['x'], segment['y']]
+            pending['users'].add(user_id)
+            pending['recipients'] = recipients
+            pending['segments'] += 1
+            json_size = len(json.dumps(segment))
+            pending['bytes_in'] += size or json_size
+            # The relay added user_id, color and timestamp to the JSON before sending to everyone else
+            pending['relay_bytes'] += (json_size + len(user_id) + len(color) + 60) * recipients
+
+    def flush(self):
+        with self.lock:
+            rooms, self.rooms = self.rooms, {}
+        now = time.time()
+        sample = [now, 0, 0, 0, 0, 0, 0]
+        for room, pending in rooms.items():
+            frame = {'strokes': pending['strokes'], 'timestamp': int(now * 1000)}
+            try:
+                frames = self._encode_frames(frame) if BINARY_DRAWING_EVENTS else [frame]
+            except Exception as e:
+                # One bad room must not cost every other room its frame
+                logger.error(f"Error encoding brush frame for room {room}: {str(e)}")
+                continue
+            # A lone drawer doesn't need their own strokes echoed back
+            skip_sid = [next(iter(pending['users']))] if len(pending['users']) == 1 else []
+            members = connected_users.members(room)
+            # Clients that can't keep up catch up from mask_state later instead
+            skip_sid += [sid for sid in socket_limits.slow_consumers(room, members) if sid not in skip_sid]
+            for frame in frames:
+                socketio.emit('brush_frame', frame, to=room, skip_sid=skip_sid)
+            socket_limits.frames_sent(room, members, skip_sid, len(frames))
+            receivers = pending['recipients'] + 1 - len(skip_sid)
+            sample[1] += pending['segments']
+            sample[2] += pending['bytes_in']
+            sample[3] += pending['segments'] * pending['recipients']
+            sample[4] += pending['relay_bytes']
+            sample[5] += receivers
+            sample[6] += sum(len(frame) if isinstance(frame, bytes) else len(json.dumps(frame))
+                             for frame in frames) * receivers
+        with self.lock:
+            self.samples.append(sample)
+            while self.samples and self.samples[0][0] < now - STROKE_STATS_WINDOW:
+                self.samples.popleft()
+
+    def stats(self):
+        with self.lock:
+            samples = list(self.samples)
+        totals = [sum(sample[index] for sample in samples) for index in range(1, 7)]
+        window = STROKE_STATS_WINDOW
+
+        def rate(value):
+            return round(value / window, 1)
+
+        return {
+            'frame_interval_ms': round(self.interval * 1000),
+            'window_seconds': window,
+            'inbound': {'messages_per_second': rate(totals[0]), 'bytes_per_second': rate(totals[1])},
+            'per_segment_relay': {'messages_per_second': rate(totals[2]), 'bytes_per_second': rate(totals[3])},
+            'batched': {'messages_per_second': rate(totals[4]), 'bytes_per_second': rate(totals[5])}
+        }
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing brush strokes: {str(e)}")
+
+    @staticmethod
+    def _encode_frames(frame):
+        """The frame as a binary brush_frame, plus a JSON one for users without a one-byte index"""
+        strokes, unindexed = [], []
+        for stroke in frame['strokes']:
+            user = connected_users.get(stroke['user_id'])
+            if not user:
+                # Disconnected since drawing
+                continue
+            if user.get('index') is None:
+                # Beyond the one-byte index range; the JSON frame names the user by sid instead
+                unindexed.append(stroke)
+                continue
+            strokes.append(dict(stroke, user_index=user['index']))
+        frames = [encode_stroke_frame(strokes)] if strokes or not unindexed else []
+        if unindexed:
+            frames.append(dict(frame, strokes=unindexed))
+        return frames
+
+    def _open_stroke(self, strokes, user_id, segment):
+        """The user's latest stroke in this frame if the segment continues it, else None"""
+        for stroke in reversed(strokes):
+            if stroke['user_id'] != user_id:
+                continue
+            if (stroke['points'][-2:] == [segment['lastX'], segment['lastY']]
+                    and all(stroke[field] == segment.get(field) for field in self.STROKE_FIELDS)):
+                return stroke
+            return None
+        return None
+
+stroke_aggregator = StrokeAggregator(STROKE_FRAME_INTERVAL_MS)
+
+class SharedMaskStore:
+    """Authoritative copy of each room's mask as a uint8 raster (255 painted, 0 clear)
+
+    Every brush/eraser segment and clear_mask is applied as it arrives. Late
+    joiners get a PNG snapshot plus the log of strokes drawn since it was
+    taken; once that tail grows past MASK_SNAPSHOT_EVERY segments it is
+    dropped and the next joiner gets a freshly encoded snapshot instead.
+    Snapshots are encoded from a copy of the raster outside the lock, so
+    strokes keep being applied while a late joiner is served.
+
+    With a shared store, every event is also kept in that store's log for the
+    room (see publish_mask_event). The first time this process serves a room
+    it rebuilds the raster from that log, so a process started after drawing
+    began doesn't hand late joiners a blank mask.
+    """
+
+    def __init__(self, max_size, snapshot_every, shared=None):
+        self.max_size = max_size
+        self.snapshot_every = snapshot_every
+        self.shared = shared
+        self.rooms = {}
+        self.seeded = set()  # rooms rebuilt from the shared log, or found empty there
+        self.loading = {}  # room -> events delivered while it is being rebuilt
+        self.replayed = {}  # room -> ids replayed from the log that pub/sub may still deliver
+        self.compacting = set()
+        self.lock = threading.Lock()
+
+    def apply_event(self, event):
+        """Apply a published segment or clear, rebuilding the room from the shared log first if it is new here"""
+        room = event['room']
+        with self.lock:
+            if room in self.loading:
+                self.loading[room].append(event)
+                return
+            seed = self.shared is not None and room not in self.seeded
+            if seed:
+                self.loading[room] = [event]
+        if seed:
+            self._seed(room)
+        else:
+            self._apply_delivered(event)
+
+    def ensure_seeded(self, room):
+        if self.shared is None:
+            return
+        with self.lock:
+            if room in self.seeded or room in self.loading:
+                return
+            self.loading[room] = []
+        self._seed(room)
+
+    def compact(self, room):
+        """Fold the shared log into a snapshot of this raster, up to the last event applied here"""
+        with self.lock:
+            state = self.rooms.get(room)
+            if state is None or state['last_id'] is None:
+                return False
+            raster = state['raster'].copy()
+            last_id = state['last_id']
+        png = run_blocking(self._encode, raster)
+        height, width = raster.shape
+        snapshot = {'png': base64.b64encode(png).decode('ascii'), 'width': width, 'height': height, 'last_id': last_id}
+        return self.shared.compact_log(f"mask:{room}", last_id, snapshot)
+
+    def compact_later(self, room):
+        with self.lock:
+            if room in self.compacting:
+                return
+            self.compacting.add(room)
+
+        def run():
+            try:
+                self.compact(room)
+            except Exception as e:
+                logger.error(f"Error compacting the shared mask log of {room}: {str(e)}")
+            finally:
+                with self.lock:
+                    self.compacting.discard(room)
+        socketio.start_background_task(run)
+
+    def _seed(self, room):
+        """Rebuild the room from the shared snapshot and log, then apply what was delivered meanwhile"""
+        try:
+            snapshot, events = self.shared.read_log(f"mask:{room}")
+        except Exception as e:
+            logger.error(f"Could not read the shared mask log of {room}: {str(e)}")
+            snapshot, events = None, []
+        if snapshot and np is not None:
+            raster = np.array(Image.open(io.BytesIO(base64.b64decode(snapshot['png']))).convert('L'))
+            with self.lock:
+                state = self._new_state(snapshot['width'], snapshot['height'])
+                state['raster'] = raster
+                state['last_id'] = snapshot['last_id']
+                self.rooms[room] = state
+        for event in events:
+            self._apply(event)
+        with self.lock:
+            # Pub/sub delivers in log order, so these arrive as a run and are skipped once
+            self.replayed[room] = [event.get('id') for event in events]
+        while True:
+            with self.lock:
+                delivered = self.loading[room]
+                if not delivered:
+                    del self.loading[room]
+                    self.seeded.add(room)
+                    return
+                self.loading[room] = []
+            for event in delivered:
+                self._apply_delivered(event)
+
+    def _apply_delivered(self, event):
+        with self.lock:
+            replayed = self.replayed.get(event['room'])
+            if replayed:
+                if event.get('id') in replayed:
+                    # Already applied from the log; anything before it in the log can no longer arrive
+                    del replayed[:replayed.index(event.get('id')) + 1]
+                    return
+                # Newer than the whole log that was read
+                del self.replayed[event['room']]
+        self._apply(event)
+
+    def _apply(self, event):
+        if event.get('clear'):
+            self.clear(event['room'], event.get('id'))
+        else:
+            self.apply_segment(event['room'], event['user_id'], event['color'], event['segment'], event.get('id'))
+
+    def apply_segment(self, room, user_id, color, segment, event_id=None):
+        if np is None:
+            return
+        canvas_width = max(int(segment.get('canvasWidth') or 0), 1)
+        canvas_height = max(int(segment.get('canvasHeight') or 0), 1)
+        with self.lock:
+            state = self.rooms.get(room)
+            if state is None:
+                scale = min(1.0, self.max_size / max(canvas_width, canvas_height))
+                state = self._new_state(max(1, int(canvas_width * scale)), max(1, int(canvas_height * scale)))
+                self.rooms[room] = state
+            raster = state['raster']
+            height, width = raster.shape
+            scale_x, scale_y = width / canvas_width, height / canvas_height
+            radius = max(0.5, (segment.get('brushSize') or 5) / 2 * (scale_x + scale_y) / 2)
+            value = 0 if segment.get('tool') == 'eraser' else 255
+            self._draw_segment(raster, segment['lastX'] * scale_x, segment['lastY'] * scale_y,
+                               segment['x'] * scale_x, segment['y'] * scale_y, radius, value)
+
+            state['last_id'] = event_id
+            state['seq'] += 1
+            state['segments_since_snapshot'] += 1
+            if state['segments_since_snapshot'] > self.snapshot_every:
+                # The raster is authoritative, so a long tail is dropped and the next snapshot re-encoded
+                state['snapshot'] = None
+                state['encoding_seq'] = None
+                state['log'] = []
+                state['segments_since_snapshot'] = 0
+                return
+            log = state['log']
+            last = log[-1] if log else None
+            if (last and last['user_id'] == user_id and last['points'][-2:] == [segment['lastX'], segment['lastY']]
+                    and all(last[field] == segment.get(field) for field in StrokeAggregator.STROKE_FIELDS)):
+                last['points'] += [segment['x'], segment['y']]
+            else:
+                stroke = {'user_id': user_id, 'color': color,
+                          'points': [segment['lastX'], segment['lastY'], segment['x'], segment['y']]}
+                stroke.update({field: segment.get(field) for field in StrokeAggregator.STROKE_FIELDS})
+                log.append(stroke)
+
+    def clear(self, room, event_id=None):
+        with self.lock:
+            state = self.rooms.get(room)
+            if state is None:
+                return
+            state['raster'][:] = 0
+            state['last_id'] = event_id
+            state['seq'] += 1
+            state['log'] = []
+            state['segments_since_snapshot'] = 0
+            state['snapshot'] = None
+            state['encoding_seq'] = None
+
+    def state(self, room):
+        """Snapshot and stroke tail for a late joiner, or None if nothing has been drawn"""
+        self.ensure_seeded(room)
+        with self.lock:
+            state = self.rooms.get(room)
+            if state is None:
+                return None
+            if state['snapshot'] is not None:
+                return self._reply(state, state['snapshot'])
+            # Copy the raster and restart the tail from it; strokes keep landing while it encodes
+            raster = state['raster'].copy()
+            seq = state['seq']
+            state['snapshot_seq'] = seq
+            state['encoding_seq'] = seq
+            state['log'] = []
+            state['segments_since_snapshot'] = 0
+        snapshot = run_blocking(self._encode, raster)
+        with self.lock:
+            if state['encoding_seq'] == seq:
+                state['snapshot'] = snapshot
+                state['encoding_seq'] = None
+                return self._reply(state, snapshot)
+        # A clear, a dropped tail or a newer snapshot replaced the tail since the copy; live frames cover the gap
+        height, width = raster.shape
+        return {'seq': seq, 'snapshot_seq': seq, 'width': width, 'height': height, 'snapshot': snapshot, 'strokes': []}
+
+    @staticmethod
+    def _reply(state, snapshot):
+        height, width = state['raster'].shape
+        return {
+            'seq': state['seq'],
+            'snapshot_seq': state['snapshot_seq'],
+            'width': width,
+            'height': height,
+            'snapshot': snapshot,
+            'strokes': [dict(stroke, points=list(stroke['points'])) for stroke in state['log']]
+        }
+
+    def mask_png(self, room):
+        """The current mask as a grayscale PNG, for generating straight from the shared canvas"""
+        self.ensure_seeded(room)
+        with self.lock:
+            state = self.rooms.get(room)
+            raster = state['raster'].copy() if state is not None else None
+        if raster is None or not raster.any():
+            return None
+        return run_blocking(self._encode, raster)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'rooms': {
+                    str(room): {
+                        'size': list(reversed(state['raster'].shape)),
+                        'coverage': round(float(np.count_nonzero(state['raster'])) / state['raster'].size, 4),
+                        'seq': state['seq'],
+                        'tail_segments': state['segments_since_snapshot']
+                    }
+                    for room, state in self.rooms.items()
                 }
-                for uid, data in connected_users.items()
-            ],
-            'total_users': len(connected_users)
-        }, broadcast=True)
+            }
+
+    @staticmethod
+    def _new_state(width, height):
+        return {
+            'raster': np.zeros((height, width), dtype=np.uint8),
+            'seq': 0,
+            'log': [],
+            'segments_since_snapshot': 0,
+            'snapshot': None,
+            'snapshot_seq': 0,
+            'encoding_seq': None,  # seq of the raster copy being encoded outside the lock
+            'last_id': None  # id of the last published event applied, up to which the shared log can be compacted
+        }
+
+    @staticmethod
+    def _encode(raster):
+        buffer = io.BytesIO()
+        Image.fromarray(raster, 'L').save(buffer, format='PNG', compress_level=6)
+        return buffer.getvalue()
+
+    @staticmethod
+    def _draw_segment(raster, x0, y0, x1, y1, radius, value):
+        """Fill every pixel within radius of the segment, which gives round caps and joins"""
+        height, width = raster.shape
+        left = max(int(min(x0, x1) - radius), 0)
+        right = min(int(max(x0, x1) + radius) + 1, width)
+        top = max(int(min(y0, y1) - radius), 0)
+        bottom = min(int(max(y0, y1) + radius) + 1, height)
+        if left >= right or top >= bottom:
+            return
+        ys, xs = np.ogrid[top:bottom, left:right]
+        # Pixel centres, projected onto the segment and clamped to its ends
+        xs = xs + 0.5
+        ys = ys + 0.5
+        dx, dy = x1 - x0, y1 - y0
+        length_sq = dx * dx + dy * dy
+        t = np.clip(((xs - x0) * dx + (ys - y0) * dy) / length_sq, 0, 1) if length_sq else 0
+        distance_sq = (xs - x0 - t * dx) ** 2 + (ys - y0 - t * dy) ** 2
+        raster[top:bottom, left:right][distance_sq <= radius * radius] = value
+
+shared_masks = SharedMaskStore(MASK_RASTER_MAX_SIZE, MASK_SNAPSHOT_EVERY, connected_users)
+
+def apply_mask_event(event):
+    """Apply a segment or clear published by any server process to this process's raster"""
+    shared_masks.apply_event(event)
+
+def publish_mask_event(event):
+    """Send a segment or clear to every process's raster, logging it for processes that start later"""
+    event['id'] = uuid.uuid4().hex
+    logged = connected_users.publish_logged('mask', f"mask:{event['room']}", event, reset=bool(event.get('clear')))
+    if logged > MASK_LOG_MAX:
+        shared_masks.compact_later(event['room'])
+
+# Every process keeps its own raster, so mask edits go through the presence store's pub/sub
+connected_users.subscribe('mask', apply_mask_event)
+
+def emit_mask_state(room, to=None):
+    """Send the requesting client (or sid `to`) the shared mask snapshot and stroke tail, if anything is drawn"""
+    state = shared_masks.state(room)
+    if state:
+        if to is None:
+            emit('mask_state', state)
+        else:
+            socketio.emit('mask_state', state, to=to)
+
+class SocketEventLimiter:
+    """Per-connection token buckets for high-frequency socket events, plus slow-consumer tracking
+
+    Events over their limit are dropped, except idempotent ones (brush size,
+    location) which are coalesced: the newest throttled update is held and
+    delivered once the bucket refills, replacing any older one still waiting.
+    Every ack_every brush frames a client is sent a frame_sync probe, and
+    its acknowledgement arrives only once the frames ahead of it have been
+    delivered. A client with more than SLOW_CONSUMER_BACKLOG frames sent but
+    not yet acknowledged is left out of brush frames until that drops to half,
+    then gets a fresh mask_state instead of the frames it missed.
+    """
+
+    def __init__(self, limits, slow_backlog, ack_every=32, interval=0.05):
+        self.limits = limits
+        self.slow_backlog = slow_backlog
+        self.ack_every = ack_every
+        self.interval = interval
+        self.buckets = {}  # (sid, event) -> [tokens, last refill]
+        self.pending = {}  # (sid, event) -> newest coalesced delivery
+        self.slow = {}  # sid -> room, for clients currently left out of brush frames
+        # sid -> [frames sent, frames acknowledged (None until the first ack), frames covered by the probe in flight, room]
+        self.frames = {}
+        self.room_frames = collections.defaultdict(set)  # room -> sids in self.frames, to drop those that left
+        self.counts = collections.defaultdict(
+            lambda: {'throttled': collections.Counter(), 'coalesced': collections.Counter(), 'frames_skipped': 0})
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = socketio.start_background_task(self._run)
+
+    def allow(self, sid, event):
+        """Take a token for one event; False (and counted as throttled) when over the limit"""
+        with self.lock:
+            if self._take(sid, event):
+                return True
+            self.counts[sid]['throttled'][event] += 1
+            return False
+
+    def coalesce(self, sid, event, deliver):
+        """Call deliver() now if the limit allows, otherwise hold it as the event's newest update"""
+        self.start()
+        with self.lock:
+            if self._take(sid, event):
+                # Anything still waiting is older than this update
+                if self.pending.pop((sid, event), None) is not None:
+                    self.counts[sid]['coalesced'][event] += 1
+            else:
+                if (sid, event) in self.pending:
+                    self.counts[sid]['coalesced'][event] += 1
+                self.counts[sid]['throttled'][event] += 1
+                self.pending[(sid, event)] = deliver
+                return False
+        deliver()
+        return True
+
+    def slow_consumers(self, room, members):
+        """Members of the room whose outbound queue is too deep for another brush frame"""
+        slow = []
+        for sid in members:
+            backlog = self.backlog(sid)
+            if sid in self.slow or (backlog is not None and backlog > self.slow_backlog):
+                slow.append(sid)
+        with self.lock:
+            for sid in slow:
+                if sid not in self.slow:
+                    logger.warning(f"Slow consumer {sid} in session {room}, pausing brush frames")
+                self.slow[sid] = room
+                self.counts[sid]['frames_skipped'] += 1
+        if slow:
+            self.start()
+        return slow
+
+    def frames_sent(self, room, members, skipped, count=1):
+        """Count brush frames broadcast to the room's members, probing any that is due for an acknowledgement"""
+        probes = []
+        with self.lock:
+            # Members of other processes are never forgotten here, so drop whoever has left the room
+            tracked = self.room_frames[room]
+            for sid in tracked - members:
+                if self.frames.get(sid, [None] * 4)[3] == room:
+                    del self.frames[sid]
+            tracked &= members
+            for sid in members:
+                if sid in skipped:
+                    continue
+                frames = self.frames.get(sid)
+                if frames is None or frames[3] != room:
+                    frames = self.frames[sid] = [0, None, None, room]
+                    tracked.add(sid)
+                frames[0] += count
+                if frames[2] is None and frames[0] - (frames[1] or 0) >= self.ack_every:
+                    frames[2] = frames[0]
+                    probes.append((sid, frames[0]))
+            if not tracked:
+                del self.room_frames[room]
+        for sid, sent in probes:
+            self._probe(sid, sent)
+
+    def backlog(self, sid):
+        """Brush frames sent to the client but not yet acknowledged, or None before its first acknowledgement"""
+        with self.lock:
+            frames = self.frames.get(sid)
+            if frames is None or frames[1] is None:
+                return None
+            return frames[0] - frames[1]
+
+    def forget(self, sid):
+        with self.lock:
+            for event in self.limits:
+                self.buckets.pop((sid, event), None)
+                self.pending.pop((sid, event), None)
+            self.slow.pop(sid, None)
+            self.frames.pop(sid, None)
+            self.counts.pop(sid, None)
+
+    def _probe(self, sid, sent):
+        def acknowledged(*args):
+            with self.lock:
+                frames = self.frames.get(sid)
+                if frames is not None and frames[2] == sent:
+                    frames[1], frames[2] = sent, None
+        socketio.emit('frame_sync', sent, to=sid, callback=acknowledged)
+
+    def stats(self):
+        with self.lock:
+            users = {
+                sid: {
+                    'throttled': dict(counts['throttled']),
+                    'coalesced': dict(counts['coalesced']),
+                    'frames_skipped': counts['frames_skipped'],
+                    'slow_consumer': sid in self.slow
+                }
+                for sid, counts in self.counts.items()
+            }
+        for sid, user in users.items():
+            user['backlog'] = self.backlog(sid)
+        return {
+            'limits': {event: {'rate': rate, 'burst': burst} for event, (rate, burst) in self.limits.items()},
+            'slow_consumer_backlog': self.slow_backlog,
+            'users': users
+        }
+
+    def _take(self, sid, event):
+        limit = self.limits.get(event)
+        if limit is None:
+            return True
+        rate, burst = limit
+        now = time.monotonic()
+        bucket = self.buckets.setdefault((sid, event), [burst, now])
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return True
+        return False
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.interval)
+            try:
+                self._deliver_pending()
+                self._release_recovered()
+            except Exception as e:
+                logger.error(f"Error in socket event limiter: {str(e)}")
+
+    def _deliver_pending(self):
+        with self.lock:
+            ready = [key for key in self.pending if self._take(*key)]
+            deliveries = [self.pending.pop(key) for key in ready]
+        for deliver in deliveries:
+            deliver()
+
+    def _release_recovered(self):
+        with self.lock:
+            slow = list(self.slow.items())
+        for sid, room in slow:
+            backlog = self.backlog(sid)
+            if backlog is None or backlog <= self.slow_backlog // 2:
+                with self.lock:
+                    self.slow.pop(sid, None)
+                if backlog is not None:
+                    # Replace the frames it missed with the current shared mask
+                    logger.info(f"Slow consumer {sid} caught up, resending mask state")
+                    emit_mask_state(room, to=sid)
+                continue
+            # It gets no frames while paused, so ask directly whether it has caught up
+            with self.lock:
+                frames = self.frames.get(sid)
+                sent = None
+                if frames is not None and frames[2] is None:
+                    sent = frames[2] = frames[0]
+            if sent is not None:
+                self._probe(sid, sent)
+
+socket_limits = SocketEventLimiter(SOCKET_EVENT_LIMITS, SLOW_CONSUMER_BACKLOG, FRAME_ACK_EVERY)
 
 @socketio.on('brush_stroke')
 def handle_brush_stroke(data):
     user_id = request.sid
     if user_id in connected_users:
+        if not socket_limits.allow(user_id, 'brush_stroke'):
+            return
+        user_data = connected_users[user_id]
+        
+        size = None
+        if isinstance(data, bytes):
+            size = len(data)
+            try:
+                data = decode_drawing_event(data)
+            except (ValueError, struct.error) as e:
+                logger.warning(f"Invalid binary brush stroke from {user_id}: {str(e)}")
+                return
+            del data['type']
+        else:
+            try:
+                data = parse_brush_segment(data)
+            except ValueError as e:
+                logger.warning(f"Invalid brush stroke from {user_id}: {str(e)}")
+                return
+        
+        room = user_data['room']
+        publish_mask_event({'room': room, 'user_id': user_id, 'color': user_data['color'], 'segment': data})
+        
+        if STROKE_FRAME_INTERVAL_MS > 0:
+            # Batched into the next brush_frame for the room
+            stroke_aggregator.add(room, user_id, user_data['color'], data,
+                                  connected_users.room_size(room) - 1, size)
+            return
+        
         # Add user information to the data
         data['user_id'] = user_id
-        user_data = connected_users[user_id]
         data['color'] = user_data['color']
         
         # Add timestamp for debugging
@@ -211,17 +1566,42 @@ def handle_brush_stroke(data):
         if random.random() < 0.01:  # Log approximately 1% of strokes
             logger.debug(f"Broadcasting brush stroke from {user_id}: {data}")
         
-        # Broadcast to all other clients (exclude the sender)
-        emit('brush_stroke', data, broadcast=True, include_self=False)
+        # Broadcast to the rest of the session (exclude the sender)
+        emit('brush_stroke', data, to=room, include_self=False)
     else:
         logger.warning(f"Brush stroke from unknown user: {user_id}")
 
+@app.route('/api/socket-limits')
+def get_socket_limits():
+    """Configured event limits plus throttled, coalesced and skipped-frame counts per connected user"""
+    try:
+        return jsonify(socket_limits.stats())
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/stroke-stats')
+def get_stroke_stats():
+    try:
+        stats = stroke_aggregator.stats()
+        if np is not None:
+            stats['shared_mask'] = shared_masks.stats()
+        return jsonify(stats)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @socketio.on('update_brush_size')
 def handle_brush_size_update(data):
     user_id = request.sid
     if user_id in connected_users:
-        connected_users[user_id]['brush_size'] = data['size']
-        emit('brush_size_updated', {'user_id': user_id, 'size': data['size']}, broadcast=True)
+        size = data.get('size') if isinstance(data, dict) else None
+        if isinstance(size, bool) or not isinstance(size, int) or not 1 <= size <= MAX_BRUSH_SIZE:
+            logger.warning(f"Invalid brush size from {user_id}: {size!r}")
+            return
+        connected_users.update_user(user_id, brush_size=size)
+        room = connected_users[user_id]['room']
+        # Only the latest size matters, so throttled updates are coalesced rather than dropped
+        socket_limits.coalesce(user_id, 'update_brush_size', lambda: emit_presence_delta(
+            'user_updated', room, {'user_id': user_id, 'changes': {'brush_size': size}}))
 
 @socketio.on('image_upload')
 def handle_image_upload(data):
@@ -238,10 +1618,10 @@ def handle_image_upload(data):
             data['user_id'] = user_id
             data['user_color'] = connected_users[user_id]['color']
             
-            logger.info(f"Broadcasting image URL to all clients except sender: {data['imageUrl'][:100]}...")
+            logger.info(f"Broadcasting image URL to the session except sender: {data['imageUrl'][:100]}...")
             
-            # Broadcast to all clients except sender
-            emit('image_uploaded', data, broadcast=True, include_self=False)
+            # Broadcast to the rest of the session
+            emit('image_uploaded', data, to=connected_users[user_id]['room'], include_self=False)
             
             logger.info(f"Image URL broadcast successful")
             return {'status': 'success'}
@@ -260,10 +1640,10 @@ def handle_image_generated(data):
             # Add user information to the data
             data['user_id'] = user_id
             
-            logger.info(f"Broadcasting generated image URL to all clients: {data['image_url'][:100]}...")
+            logger.info(f"Broadcasting generated image URL to the session: {data['image_url'][:100]}...")
             
-            # Broadcast to all clients including sender
-            emit('image_generated', data, broadcast=True)
+            # Broadcast to the whole session including sender
+            emit('image_generated', data, to=connected_users[user_id]['room'])
             
             logger.info(f"Generated image URL broadcast successful")
             return {'status': 'success'}
@@ -279,24 +1659,22 @@ def handle_state_request():
         logger.info(f"User {user_id} requested current state")
         
         # Send current users list
-        emit('users_list', {
-            'users': [
-                {
-                    'id': uid,
-                    'color': data['color'],
-                    'brush_size': data['brush_size'],
-                    'connected_at': data['connected_at']
-                }
-                for uid, data in connected_users.items()
-            ],
-            'total_users': len(connected_users)
-        })
+        room = connected_users[user_id]['room'] if user_id in connected_users else DEFAULT_SESSION
+        emit('users_list', users_list_payload(room))
+        emit_mask_state(room)
         
         logger.info(f"Current state sent to user {user_id}")
     except Exception as e:
         logger.error(f"Error in handle_state_request: {str(e)}")
         logger.error(traceback.format_exc())
 
+@socketio.on('request_presence')
+def handle_presence_request():
+    """Fresh presence snapshot for a client that missed a delta"""
+    user_id = request.sid
+    if user_id in connected_users and connected_users[user_id].get('room') is not None:
+        emit('users_list', users_list_payload(connected_users[user_id]['room']))
+
 @socketio.on('location_updated')
 def handle_location_updated(data):
     try:
@@ -313,18 +1691,23 @@ def handle_location_updated(data):
                 return {'status': 'error', 'message': 'Missing panorama data'}
             
             # Log more detailed information about the broadcast
-            logger.info(f"Broadcasting location update with panorama data from {user_id} to all other users")
-            logger.info(f"Connected users: {list(connected_users.keys())}")
+            room = connected_users[user_id]['room']
+            logger.info(f"Broadcasting location update with panorama data from {user_id} to session {room}")
+            logger.info(f"Session users: {list(connected_users.members(room))}")
             logger.info(f"Broadcast data: {data}")
             
-            # Broadcast to all other clients
-            emit('location_updated', {
+            # Broadcast to the other members of the session; a throttled update is held until
+            # the limit allows it, and replaced if a newer location arrives first
+            payload = {
                 'location': data['location'],
                 'panorama_id': data['panorama_id'],
                 'heading': data['heading'],
                 'image_url': data.get('image_url'),
                 'user_id': user_id
-            }, broadcast=True, include_self=False)
+            }
+            if not socket_limits.coalesce(user_id, 'location_updated',
+                                          lambda: socketio.emit('location_updated', payload, to=room, skip_sid=user_id)):
+                return {'status': 'coalesced'}
             
             logger.info(f"Location update with panorama data broadcast successful")
             return {'status': 'success'}
@@ -343,14 +1726,17 @@ def handle_location_updated(data):
 def handle_debug_ping(data):
     try:
         user_id = request.sid
+        if not socket_limits.allow(user_id, 'debug_ping'):
+            return {'status': 'throttled'}
         logger.info(f"Received debug ping from {user_id}: {data}")
         
         # Add user ID to the data for identification
         data['user_id'] = user_id
         
-        # Broadcast to all clients including sender
-        logger.info(f"Broadcasting debug ping from {user_id} to all clients")
-        emit('debug_ping', data, broadcast=True)
+        # Broadcast to the sender's session, sender included
+        room = connected_users[user_id]['room'] if user_id in connected_users else DEFAULT_SESSION
+        logger.info(f"Broadcasting debug ping from {user_id} to session {room}")
+        emit('debug_ping', data, to=room)
         
         logger.info(f"Debug ping broadcast completed")
         return {'status': 'success'}
@@ -359,17 +1745,21 @@ def handle_debug_ping(data):
         logger.error(traceback.format_exc())
         return {'status': 'error', 'message': str(e)}
 
+def drawing_event_payload(user_id, is_drawing):
+    """user_drawing payload: binary when enabled and the user has an index, JSON otherwise"""
+    user = connected_users[user_id]
+    if BINARY_DRAWING_EVENTS and user['index'] is not None:
+        return encode_user_drawing(user['index'], is_drawing)
+    return {'user_id': user_id, 'color': user['color'], 'is_drawing': is_drawing}
+
 @socketio.on('start_drawing')
 def handle_start_drawing():
     try:
         user_id = request.sid
         if user_id in connected_users:
             # Broadcast to all other clients that this user started drawing
-            emit('user_drawing', {
-                'user_id': user_id,
-                'color': connected_users[user_id]['color'],
-                'is_drawing': True
-            }, broadcast=True, include_self=False)
+            emit('user_drawing', drawing_event_payload(user_id, True),
+                 to=connected_users[user_id]['room'], include_self=False)
     except Exception as e:
         logger.error(f"Error in handle_start_drawing: {str(e)}")
         logger.error(traceback.format_exc())
@@ -380,11 +1770,8 @@ def handle_stop_drawing():
         user_id = request.sid
         if user_id in connected_users:
             # Broadcast to all other clients that this user stopped drawing
-            emit('user_drawing', {
-                'user_id': user_id,
-                'color': connected_users[user_id]['color'],
-                'is_drawing': False
-            }, broadcast=True, include_self=False)
+            emit('user_drawing', drawing_event_payload(user_id, False),
+                 to=connected_users[user_id]['room'], include_self=False)
     except Exception as e:
         logger.error(f"Error in handle_stop_drawing: {str(e)}")
         logger.error(traceback.format_exc())
@@ -394,15 +1781,36 @@ def handle_clear_mask():
     try:
         user_id = request.sid
         if user_id in connected_users:
-            # Broadcast to all other clients that this user cleared the mask
-            emit('mask_cleared', {
-                'user_id': user_id,
-                'color': connected_users[user_id]['color']
-            }, broadcast=True, include_self=False)
+            # Broadcast to the rest of the session that this user cleared the mask
+            room = connected_users[user_id]['room']
+            publish_mask_event({'room': room, 'clear': True})
+            index = connected_users[user_id]['index']
+            if BINARY_DRAWING_EVENTS and index is not None:
+                payload = encode_mask_cleared(index)
+            else:
+                payload = {'user_id': user_id, 'color': connected_users[user_id]['color']}
+            emit('mask_cleared', payload, to=room, include_self=False)
     except Exception as e:
         logger.error(f"Error in handle_clear_mask: {str(e)}")
         logger.error(traceback.format_exc())
 
+@socketio.on('register_facilitator')
+def handle_register_facilitator(data):
+    try:
+        user_id = request.sid
+        if not FACILITATOR_KEY or not data or data.get('key') != FACILITATOR_KEY:
+            logger.warning(f"Rejected facilitator registration from {user_id}")
+            return {'error': 'Invalid facilitator key'}
+        if user_id in connected_users:
+            # Generation requests from this session now use the facilitator lane
+            connected_users.update_user(user_id, role='facilitator')
+            logger.info(f"User {user_id} registered as facilitator")
+        return {'role': 'facilitator'}
+    except Exception as e:
+        logger.error(f"Error in handle_register_facilitator: {str(e)}")
+        logger.error(traceback.format_exc())
+        return {'error': str(e)}
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -411,18 +1819,106 @@ def index():
 def favicon():
     return send_file('assets/images/logo.png', mimetype='image/png')
 
+def verified_socket_id(params):
+    """The socket id a request names, if it also carries the token that socket was issued on connect"""
+    socket_id = params.get('socket_id')
+    token = params.get('socket_token')
+    user = connected_users.get(socket_id) if socket_id and token else None
+    if not user or not user.get('token') or not hmac.compare_digest(str(user['token']), str(token)):
+        if socket_id:
+            logging.warning(f"Ignoring unverified socket_id {socket_id} from {request.remote_addr}")
+        return None
+    return socket_id
+
+def submit_generation_request(image_bytes, mask_bytes, params, socket_id=None, binary=False):
+    """Check the result cache, then queue a generation job; returns (response body, status code)
+
+    socket_id must already be verified: it picks the facilitator lane and
+    cancels the same socket's queued jobs.
+    """
+    prompt = params.get('prompt', '')
+    negative_prompt = params.get('negative_prompt', '')
+    room = request_session(params, socket_id)
+    
+    try:
+        # Form fields arrive as strings; out-of-range counts are clamped rather than refused
+        variants = max(1, min(int(params.get('variants') or 1), MAX_VARIANTS))
+        seed = int(params.get('seed') or DETERMINISTIC_SEED)
+    except (TypeError, ValueError):
+        return {"error": f"variants and seed must be whole numbers (variants 1 to {MAX_VARIANTS})"}, 400
+    crop_to_mask = str(params.get('crop_to_mask', '')).lower() in ('true', '1')
+    options = {'variants': variants, 'crop_to_mask': crop_to_mask}
+    
+    # Deterministic mode fixes the seed so identical requests can reuse a cached result
+    if str(params.get('deterministic', '')).lower() in ('true', '1'):
+        cache_key = result_cache.make_key(image_bytes, mask_bytes, prompt, negative_prompt,
+                                          DEFAULT_CHECKPOINT, DEFAULT_SAMPLER_SETTINGS, seed, variants,
+                                          crop_to_mask)
+        cache_keys = result_cache.variant_keys(cache_key, variants)
+        cached = result_cache.get_many(cache_keys)
+        if cached:
+            logging.info(f"Result cache hit for {cache_key[:12]}")
+            return {
+                "job_id": None,
+                "status": "completed",
+                "cached": True,
+                "result": cached_result_response(cached, prompt, negative_prompt, socket_id, room,
+                                                 cache_keys if binary else None)
+            }, 200
+        options.update(seed=seed, cache_keys=cache_keys)
+    
+    # Queue the workflow; the result is pushed over the image_generated event
+    user = connected_users.get(socket_id) or {}
+    try:
+        job_id = generation_queue.submit(
+            image_bytes,
+            mask_bytes,
+            prompt,
+            negative_prompt,
+            socket_id=socket_id,
+            room=room,
+            binary=binary,
+            # Sessions are the unit of fairness; HTTP callers without one share their address
+            user_key=socket_id or request.remote_addr,
+            lane='facilitator' if user.get('role') == 'facilitator' else 'participant',
+            # Everyone behind one NAT or tunnel shares an address, so only a verified socket supersedes its jobs
+            supersede=socket_id is not None,
+            **options
+        )
+    except queue.Full:
+        logging.warning("Generation queue is full, rejecting request")
+        return {"error": "Generation queue is full, please try again shortly"}, 503
+    
+    return {
+        "job_id": job_id,
+        "status": "queued",
+        "queue_position": generation_queue.queue_depth()
+    }, 202
+
+def request_session(params, socket_id=None):
+    """Session an HTTP/socket generation request belongs to: explicit code, else the caller's room"""
+    if params.get('session'):
+        return session_code(params.get('session'))
+    user = connected_users.get(socket_id) or {}
+    return user.get('room') or DEFAULT_SESSION
+
+def wants_shared_mask(params):
+    """True when the request asks to inpaint with the server's shared mask instead of an uploaded one"""
+    return np is not None and str(params.get('use_shared_mask', '')).lower() in ('true', '1')
+
 @app.route('/api/process', methods=['POST'])
 def process():
     try:
         data = request.get_json()
-        logging.debug(f"Received request with data keys: {list(data.keys())}")
         
         if not data:
             logging.error("No JSON data received")
             return jsonify({"error": "No data received"}), 400
+        logging.debug(f"Received request with data keys: {list(data.keys())}")
 
-        # Validate required fields
-        required_fields = ['image', 'mask']
+        # Validate required fields; the mask may come from the server's shared canvas instead
+        use_shared_mask = wants_shared_mask(data)
+        required_fields = ['image'] if use_shared_mask else ['image', 'mask']
         for field in required_fields:
             if field not in data:
                 logging.error(f"Missing required field: {field}")
@@ -431,21 +1927,14 @@ def process():
         try:
             # Convert base64 strings to bytes
             image_bytes = base64.b64decode(data['image'])
-            mask_bytes = base64.b64decode(data['mask'])
-            
-            # Process the workflow with binary data
-            result = process_workflow(
-                image_bytes,
-                mask_bytes,
-                data.get('prompt', ''),
-                data.get('negative_prompt', '')
-            )
-            
-            # Convert result image back to base64 for response
-            if isinstance(result.get('image'), bytes):
-                result['image'] = base64.b64encode(result['image']).decode('utf-8')
+            socket_id = verified_socket_id(data)
+            mask_bytes = (shared_masks.mask_png(request_session(data, socket_id)) if use_shared_mask
+                          else base64.b64decode(data['mask']))
+            if mask_bytes is None:
+                return jsonify({"error": "Nothing has been drawn on the shared mask"}), 400
             
-            return jsonify(result)
+            body, status = submit_generation_request(image_bytes, mask_bytes, data, socket_id)
+            return jsonify(body), status
             
         except Exception as e:
             logging.error(f"Error processing data: {str(e)}")
@@ -457,23 +1946,63 @@ def process():
         logging.error(traceback.format_exc())
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/process-binary', methods=['POST'])
+def process_binary():
+    """Multipart variant of /api/process: image and mask are raw PNG file parts, not base64 JSON"""
+    try:
+        use_shared_mask = wants_shared_mask(request.form)
+        for field in ('image',) if use_shared_mask else ('image', 'mask'):
+            if field not in request.files:
+                logging.error(f"Missing required file: {field}")
+                return jsonify({"error": f"Missing {field}"}), 400
+        
+        image_bytes = request.files['image'].read()
+        socket_id = verified_socket_id(request.form)
+        mask_bytes = (shared_masks.mask_png(request_session(request.form, socket_id))
+                      if use_shared_mask else request.files['mask'].read())
+        if mask_bytes is None:
+            return jsonify({"error": "Nothing has been drawn on the shared mask"}), 400
+        
+        body, status = submit_generation_request(image_bytes, mask_bytes, request.form, socket_id, binary=True)
+        return jsonify(body), status
+        
+    except Exception as e:
+        logging.error(f"Error processing binary request: {str(e)}")
+        logging.error(traceback.format_exc())
+        return jsonify({"error": str(e)}), 500
+
+@socketio.on('process_image')
+def handle_process_image(data):
+    """Binary SocketIO counterpart of /api/process; image and mask arrive as binary attachments"""
+    try:
+        if not isinstance(data.get('image'), bytes) or not isinstance(data.get('mask'), bytes):
+            return {'error': 'image and mask must be sent as binary data'}
+        
+        body, status = submit_generation_request(data['image'], data['mask'], data, request.sid, binary=True)
+        return body
+    except Exception as e:
+        logger.error(f"Error in handle_process_image: {str(e)}")
+        logger.error(traceback.format_exc())
+        return {'error': str(e)}
+
 @app.route('/test_comfyui')
 def test_comfyui():
     try:
-        # Test connection to ComfyUI
-        response = requests.get(f"{COMFYUI_API_URL}/object_info")
-        if response.status_code == 200:
-            return jsonify({
-                "status": "success",
-                "message": "ComfyUI is running and accessible",
-                "data": response.json()
-            })
-        else:
+        # Test connection to ComfyUI through the shared model catalog
+        try:
+            catalog = model_catalog.get()
+        except Exception as e:
             return jsonify({
                 "status": "error",
-                "message": f"ComfyUI returned status code: {response.status_code}",
-                "error": response.text
+                "message": "ComfyUI did not return its object info",
+                "error": str(e)
             }), 500
+        return jsonify({
+            "status": "success",
+            "message": "ComfyUI is running and accessible",
+            "data": catalog['object_info'],
+            "catalog": model_catalog.stats()
+        })
     except Exception as e:
         return jsonify({
             "status": "error",
@@ -484,13 +2013,10 @@ def test_comfyui():
 @app.route('/check_workflow')
 def check_workflow():
     try:
-        workflow_path = os.path.join(os.path.dirname(__file__), "Inpaint_Anything.json")
-        if not os.path.exists(workflow_path):
+        workflow_data = workflow_registry.graph('inpaint_anything')
+        if workflow_data is None:
             return jsonify({"error": "Workflow file not found"}), 404
             
-        with open(workflow_path, 'r') as f:
-            workflow_data = json.load(f)
-            
         # Get node information
         nodes_info = [
             {
@@ -511,22 +2037,12 @@ def check_workflow():
 @app.route('/test_workflow_conversion')
 def test_workflow_conversion():
     try:
-        workflow_path = os.path.join(os.path.dirname(__file__), "Inpaint_Anything.json")
-        with open(workflow_path, 'r') as f:
-            workflow_data = json.load(f)
-            
-        # Test converting first few nodes
-        test_prompt = {}
-        for node in workflow_data['nodes'][:5]:  # Test first 5 nodes
-            node_id = str(node['id'])
-            test_prompt[node_id] = {
-                "class_type": node['type'],
-                "inputs": node.get('inputs', {})
-            }
-            
+        template = workflow_registry.get('inpaint_anything')
         return jsonify({
             "status": "success",
-            "test_prompt": test_prompt
+            "test_prompt": template.prompt,
+            "slots": template.describe()['slots'],
+            "problems": template.problems
         })
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -534,9 +2050,9 @@ def test_workflow_conversion():
 @app.route('/debug_prompt')
 def debug_prompt():
     try:
-        workflow_path = os.path.join(os.path.dirname(__file__), "Inpaint_Anything.json")
-        with open(workflow_path, 'r') as f:
-            workflow_data = json.load(f)
+        workflow_data = workflow_registry.graph('inpaint_anything')
+        if workflow_data is None:
+            return jsonify({"error": "Workflow file not found"}), 404
             
         # Get a sample of the workflow structure
         sample = {
@@ -551,6 +2067,19 @@ def debug_prompt():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/workflows')
+def list_workflows():
+    try:
+        workflows = []
+        for name in workflow_registry.names():
+            try:
+                workflows.append(workflow_registry.get(name).describe())
+            except Exception as e:
+                workflows.append({"name": name, "error": str(e)})
+        return jsonify({"workflows": workflows})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/test', methods=['POST'])
 def test_endpoint():
     try:
@@ -564,90 +2093,50 @@ def test_endpoint():
 @app.route('/api/history/<prompt_id>')
 def get_history(prompt_id):
     try:
-        response = requests.get(f"{COMFYUI_API_URL}/history")
-        if response.status_code != 200:
-            return jsonify({"error": "Failed to get history from ComfyUI"}), 500
-            
-        history = response.json()
-        prompt_data = history.get(prompt_id)
+        comfyui_events.start()
+        # Falls back to asking each backend's /history for this one prompt when no
+        # event listener has seen it (e.g. it was queued before a restart)
+        backend, state = comfyui_backends.find_prompt(prompt_id)
         
-        if not prompt_data:
+        if not state:
             return jsonify({
                 "completed": False,
                 "progress": 0,
                 "executing": False
             })
-            
-        # Check for execution errors
-        status = prompt_data.get('status', {})
-        status_str = status.get('status_str')
-        messages = status.get('messages', [])
-        
-        # Log status for debugging
-        logging.debug(f"Workflow status: {status_str}")
-        logging.debug(f"Messages: {messages}")
-        
-        if status_str == 'error':
-            error_messages = []
-            for msg in messages:
-                if msg[0] == 'execution_error':
-                    error_data = msg[1]
-                    error_messages.append({
-                        'node_id': error_data.get('node_id'),
-                        'node_type': error_data.get('node_type'),
-                        'error_type': error_data.get('exception_type'),
-                        'message': error_data.get('exception_message'),
-                        'traceback': error_data.get('traceback', [])
-                    })
-            
-            if error_messages:
-                return jsonify({
-                    "error": "Workflow execution failed",
-                    "details": error_messages,
-                    "status": status_str
-                }), 500
+        
+        if state['status'] == 'error':
+            return jsonify({
+                "error": "Workflow execution failed",
+                "details": [state['error']] if state['error'] else [],
+                "status": state['status']
+            }), 500
             
         # Check if workflow completed
-        if prompt_data.get('outputs'):
-            images = []
-            for node_id, output in prompt_data['outputs'].items():
-                if output.get('images'):
-                    images.extend(output['images'])
-                    logging.info(f"Found {len(output['images'])} images in node {node_id}")
-                    
+        images = []
+        for node_id, output in state['outputs'].items():
+            if output.get('images'):
+                images.extend(output['images'])
+                
+        if state['status'] == 'completed':
             if images:
                 logging.info(f"Workflow completed with {len(images)} total images")
                 return jsonify({
                     "completed": True,
                     "images": images
                 })
-            else:
-                logging.warning("Workflow completed but no images found")
-                
-        # Check execution status
-        executing = False
-        for msg in messages:
-            if msg[0] == 'execution_start':
-                executing = True
-                logging.debug("Workflow execution started")
-            elif msg[0] == 'execution_cached':
-                executing = False
-                logging.debug("Workflow execution cached")
-            elif msg[0] == 'execution_error':
-                executing = False
-                logging.error("Workflow execution error")
-                
+            logging.warning("Workflow completed but no images found")
+        
         # Return progress
         progress = 0
-        if prompt_data.get('progress'):
-            progress = round(prompt_data['progress'].get('value', 0) * 100)
-            logging.debug(f"Current progress: {progress}%")
+        if state['progress']['max']:
+            progress = round(state['progress']['value'] / state['progress']['max'] * 100)
             
         return jsonify({
             "completed": False,
             "progress": progress,
-            "executing": executing,
-            "status": status_str
+            "executing": state['status'] == 'executing',
+            "status": state['status']
         })
 
     except Exception as e:
@@ -657,22 +2146,23 @@ def get_history(prompt_id):
 
 @app.route('/debug_workflow')
 def debug_workflow():
-    workflow_path = os.path.join(os.path.dirname(__file__), "Inpaint_Anything.json")
-    with open(workflow_path, 'r') as f:
-        workflow_data = json.load(f)
+    workflow_data = workflow_registry.graph('inpaint_anything')
+    if workflow_data is None:
+        return jsonify({"error": "Workflow file not found"}), 404
         
     # Find node 48 (Mask Crop Region)
     node_48 = next((node for node in workflow_data['nodes'] if str(node['id']) == '48'), None)
     if node_48:
         logging.debug("Node 48 configuration from JSON:")
         logging.debug(json.dumps(node_48, indent=2))
+    return jsonify({"node": node_48})
 
 @app.route('/debug_node/<node_id>')
 def debug_node_config(node_id):
     try:
-        workflow_path = os.path.join(os.path.dirname(__file__), "Inpaint_Anything.json")
-        with open(workflow_path, 'r') as f:
-            workflow_data = json.load(f)
+        workflow_data = workflow_registry.graph('inpaint_anything')
+        if workflow_data is None:
+            return jsonify({"error": "Workflow file not found"}), 404
             
         # Find the node
         node = next((n for n in workflow_data['nodes'] if str(n['id']) == node_id), None)
@@ -692,17 +2182,12 @@ def debug_node_config(node_id):
 @app.route('/api/available_models', methods=['GET'])
 def get_available_models():
     try:
-        response = requests.get(f"{COMFYUI_API_URL}/object_info")
-        if response.ok:
-            data = response.json()
-            models = {
-                "checkpoints": data.get("CheckpointLoaderSimple", {}).get("input", {}).get("required", {}).get("ckpt_name", []),
-                "vae": data.get("VAELoader", {}).get("input", {}).get("required", {}).get("vae_name", []),
-                "clip": data.get("CLIPLoader", {}).get("input", {}).get("required", {}).get("clip_name", [])
-            }
-            return jsonify(models)
-        else:
+        try:
+            catalog = model_catalog.get()
+        except Exception as e:
+            logging.error(f"Failed to get model info: {str(e)}")
             return jsonify({"error": "Failed to get model info"}), 500
+        return jsonify(catalog['models'])
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -728,29 +2213,44 @@ def debug_comfyui_paths():
 
 @app.route('/api/save-submission', methods=['POST'])
 def save_submission():
+    """Append submissions to submissions.csv
+
+    Takes one submission or {"submissions": [...]}, in the same shape
+    /api/submissions returns. The older {"csvData": "..."} body is still
+    accepted; its rows are parsed and re-serialized rather than written as-is.
+    """
     try:
-        data = request.get_json()
-        if not data or 'csvData' not in data:
+        data = request.get_json(silent=True)
+        if not data:
             return jsonify({"error": "No data provided"}), 400
+        if not isinstance(data, dict):
+            return jsonify({"error": "Invalid submission: expected a JSON object"}), 400
 
-        csv_file_path = os.path.join(os.path.dirname(__file__), 'submissions.csv')
+        if 'csvData' in data:
+            if not isinstance(data['csvData'], str):
+                return jsonify({"error": "Invalid submission: csvData must be a string"}), 400
+            rows = csv_data_rows(data['csvData'])
+        else:
+            submissions = data.get('submissions', [data])
+            if not isinstance(submissions, list):
+                return jsonify({"error": "Invalid submission: submissions must be a list"}), 400
+            rows = [submission_to_row(submission) for submission in submissions]
+        if not rows:
+            return jsonify({"error": "No data provided"}), 400
         
-        # Check if file exists to write headers
-        file_exists = os.path.exists(csv_file_path)
+        # Returns once the rows are fsynced, batched with any other submissions arriving meanwhile
+        submission_writer.append(rows)
         
-        with open(csv_file_path, 'a', newline='') as f:
-            # Write headers if file is new
-            if not file_exists:
-                headers = ['Timestamp', 'Latitude', 'Longitude', 'Image URL', 
-                          'Main Subject', 'Context', 'Avoid', 'Sunlight', 
-                          'Movement', 'Privacy', 'Harmony']
-                f.write(','.join(headers) + '\n')
-            
-            # Write the data
-            f.write(data['csvData'])
+        # Index the appended rows right away so the next read sees them
+        if submission_store is not None:
+            submission_store.sync()
+            submission_clusters.refresh(submission_store)
+            announce_new_submissions()
         
-        return jsonify({"success": True})
+        return jsonify({"success": True, "count": len(rows)})
     
+    except ValueError as e:
+        return jsonify({"error": f"Invalid submission: {str(e)}"}), 400
     except Exception as e:
         logging.error(f"Error saving to CSV: {str(e)}")
         return jsonify({"error": str(e)}), 500
@@ -758,7 +2258,7 @@ def save_submission():
 @app.route('/api/download-csv')
 def download_csv():
     try:
-        csv_file_path = os.path.join(os.path.dirname(__file__), 'submissions.csv')
+        csv_file_path = SUBMISSIONS_CSV_PATH
         if not os.path.exists(csv_file_path):
             return jsonify({"error": "No submissions found"}), 404
             
@@ -773,46 +2273,681 @@ def download_csv():
         logging.error(f"Error downloading CSV: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
-def load_submissions_from_csv():
+SUBMISSION_CSV_HEADERS = ['Timestamp', 'Latitude', 'Longitude', 'Image URL',
+                          'Main Subject', 'Context', 'Avoid', 'Sunlight',
+                          'Movement', 'Privacy', 'Harmony']
+
+def submission_from_row(row):
+    """The nested submission dict the clients expect, from one submissions.csv row"""
+    return {
+        'timestamp': row['Timestamp'],
+        'location': {
+            'lat': float(row['Latitude']),
+            'lng': float(row['Longitude'])
+        },
+        'imageUrl': row['Image URL'],
+        'prompts': {
+            'mainSubject': row['Main Subject'],
+            'context': row['Context'],
+            'avoid': row['Avoid'],
+            'sliderValues': {
+                'sunlight': row['Sunlight'],
+                'movement': row['Movement'],
+                'privacy': row['Privacy'],
+                'harmony': row['Harmony']
+            }
+        }
+    }
+
+def parse_location(lat, lng):
+    """(lat, lng) as floats; ValueError unless both are numbers in range"""
     try:
-        csv_file_path = os.path.join(os.path.dirname(__file__), 'submissions.csv')
-        if not os.path.exists(csv_file_path):
+        lat, lng = float(lat), float(lng)
+    except (TypeError, ValueError):
+        raise ValueError(f"location needs numeric lat and lng, got {lat!r} and {lng!r}")
+    # NaN fails every comparison, so it is rejected here too
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise ValueError(f"location {lat},{lng} is out of range")
+    return lat, lng
+
+def submission_to_row(submission):
+    """One submissions.csv row, in SUBMISSION_CSV_HEADERS order, from a submission dict"""
+    if not isinstance(submission, dict):
+        raise ValueError("each submission must be an object")
+    location = submission.get('location') or {}
+    prompts = submission.get('prompts') or {}
+    if not isinstance(location, dict) or not isinstance(prompts, dict):
+        raise ValueError("location and prompts must be objects")
+    sliders = prompts.get('sliderValues') or {}
+    if not isinstance(sliders, dict):
+        raise ValueError("sliderValues must be an object")
+    lat, lng = parse_location(location.get('lat', submission.get('lat')),
+                              location.get('lng', submission.get('lng')))
+    return [
+        submission.get('timestamp') or time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime()) + 'Z',
+        lat, lng,
+        submission.get('imageUrl', ''),
+        prompts.get('mainSubject', ''),
+        prompts.get('context', ''),
+        prompts.get('avoid', ''),
+        sliders.get('sunlight', ''),
+        sliders.get('movement', ''),
+        sliders.get('privacy', ''),
+        sliders.get('harmony', '')
+    ]
+
+def csv_data_rows(csv_data):
+    """Rows from a client-built CSV string, checked against the submissions.csv columns"""
+    rows = [values for values in csv.reader(io.StringIO(csv_data)) if any(value.strip() for value in values)]
+    for values in rows:
+        if len(values) != len(SUBMISSION_CSV_HEADERS):
+            raise ValueError(f"expected {len(SUBMISSION_CSV_HEADERS)} columns, got {len(values)}")
+        # Latitude and longitude have to parse, or the row would be skipped on import
+        parse_location(values[1], values[2])
+    return rows
+
+class SubmissionWriter:
+    """The one writer for submissions.csv, committing queued rows in groups
+
+    Requests queue their rows and wait. The writer thread takes everything
+    queued so far (up to SUBMISSION_WRITE_BATCH rows' worth of requests),
+    serializes it with the csv module and appends it with a single O_APPEND
+    write and one fsync. Rows from different requests never interleave, and
+    a burst of submitters costs one fsync per batch rather than one each.
+    """
+
+    def __init__(self, csv_path, max_batch):
+        self.csv_path = csv_path
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stats = {'rows': 0, 'batches': 0, 'largest_batch': 0}
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="submission-writer", daemon=True)
+                self.thread.start()
+
+    def append(self, rows, timeout=30):
+        """Queue rows for the CSV and block until they are on disk"""
+        self.start()
+        future = concurrent.futures.Future()
+        self.queue.put((rows, future))
+        return future.result(timeout)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            size = len(batch[0][0])
+            while size < self.max_batch:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(item)
+                size += len(item[0])
+            try:
+                run_blocking(self._commit, [row for rows, _ in batch for row in rows])
+            except Exception as e:
+                logging.error(f"Error writing submissions: {str(e)}")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            with self.lock:
+                self.stats['rows'] += size
+                self.stats['batches'] += 1
+                self.stats['largest_batch'] = max(self.stats['largest_batch'], size)
+            for _, future in batch:
+                future.set_result(True)
+
+    def _commit(self, rows):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+        writer.writerows(rows)
+        fd = os.open(self.csv_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            data = buffer.getvalue()
+            if os.fstat(fd).st_size == 0:
+                data = ','.join(SUBMISSION_CSV_HEADERS) + '\n' + data
+            data = data.encode('utf-8')
+            # O_APPEND keeps each batch contiguous even with other server processes appending too
+            while data:
+                data = data[os.write(fd, data):]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+submission_writer = SubmissionWriter(SUBMISSIONS_CSV_PATH, SUBMISSION_WRITE_BATCH)
+
+def read_submission_rows(csv_file_path, offset=0):
+    """Parse the complete CSV records from a byte offset on
+
+    Returns (header, rows, end offset). A record still being written (no
+    trailing newline, or an open quoted field) is left for the next read.
+    """
+    rows = []
+    with open(csv_file_path, 'rb') as f:
+        header_line = f.readline()
+        header = next(csv.reader([header_line.decode('utf-8', errors='replace')]), [])
+        offset = max(offset, len(header_line))
+        f.seek(offset)
+        record = b''
+        for line in f:
+            record += line
+            if not line.endswith(b'\n') or record.count(b'"') % 2:
+                continue
+            values = next(csv.reader(io.StringIO(record.decode('utf-8', errors='replace'))), [])
+            offset += len(record)
+            record = b''
+            if any(value.strip() for value in values):
+                rows.append(dict(zip(header, values)))
+    return header, rows, offset
+
+class SubmissionCsvCache:
+    """submissions.csv parsed once per process and kept up to date by reading only appended bytes
+
+    The file's size and mtime are checked on every call. If they are
+    unchanged the cached list is returned. If the file grew, only the new
+    records are parsed. If it shrank or its header changed, it is parsed
+    again from the start.
+    """
+
+    def __init__(self, csv_path):
+        self.csv_path = csv_path
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.submissions = []
+        self.header = None
+        self.offset = 0
+        self.signature = None
+
+    def get(self):
+        try:
+            stat = os.stat(self.csv_path)
+        except FileNotFoundError:
+            with self.lock:
+                self._reset()
             return []
-            
-        submissions = []
-        with open(csv_file_path, 'r') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                submissions.append({
-                    'timestamp': row['Timestamp'],
-                    'location': {
-                        'lat': float(row['Latitude']),
-                        'lng': float(row['Longitude'])
-                    },
-                    'imageUrl': row['Image URL'],
-                    'prompts': {
-                        'mainSubject': row['Main Subject'],
-                        'context': row['Context'],
-                        'avoid': row['Avoid'],
-                        'sliderValues': {
-                            'sunlight': row['Sunlight'],
-                            'movement': row['Movement'],
-                            'privacy': row['Privacy'],
-                            'harmony': row['Harmony']
-                        }
-                    }
-                })
-        return submissions
+        signature = (stat.st_size, stat.st_mtime_ns)
+        # Concurrent callers (every client asks on connect) wait for one parse instead of each doing their own
+        with self.lock:
+            if signature != self.signature:
+                if stat.st_size < self.offset:
+                    self._reset()
+                header, rows, end = read_submission_rows(self.csv_path, self.offset)
+                if self.header is not None and header != self.header:
+                    self._reset()
+                    header, rows, end = read_submission_rows(self.csv_path, 0)
+                for row in rows:
+                    try:
+                        self.submissions.append(submission_from_row(row))
+                    except (KeyError, TypeError, ValueError) as e:
+                        logging.warning(f"Skipping malformed submission row {row}: {str(e)}")
+                self.header, self.offset, self.signature = header, end, signature
+            return list(self.submissions)
+
+submission_csv_cache = SubmissionCsvCache(SUBMISSIONS_CSV_PATH)
+
+def load_submissions_from_csv():
+    try:
+        return submission_csv_cache.get()
     
     except Exception as e:
         logging.error(f"Error loading submissions from CSV: {str(e)}")
         return []
 
+class SubmissionStore:
+    """Indexed copy of submissions.csv in SQLite (WAL mode)
+
+    The CSV stays the append-only record and download format. sync() imports
+    only the bytes appended since the last import, tracked as a byte offset in
+    the database, so keeping up costs O(new rows). Reads are paginated and
+    filtered queries that cost O(page) rather than a parse of the whole file.
+    sqlite3 blocks, so every statement runs in a worker thread (run_blocking)
+    on one of a fixed pool of connections rather than on the event loop.
+    """
+
+    SLIDERS = (('sunlight', 'Sunlight'), ('movement', 'Movement'), ('privacy', 'Privacy'), ('harmony', 'Harmony'))
+
+    def __init__(self, db_path, csv_path, connections=None):
+        self.db_path = db_path
+        self.csv_path = csv_path
+        # Connections are opened on first use; None marks a free slot without one yet
+        self.pool = queue.Queue()
+        for _ in range(connections or SUBMISSIONS_DB_CONNECTIONS):
+            self.pool.put(None)
+        self.lock = threading.Lock()
+        self.synced = None  # (size, mtime) of the CSV at the last sync by this process
+        self._run(lambda conn: conn.executescript('''
+                CREATE TABLE IF NOT EXISTS submissions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    timestamp TEXT,
+                    lat REAL NOT NULL,
+                    lng REAL NOT NULL,
+                    image_url TEXT,
+                    main_subject TEXT,
+                    context TEXT,
+                    avoid TEXT,
+                    sunlight TEXT,
+                    movement TEXT,
+                    privacy TEXT,
+                    harmony TEXT
+                );
+                CREATE INDEX IF NOT EXISTS submissions_timestamp ON submissions (timestamp);
+                CREATE INDEX IF NOT EXISTS submissions_location ON submissions (lat, lng);
+                CREATE TABLE IF NOT EXISTS store_meta (key TEXT PRIMARY KEY, value TEXT);
+            '''))
+
+    def _connect(self):
+        # WAL lets readers run alongside the importer and other processes
+        conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _run(self, func):
+        """func(conn) on a pooled connection in a worker thread; waiting for a free connection only blocks the caller"""
+        conn = self.pool.get()
+        try:
+            if conn is None:
+                conn = run_blocking(self._connect)
+            return run_blocking(func, conn)
+        finally:
+            self.pool.put(conn)
+
+    def _fetchone(self, sql, params=()):
+        return self._run(lambda conn: conn.execute(sql, params).fetchone())
+
+    def sync(self):
+        """Import rows appended to the CSV since the last sync; re-import if it was truncated or replaced"""
+        try:
+            stat = os.stat(self.csv_path)
+        except FileNotFoundError:
+            return 0
+        if self.synced == (stat.st_size, stat.st_mtime_ns):
+            return 0
+        with self.lock:
+            imported = self._run(lambda conn: self._import(conn, stat.st_size))
+            self.synced = (stat.st_size, stat.st_mtime_ns)
+        if imported:
+            logging.info(f"Imported {imported} submissions from {self.csv_path}")
+        return imported
+
+    def _import(self, conn, size):
+        # IMMEDIATE takes the write lock up front, so two processes never import the same bytes
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            meta = dict(conn.execute('SELECT key, value FROM store_meta').fetchall())
+            offset = int(meta.get('csv_offset', 0))
+            header, rows, end = read_submission_rows(self.csv_path, offset)
+            if size < offset or meta.get('csv_header', ','.join(header)) != ','.join(header):
+                logging.info(f"{self.csv_path} was truncated or replaced, re-importing it")
+                conn.execute('DELETE FROM submissions')
+                header, rows, end = read_submission_rows(self.csv_path, 0)
+                # Sync tokens from before the re-import no longer describe what clients hold
+                conn.execute('INSERT OR REPLACE INTO store_meta (key, value) VALUES (?, ?)',
+                             ('generation', str(int(meta.get('generation', 0)) + 1)))
+            conn.executemany(
+                'INSERT INTO submissions (timestamp, lat, lng, image_url, main_subject, context, avoid, '
+                'sunlight, movement, privacy, harmony) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [values for values in map(self._row_values, rows) if values is not None])
+            conn.executemany('INSERT OR REPLACE INTO store_meta (key, value) VALUES (?, ?)',
+                             [('csv_offset', str(end)), ('csv_header', ','.join(header))])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return len(rows)
+
+    def query(self, limit=None, offset=0, bbox=None, since=None, until=None, search=None, descending=False,
+              after_id=None):
+        """One page of submissions matching the filters, plus the total number that match
+
+        bbox is (south, west, north, east); since/until compare against the
+        timestamp text; search matches the prompt fields; after_id keeps only
+        submissions added after that one, for cursors.
+        """
+        self.sync()
+        clauses, params = [], []
+        if after_id is not None:
+            clauses.append('id > ?')
+            params.append(after_id)
+        if bbox:
+            south, west, north, east = bbox
+            clauses.append('lat BETWEEN ? AND ?')
+            params += [south, north]
+            if west <= east:
+                clauses.append('lng BETWEEN ? AND ?')
+            else:
+                # The box crosses the antimeridian
+                clauses.append('(lng >= ? OR lng <= ?)')
+            params += [west, east]
+        if since:
+            clauses.append('timestamp >= ?')
+            params.append(since)
+        if until:
+            clauses.append('timestamp <= ?')
+            params.append(until)
+        if search:
+            clauses.append('(main_subject LIKE ? OR context LIKE ? OR avoid LIKE ?)')
+            params += [f'%{search}%'] * 3
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ''
+        sql = f"SELECT * FROM submissions{where} ORDER BY id {'DESC' if descending else 'ASC'}"
+        page_params = params + [limit, offset] if limit is not None else params
+        if limit is not None:
+            sql += ' LIMIT ? OFFSET ?'
+
+        def fetch(conn):
+            total = conn.execute(f'SELECT COUNT(*) FROM submissions{where}', params).fetchone()[0]
+            return [self._to_submission(row) for row in conn.execute(sql, page_params)], total
+        return self._run(fetch)
+
+    def all(self):
+        return self.query()[0]
+
+    def count(self):
+        self.sync()
+        return self._fetchone('SELECT COUNT(*) FROM submissions')[0]
+
+    def generation(self):
+        """Bumped whenever the CSV is re-imported, which is the only way rows are ever removed"""
+        self.sync()
+        row = self._fetchone("SELECT value FROM store_meta WHERE key = 'generation'")
+        return int(row[0]) if row else 0
+
+    def sync_token(self, last_id=None):
+        """Opaque token for "everything up to last_id" (default: the newest submission)"""
+        generation = self.generation()
+        if last_id is None:
+            last_id = self._fetchone('SELECT COALESCE(MAX(id), 0) FROM submissions')[0]
+        return f"{generation}.{last_id}"
+
+    def start_announcing(self):
+        """Start the shared submission_added position at the newest submission, unless a process already has"""
+        token = self.sync_token()
+        self._run(lambda conn: conn.execute(
+            "INSERT OR IGNORE INTO store_meta (key, value) VALUES ('announced', ?)", (token,)))
+
+    def claim_announcement(self):
+        """Submissions no process has announced yet and the sync token after them, moving the shared position past them
+
+        The position is a store_meta row moved under BEGIN IMMEDIATE, so with
+        several processes each submission is claimed by exactly one of them.
+        """
+        self.sync()
+
+        def claim(conn):
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                meta = dict(conn.execute(
+                    "SELECT key, value FROM store_meta WHERE key IN ('generation', 'announced')").fetchall())
+                generation = meta.get('generation', '0')
+                announced_generation, _, announced_id = meta.get('announced', '').partition('.')
+                last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM submissions').fetchone()[0]
+                rows = []
+                # After a re-import clients see reset on their next get_submissions, so nothing is announced
+                if announced_generation == generation and announced_id.isdigit():
+                    rows = conn.execute('SELECT * FROM submissions WHERE id > ? AND id <= ? ORDER BY id',
+                                        (int(announced_id), last_id)).fetchall()
+                token = f"{generation}.{last_id}"
+                conn.execute("INSERT OR REPLACE INTO store_meta (key, value) VALUES ('announced', ?)", (token,))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            return [self._to_submission(row) for row in rows], token
+        return self._run(claim)
+
+    def parse_sync_token(self, token):
+        """The last submission id a token covers, or None if it is malformed or from before a re-import"""
+        try:
+            generation, last_id = str(token).split('.')
+            if self.sync_token(0).split('.')[0] != generation:
+                return None
+            return int(last_id)
+        except ValueError:
+            return None
+
+    def points_after(self, last_id):
+        """(id, lat, lng) of every submission added after last_id, oldest first"""
+        self.sync()
+        return self._run(lambda conn: conn.execute(
+            'SELECT id, lat, lng FROM submissions WHERE id > ? ORDER BY id', (last_id,)).fetchall())
+
+    def _row_values(self, row):
+        try:
+            return (row.get('Timestamp'), float(row['Latitude']), float(row['Longitude']), row.get('Image URL'),
+                    row.get('Main Subject'), row.get('Context'), row.get('Avoid'),
+                    *(row.get(column) for _, column in self.SLIDERS))
+        except (KeyError, TypeError, ValueError) as e:
+            logging.warning(f"Skipping malformed submission row {row}: {str(e)}")
+            return None
+
+    def _to_submission(self, row):
+        return {
+            'id': row['id'],
+            'timestamp': row['timestamp'],
+            'location': {'lat': row['lat'], 'lng': row['lng']},
+            'imageUrl': row['image_url'],
+            'prompts': {
+                'mainSubject': row['main_subject'],
+                'context': row['context'],
+                'avoid': row['avoid'],
+                'sliderValues': {key: row[key] for key, _ in self.SLIDERS}
+            }
+        }
+
+try:
+    submission_store = SubmissionStore(SUBMISSIONS_DB_PATH, SUBMISSIONS_CSV_PATH)
+    submission_store.sync()
+except Exception as e:
+    submission_store = None
+    logging.error(f"Could not open the submission store at {SUBMISSIONS_DB_PATH}: {str(e)}")
+    logging.warning("Submissions will be read straight from submissions.csv")
+
+class SubmissionClusterIndex:
+    """Grid clusters of submission locations for each map zoom level, updated as rows arrive
+
+    At zoom z the Web Mercator world is 256 * 2**z pixels wide and is cut
+    into CLUSTER_CELL_PX-pixel cells, so a viewport covers a bounded number
+    of cells however many submissions there are. A new submission adds to
+    one cell per zoom level. A cell is [count, lat sum, lng sum, south, west,
+    north, east, first id], and its bounds are those of the submissions in it.
+    """
+
+    def __init__(self, zooms, cell_px):
+        self.zooms = list(zooms)
+        self.cell_px = cell_px
+        self.levels = {zoom: {} for zoom in self.zooms}
+        self.last_id = 0
+        self.count = 0
+        self.generation = None  # Store generation the cells were built from
+        self.lock = threading.Lock()
+
+    def refresh(self, store):
+        """Add the store's new rows; rebuild after the store re-imported the CSV or invalidate()"""
+        with self.lock:
+            # Read before the rows: a re-import in between is then caught by the next refresh
+            generation = store.generation()
+            if generation != self.generation:
+                self.levels = {zoom: {} for zoom in self.zooms}
+                self.last_id = self.count = 0
+                self.generation = generation
+            for submission_id, lat, lng in store.points_after(self.last_id):
+                self.add(submission_id, lat, lng)
+
+    def invalidate(self):
+        """Rebuild from scratch on the next refresh"""
+        with self.lock:
+            self.generation = None
+
+    def add(self, submission_id, lat, lng):
+        world_x, world_y = self._world(lat, lng)
+        for zoom in self.zooms:
+            cells_across = (256 << zoom) // self.cell_px
+            key = (min(int(world_x * cells_across), cells_across - 1), min(int(world_y * cells_across), cells_across - 1))
+            cell = self.levels[zoom].get(key)
+            if cell is None:
+                self.levels[zoom][key] = [1, lat, lng, lat, lng, lat, lng, submission_id]
+                continue
+            cell[0] += 1
+            cell[1] += lat
+            cell[2] += lng
+            cell[3], cell[4] = min(cell[3], lat), min(cell[4], lng)
+            cell[5], cell[6] = max(cell[5], lat), max(cell[6], lng)
+        self.last_id = max(self.last_id, submission_id)
+        self.count += 1
+
+    def clusters(self, zoom, bbox=None):
+        """Clusters at the nearest indexed zoom whose cells overlap bbox (south, west, north, east)"""
+        zoom = min(self.zooms, key=lambda level: abs(level - zoom))
+        cells_across = (256 << zoom) // self.cell_px
+        with self.lock:
+            cells = self.levels[zoom]
+            if bbox:
+                south, west, north, east = bbox
+                west_x, north_y = self._cell(north, west, cells_across)
+                east_x, south_y = self._cell(south, east, cells_across)
+                # A box crossing the antimeridian wraps around from the east edge
+                x_ranges = [(west_x, east_x)] if west <= east else [(west_x, cells_across - 1), (0, east_x)]
+                span = sum(high - low + 1 for low, high in x_ranges) * (south_y - north_y + 1)
+                if span < len(cells):
+                    keys = [(x, y) for low, high in x_ranges for x in range(low, high + 1)
+                            for y in range(north_y, south_y + 1)]
+                    selected = [cells[key] for key in keys if key in cells]
+                else:
+                    selected = [cell for (x, y), cell in cells.items()
+                                if north_y <= y <= south_y and any(low <= x <= high for low, high in x_ranges)]
+            else:
+                selected = list(cells.values())
+            return zoom, [self._cluster(cell) for cell in selected]
+
+    @staticmethod
+    def _cluster(cell):
+        count, lat_sum, lng_sum, south, west, north, east, first_id = cell
+        cluster = {
+            'lat': round(lat_sum / count, 6),
+            'lng': round(lng_sum / count, 6),
+            'count': count,
+            'bounds': [south, west, north, east]
+        }
+        if count == 1:
+            cluster['id'] = first_id
+        return cluster
+
+    @staticmethod
+    def _world(lat, lng):
+        """Web Mercator position as fractions of the world, x from the antimeridian and y from the north"""
+        sin_lat = min(max(math.sin(math.radians(lat)), -0.9999), 0.9999)
+        return (lng + 180) / 360, 0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+
+    def _cell(self, lat, lng, cells_across):
+        world_x, world_y = self._world(lat, lng)
+        return (min(max(int(world_x * cells_across), 0), cells_across - 1),
+                min(max(int(world_y * cells_across), 0), cells_across - 1))
+
+submission_clusters = SubmissionClusterIndex(range(CLUSTER_MAX_ZOOM + 1), CLUSTER_CELL_PX)
+if submission_store is not None:
+    try:
+        submission_clusters.refresh(submission_store)
+    except Exception as e:
+        logging.error(f"Error building submission clusters: {str(e)}")
+
+def submission_clusters_for(zoom, bbox):
+    """(zoom used, clusters) for a map view; deep zooms and the CSV fallback are clustered per request"""
+    if submission_store is not None and zoom <= CLUSTER_MAX_ZOOM:
+        submission_clusters.refresh(submission_store)
+        return submission_clusters.clusters(zoom, bbox)
+    index = SubmissionClusterIndex([zoom], CLUSTER_CELL_PX)
+    if submission_store is not None:
+        submissions = submission_store.query(limit=SUBMISSIONS_PAGE_MAX * 20, bbox=bbox)[0]
+    else:
+        submissions = load_submissions_from_csv()
+    for number, submission in enumerate(submissions, start=1):
+        index.add(submission.get('id', number), submission['location']['lat'], submission['location']['lng'])
+    return index.clusters(zoom, bbox)
+
+SUBMISSIONS_SYNC_PAGE = 200  # Default submissions_list page size
+if submission_store is not None:
+    try:
+        submission_store.start_announcing()
+    except Exception as e:
+        logging.error(f"Error reading the submissions sync position: {str(e)}")
+
+def announce_new_submissions():
+    """Push submissions saved since the last announcement to every client as one small event"""
+    # Only the process that moves the shared position broadcasts, so each submission is announced once
+    submissions, token = submission_store.claim_announcement()
+    if submissions:
+        socketio.emit('submission_added', {'submissions': submissions, 'sync_token': token})
+
+def load_submissions():
+    """Every submission, from the indexed store when it is available"""
+    if submission_store is not None:
+        try:
+            return submission_store.all()
+        except Exception as e:
+            logging.error(f"Error reading the submission store: {str(e)}")
+    return load_submissions_from_csv()
+
+def parse_bbox(value):
+    """'south,west,north,east' as four floats, or None"""
+    if not value:
+        return None
+    parts = [float(part) for part in value.split(',')]
+    if len(parts) != 4:
+        raise ValueError("bbox must be south,west,north,east")
+    return tuple(parts)
+
 @app.route('/api/submissions')
 def get_submissions():
+    """One page of submissions, filtered by the query parameters
+
+    Parameters: limit (default and most SUBMISSIONS_PAGE_MAX), offset,
+    bbox=south,west,north,east, since, until, q, order=asc|desc.
+    With zoom=<map zoom> (and usually bbox) it returns map clusters instead.
+    """
     try:
-        submissions = load_submissions_from_csv()
-        return jsonify(submissions)
+        if 'zoom' in request.args:
+            zoom, clusters = submission_clusters_for(max(0, min(int(request.args['zoom']), 22)),
+                                                     parse_bbox(request.args.get('bbox')))
+            return jsonify({
+                'zoom': zoom,
+                'clusters': clusters,
+                'total': sum(cluster['count'] for cluster in clusters)
+            })
+        limit = min(int(request.args.get('limit', SUBMISSIONS_PAGE_MAX)), SUBMISSIONS_PAGE_MAX)
+        offset = max(int(request.args.get('offset', 0)), 0)
+        if submission_store is None:
+            # Without the index only paging is available, over the cached CSV parse
+            submissions = load_submissions_from_csv()
+            return jsonify({
+                'submissions': submissions[offset:offset + limit],
+                'total': len(submissions),
+                'limit': limit,
+                'offset': offset
+            })
+        submissions, total = submission_store.query(
+            limit=limit,
+            offset=offset,
+            bbox=parse_bbox(request.args.get('bbox')),
+            since=request.args.get('since'),
+            until=request.args.get('until'),
+            search=request.args.get('q'),
+            descending=request.args.get('order') == 'desc')
+        return jsonify({
+            'submissions': submissions,
+            'total': total,
+            'limit': limit,
+            'offset': offset
+        })
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         logging.error(f"Error getting submissions: {str(e)}")
         return jsonify({"error": str(e)}), 500
@@ -869,7 +3004,8 @@ def analyze_submissions_with_ai(submissions):
         
         # Call OpenAI API using the new format
         client = openai.OpenAI()
-        response = client.chat.completions.create(
+        response = run_blocking(
+            client.chat.completions.create,
             model="gpt-3.5-turbo",  # or another appropriate model
             messages=[
                 {"role": "system", "content": system_prompt},
@@ -960,7 +3096,7 @@ def generate_report():
             }), 500
         
         # Get all submissions
-        submissions = load_submissions_from_csv()
+        submissions = load_submissions()
         
         # If no submissions, create sample data for testing
         if not submissions:
@@ -1413,390 +3549,1857 @@ def generate_report():
                     else:
                         elements.append(Paragraph("No vote data available", normal_style))
                 else:
-                    elements.append(Paragraph("Vote data not available from server", normal_style))
-            else:
-                elements.append(Paragraph("Requests library not available - cannot fetch vote data", normal_style))
-        except Exception as vote_error:
-            logging.error(f"Error processing vote data for report: {str(vote_error)}")
-            elements.append(Paragraph(f"Unable to access vote data: {str(vote_error)}", normal_style))
-        
-        # Generate the PDF
-        doc.build(elements)
+                    elements.append(Paragraph("Vote data not available from server", normal_style))
+            else:
+                elements.append(Paragraph("Requests library not available - cannot fetch vote data", normal_style))
+        except Exception as vote_error:
+            logging.error(f"Error processing vote data for report: {str(vote_error)}")
+            elements.append(Paragraph(f"Unable to access vote data: {str(vote_error)}", normal_style))
+        
+        # Generate the PDF
+        doc.build(elements)
+        
+        # Get the PDF value
+        pdf_value = buffer.getvalue()
+        buffer.close()
+        
+        # Return the PDF
+        return send_file(
+            io.BytesIO(pdf_value),
+            mimetype='application/pdf',
+            as_attachment=True,
+            download_name='consensus_submissions_report.pdf',
+            etag=False,
+            last_modified=None,
+            max_age=None
+        )
+        
+    except Exception as e:
+        logging.error(f"Error generating report: {str(e)}")
+        logging.error(traceback.format_exc())
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/vote-data')
+def get_vote_data():
+    """Endpoint to provide vote data for the report generation."""
+    try:
+        # Get votes from Firebase Realtime Database
+        votes_ref = db.reference('votes')
+        votes_data = votes_ref.get()
+        if votes_data is None:
+            votes_data = {"votes": {}}
+        
+        return jsonify(votes_data)
+    except Exception as e:
+        logging.error(f"Error getting vote data from Firebase: {str(e)}")
+        logging.error(traceback.format_exc())
+        
+        # Fallback to local file if Firebase fails
+        try:
+            votes_file_path = os.path.join(os.path.dirname(__file__), 'votes.json')
+            if os.path.exists(votes_file_path):
+                with open(votes_file_path, 'r') as f:
+                    votes_data = json.load(f)
+            else:
+                votes_data = {"votes": {}}
+            
+            return jsonify(votes_data)
+        except Exception as fallback_error:
+            logging.error(f"Error getting vote data from fallback file: {str(fallback_error)}")
+            return jsonify({"votes": {}}), 500
+
+@app.route('/api/save-votes', methods=['POST'])
+def save_votes():
+    """Save votes from the client to Firebase."""
+    try:
+        data = request.get_json()
+        if not data or 'votes' not in data:
+            logging.error("No vote data provided in request")
+            return jsonify({"error": "No vote data provided"}), 400
+        
+        logging.info(f"Received vote data: {data}")
+        
+        try:
+            # Save to Firebase Realtime Database
+            votes_ref = db.reference('votes')
+            votes_ref.set(data['votes'])
+            logging.info(f"Successfully saved {len(data['votes'])} votes to Firebase")
+        except Exception as firebase_error:
+            logging.error(f"Firebase error: {str(firebase_error)}")
+            logging.error(traceback.format_exc())
+            # Continue to save to local file even if Firebase fails
+        
+        # Save to local file as backup
+        try:
+            votes_file_path = os.path.join(os.path.dirname(__file__), 'votes.json')
+            os.makedirs(os.path.dirname(votes_file_path), exist_ok=True)
+            with open(votes_file_path, 'w') as f:
+                json.dump(data, f, indent=2)
+            logging.info(f"Successfully saved votes to local file: {votes_file_path}")
+        except Exception as file_error:
+            logging.error(f"Error saving votes to backup file: {str(file_error)}")
+            logging.error(traceback.format_exc())
+            
+        return jsonify({"success": True, "message": "Votes saved successfully"})
+        
+    except Exception as e:
+        logging.error(f"Error in save_votes endpoint: {str(e)}")
+        logging.error(traceback.format_exc())
+        return jsonify({"error": f"Failed to save votes: {str(e)}"}), 500
+
+class ModelCatalogCache:
+    """Shared TTL cache of ComfyUI's /object_info with a pre-parsed view of the model lists"""
+
+    def __init__(self, api_url, ttl):
+        self.api_url = api_url
+        self.ttl = ttl
+        self.object_info = None
+        self.models = None
+        self.fetched_at = 0
+        self.lock = threading.Lock()
+        # Held while fetching so concurrent callers share one request to ComfyUI
+        self.refresh_lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+
+    def get(self):
+        """Return the cached catalog, fetching it if missing and refreshing it in the background if stale"""
+        with self.lock:
+            catalog = self._snapshot()
+            fresh = catalog is not None and time.time() - self.fetched_at < self.ttl
+            if fresh:
+                self.hits += 1
+            elif catalog is not None:
+                self.stale_hits += 1
+        if fresh:
+            return catalog
+        if catalog is not None:
+            # Serve the stale copy rather than making this request wait on ComfyUI
+            self._refresh_in_background()
+            return catalog
+        return self.refresh()
+
+    def refresh(self, force=False):
+        with self.refresh_lock:
+            # Another caller may have refreshed while we waited for the lock
+            with self.lock:
+                if not force and self.object_info is not None and time.time() - self.fetched_at < self.ttl:
+                    return self._snapshot()
+            try:
+                response = requests.get(f"{self.api_url}/object_info", timeout=30)
+                if response.status_code != 200:
+                    raise Exception(f"Failed to get available models: {response.text}")
+                object_info = response.json()
+            except Exception:
+                with self.lock:
+                    self.refresh_errors += 1
+                raise
+
+            models = self.parse_models(object_info)
+            with self.lock:
+                self.object_info = object_info
+                self.models = models
+                self.fetched_at = time.time()
+                self.refreshes += 1
+                logging.info(f"Refreshed ComfyUI model catalog: {len(models['checkpoints'])} checkpoints, "
+                             f"{len(models['vae'])} VAEs, {len(models['clip'])} CLIP models")
+                return self._snapshot()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'ttl_seconds': self.ttl,
+                'age_seconds': round(time.time() - self.fetched_at, 1) if self.fetched_at else None,
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'refreshes': self.refreshes,
+                'refresh_errors': self.refresh_errors
+            }
+
+    @staticmethod
+    def parse_models(object_info):
+        def required_input(node_type, input_name):
+            values = object_info.get(node_type, {}).get("input", {}).get("required", {}).get(input_name, [])
+            # ComfyUI wraps combo inputs as [[choices...], {options}]
+            if values and isinstance(values[0], list):
+                return values[0]
+            return values
+
+        return {
+            "checkpoints": required_input("CheckpointLoaderSimple", "ckpt_name"),
+            "vae": required_input("VAELoader", "vae_name"),
+            "clip": required_input("CLIPLoader", "clip_name")
+        }
+
+    def _refresh_in_background(self):
+        if self.refresh_lock.locked():
+            return
+        threading.Thread(target=self._background_refresh, name="model-catalog-refresh", daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            logging.warning(f"Background refresh of ComfyUI model catalog failed: {str(e)}")
+
+    def _snapshot(self):
+        if self.object_info is None:
+            return None
+        return {
+            'object_info': self.object_info,
+            'models': self.models,
+            'fetched_at': self.fetched_at
+        }
+
+class ComfyUIUploader:
+    """Uploads image bytes to ComfyUI's input folder under content-addressed names"""
+
+    def __init__(self, api_url, subfolder='codesign', max_entries=256):
+        self.api_url = api_url
+        self.subfolder = subfolder
+        self.max_entries = max_entries
+        # sha256 -> image name as LoadImage expects it, most recently used last
+        self.uploaded = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.uploads = 0
+        self.deduplicated = 0
+
+    def upload(self, data, kind='image', extension='png'):
+        """Upload image bytes unless identical bytes were already uploaded; returns the LoadImage name"""
+        digest = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            name = self.uploaded.get(digest)
+            if name:
+                self.uploaded.move_to_end(digest)
+                self.deduplicated += 1
+                return name
+
+        # The name is derived from the content, so concurrent uploads can never clobber each other
+        filename = f"{kind}_{digest[:32]}.{extension}"
+        response = requests.post(
+            f"{self.api_url}/upload/image",
+            files={'image': (filename, data, f"image/{extension}")},
+            data={'subfolder': self.subfolder, 'type': 'input', 'overwrite': 'true'},
+            timeout=30
+        )
+        if response.status_code != 200:
+            raise Exception(f"ComfyUI image upload failed: {response.text}")
+
+        info = response.json()
+        name = f"{info['subfolder']}/{info['name']}" if info.get('subfolder') else info['name']
+        with self.lock:
+            self.uploaded[digest] = name
+            self.uploads += 1
+            while len(self.uploaded) > self.max_entries:
+                self.uploaded.popitem(last=False)
+        logging.debug(f"Uploaded {kind} to ComfyUI as {name} ({len(data)} bytes)")
+        return name
+
+    def stats(self):
+        with self.lock:
+            return {
+                'uploads': self.uploads,
+                'deduplicated': self.deduplicated,
+                'tracked': len(self.uploaded)
+            }
+
+class ComfyUIEventListener:
+    """Long-lived client on ComfyUI's /ws event stream that keeps per-prompt state in memory"""
+
+    FINISHED_STATUSES = ('completed', 'error')
+
+    def __init__(self, api_url):
+        self.api_url = api_url
+        self.ws_url = api_url.replace('http', 'ws', 1) + '/ws'
+        self.client_id = uuid.uuid4().hex
+        self.prompts = {}
+        self.current_prompt_id = None
+        self.queue_remaining = None
+        self.connected = False
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def start(self):
+        """Start the listener thread once; returns False if websocket-client is missing"""
+        if websocket is None:
+            return False
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name=f"comfyui-events-{self.api_url}", daemon=True)
+                self.thread.start()
+        return True
+
+    def track(self, prompt_id):
+        with self.condition:
+            self._prune_finished()
+            self.prompts.setdefault(prompt_id, self._new_state())
+
+    def get_state(self, prompt_id):
+        with self.condition:
+            state = self.prompts.get(prompt_id)
+            return self._snapshot(state) if state else None
+
+    def wait_for_prompt(self, prompt_id, timeout):
+        """Block until the prompt completes or fails and return its state
+
+        The event stream can miss a prompt's events even while connected
+        (e.g. it finished before the stream subscribed), so ComfyUI's history
+        is checked every COMFYUI_HISTORY_RECONCILE_INTERVAL seconds as well,
+        and every second while the stream is down.
+        """
+        deadline = time.time() + timeout
+        next_reconcile = time.time() + COMFYUI_HISTORY_RECONCILE_INTERVAL
+        while True:
+            with self.condition:
+                state = self.prompts.get(prompt_id)
+                if state and state['status'] in self.FINISHED_STATUSES:
+                    return self._snapshot(state)
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Exception("Timeout waiting for image generation")
+                connected = self.connected
+                if connected and time.time() < next_reconcile:
+                    self.condition.wait(min(remaining, next_reconcile - time.time()))
+                    continue
+            self.refresh_from_history(prompt_id)
+            if connected:
+                next_reconcile = time.time() + COMFYUI_HISTORY_RECONCILE_INTERVAL
+            else:
+                time.sleep(min(1, max(0, deadline - time.time())))
+
+    def refresh_from_history(self, prompt_id):
+        """Fold ComfyUI's /history entry for one prompt into the state table"""
+        try:
+            response = requests.get(f"{self.api_url}/history/{prompt_id}", timeout=10)
+            if response.status_code != 200:
+                return False
+            entry = response.json().get(prompt_id)
+        except Exception as e:
+            logging.warning(f"Error fetching ComfyUI history for {prompt_id}: {str(e)}")
+            return False
+        if not entry:
+            return False
+
+        status = entry.get('status', {})
+        with self.condition:
+            state = self.prompts.setdefault(prompt_id, self._new_state())
+            state['outputs'].update(entry.get('outputs', {}))
+            if status.get('status_str') == 'error':
+                state['status'] = 'error'
+                for message in status.get('messages', []):
+                    if message[0] == 'execution_error':
+                        state['error'] = self._error_details(message[1])
+            elif status.get('completed') or state['outputs']:
+                state['status'] = 'completed'
+            state['updated_at'] = time.time()
+            self.condition.notify_all()
+        return True
+
+    def _run(self):
+        backoff = 1
+        while True:
+            try:
+                ws = websocket.create_connection(f"{self.ws_url}?clientId={self.client_id}", timeout=10)
+            except Exception as e:
+                logging.warning(f"Could not connect to ComfyUI event stream at {self.ws_url}: {str(e)}")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+                continue
+
+            backoff = 1
+            logging.info(f"Connected to ComfyUI event stream as client {self.client_id}")
+            self._set_connected(True)
+            # Events may have been missed while we were disconnected
+            self._reconcile_in_flight()
+            try:
+                ws.settimeout(30)
+                while True:
+                    try:
+                        message = ws.recv()
+                    except websocket.WebSocketTimeoutException:
+                        ws.ping()
+                        continue
+                    # Binary frames carry preview images, which we don't use
+                    if isinstance(message, bytes) or not message:
+                        continue
+                    self._handle_message(json.loads(message))
+            except Exception as e:
+                logging.warning(f"ComfyUI event stream disconnected: {str(e)}")
+            finally:
+                self._set_connected(False)
+                try:
+                    ws.close()
+                except Exception:
+                    pass
+            time.sleep(backoff)
+
+    def _handle_message(self, message):
+        event_type = message.get('type')
+        data = message.get('data') or {}
+
+        if event_type == 'status':
+            self.queue_remaining = data.get('status', {}).get('exec_info', {}).get('queue_remaining')
+            return
+
+        # Older ComfyUI builds omit prompt_id on progress events
+        prompt_id = data.get('prompt_id')
+        if not prompt_id and event_type == 'progress':
+            prompt_id = self.current_prompt_id
+        if not prompt_id:
+            return
+
+        with self.condition:
+            state = self.prompts.setdefault(prompt_id, self._new_state())
+            if event_type == 'execution_start':
+                state['status'] = 'executing'
+                self.current_prompt_id = prompt_id
+            elif event_type == 'executing':
+                if data.get('node') is None:
+                    # A null node marks the end of the prompt
+                    if state['status'] != 'error':
+                        state['status'] = 'completed'
+                    state['node'] = None
+                else:
+                    state['status'] = 'executing'
+                    state['node'] = data['node']
+            elif event_type == 'progress':
+                state['status'] = 'executing'
+                state['progress'] = {'value': data.get('value', 0), 'max': data.get('max', 0)}
+            elif event_type == 'executed':
+                state['outputs'][str(data.get('node'))] = data.get('output') or {}
+            elif event_type == 'execution_success':
+                state['status'] = 'completed'
+            elif event_type in ('execution_error', 'execution_interrupted'):
+                state['status'] = 'error'
+                state['error'] = self._error_details(data)
+            else:
+                return
+            state['updated_at'] = time.time()
+            self.condition.notify_all()
+
+    def _reconcile_in_flight(self):
+        with self.condition:
+            in_flight = [prompt_id for prompt_id, state in self.prompts.items()
+                         if state['status'] not in self.FINISHED_STATUSES]
+        for prompt_id in in_flight:
+            self.refresh_from_history(prompt_id)
+
+    def _set_connected(self, connected):
+        with self.condition:
+            self.connected = connected
+            self.condition.notify_all()
+
+    def _prune_finished(self):
+        cutoff = time.time() - GENERATION_JOB_RETENTION
+        expired = [prompt_id for prompt_id, state in self.prompts.items()
+                   if state['status'] in self.FINISHED_STATUSES and state['updated_at'] < cutoff]
+        for prompt_id in expired:
+            del self.prompts[prompt_id]
+
+    @staticmethod
+    def _new_state():
+        return {
+            'status': 'queued',
+            'node': None,
+            'progress': {'value': 0, 'max': 0},
+            'outputs': {},
+            'error': None,
+            'updated_at': time.time()
+        }
+
+    @staticmethod
+    def _snapshot(state):
+        snapshot = dict(state)
+        snapshot['progress'] = dict(state['progress'])
+        snapshot['outputs'] = dict(state['outputs'])
+        return snapshot
+
+    @staticmethod
+    def _error_details(data):
+        return {
+            'node_id': data.get('node_id'),
+            'node_type': data.get('node_type'),
+            'error_type': data.get('exception_type'),
+            'message': data.get('exception_message', 'Execution interrupted'),
+            'traceback': data.get('traceback', [])
+        }
+
+class ComfyUIBackend:
+    """One ComfyUI instance with its own model catalog, upload cache, event listener and health state"""
+
+    def __init__(self, api_url):
+        self.url = api_url
+        self.catalog = ModelCatalogCache(api_url, COMFYUI_OBJECT_INFO_TTL)
+        self.uploads = ComfyUIUploader(api_url)
+        self.events = ComfyUIEventListener(api_url)
+        # Only the configured local instance shares our filesystem for outputs
+        self.local = api_url == COMFYUI_API_URL.rstrip('/')
+        self.healthy = True
+        self.failures = 0
+        self.successes = 0
+        self.queue_depth = 0
+        self.in_flight = 0
+        self.last_checkpoint = None
+        self.last_probe = None
+        self.last_error = None
+        self.dispatched = 0
+
+    def load(self):
+        """Prompts ahead of a new one; the event stream's count is fresher than the last probe"""
+        queued = self.events.queue_remaining if self.events.connected and self.events.queue_remaining is not None else self.queue_depth
+        return max(queued, self.in_flight)
+
+    def has_checkpoint(self, checkpoint):
+        """True/False from the cached catalog, or None when it has not been fetched yet"""
+        models = self.catalog.models
+        if not checkpoint or not models:
+            return None
+        return checkpoint in models['checkpoints']
+
+    def probe(self):
+        response = requests.get(f"{self.url}/queue", timeout=5)
+        if response.status_code != 200:
+            raise Exception(f"ComfyUI /queue returned {response.status_code}")
+        queue = response.json()
+        return len(queue.get('queue_running', [])) + len(queue.get('queue_pending', []))
+
+    def fetch_output(self, image_info):
+        """Return the bytes of a generated image, from disk when local and over /view otherwise"""
+        if self.local:
+            image_path = os.path.join(COMFYUI_MODELS_PATH, "..", "output", image_info.get('subfolder', ''), image_info['filename'])
+            logging.info(f"Looking for generated image at: {image_path}")
+            if os.path.exists(image_path):
+                with open(image_path, 'rb') as f:
+                    return f.read()
+        response = requests.get(f"{self.url}/view", params={
+            'filename': image_info['filename'],
+            'subfolder': image_info.get('subfolder', ''),
+            'type': image_info.get('type', 'output')
+        }, timeout=30)
+        if response.status_code != 200:
+            raise Exception(f"Failed to fetch {image_info['filename']} from {self.url}: {response.status_code}")
+        return response.content
+
+    def stats(self):
+        return {
+            'url': self.url,
+            'healthy': self.healthy,
+            'queue_depth': self.queue_depth,
+            'in_flight': self.in_flight,
+            'events_connected': self.events.connected,
+            'last_checkpoint': self.last_checkpoint,
+            'consecutive_failures': self.failures,
+            'dispatched': self.dispatched,
+            'last_probe_age_seconds': round(time.time() - self.last_probe, 1) if self.last_probe else None,
+            'last_error': self.last_error
+        }
+
+class ComfyUIBackendPool:
+    """Routes each generation to the least-loaded healthy ComfyUI backend
+
+    A background thread probes every backend's /queue; backends that fail
+    COMFYUI_EJECT_FAILURES times in a row (probes or job requests) stop
+    receiving work until COMFYUI_READMIT_SUCCESSES probes succeed. A backend
+    that last ran the requested checkpoint is preferred while its queue is
+    within COMFYUI_AFFINITY_SLACK of the shortest, to avoid reloading models.
+    """
+
+    def __init__(self, api_urls):
+        self.backends = [ComfyUIBackend(url) for url in api_urls]
+        self.primary = self.backends[0]
+        self.lock = threading.Lock()
+        self.thread = None
+        self.affinity_hits = 0
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._probe_loop, name="comfyui-health", daemon=True)
+                self.thread.start()
+
+    def acquire(self, checkpoint=None):
+        """Pick a backend for one prompt and count it as in flight until release()"""
+        self.start()
+        with self.lock:
+            candidates = [backend for backend in self.backends if backend.healthy]
+            if not candidates:
+                raise Exception("No healthy ComfyUI backends available")
+            # Skip backends whose catalog is known not to list the checkpoint
+            stocked = [backend for backend in candidates if backend.has_checkpoint(checkpoint) is not False]
+            candidates = stocked or candidates
+            least = min(backend.load() for backend in candidates)
+            warm = [backend for backend in candidates
+                    if checkpoint and backend.last_checkpoint == checkpoint
+                    and backend.load() <= least + COMFYUI_AFFINITY_SLACK]
+            if warm:
+                self.affinity_hits += 1
+            backend = min(warm or candidates, key=lambda backend: (backend.load(), backend.dispatched))
+            backend.in_flight += 1
+            backend.dispatched += 1
+            if checkpoint:
+                backend.last_checkpoint = checkpoint
+        logging.info(f"Routing generation to ComfyUI backend {backend.url} (load {backend.load()})")
+        return backend
+
+    def release(self, backend, failed=False, error=None):
+        """Return a backend from acquire(); failed=True counts a network-level failure against it"""
+        with self.lock:
+            backend.in_flight = max(0, backend.in_flight - 1)
+            if failed:
+                self._record_failure(backend, error)
+            else:
+                backend.failures = 0
+
+    def find_prompt(self, prompt_id):
+        """Return (backend, state) for a prompt from whichever backend ran it"""
+        for backend in self.backends:
+            state = backend.events.get_state(prompt_id)
+            if state:
+                return backend, state
+        for backend in self.backends:
+            backend.events.refresh_from_history(prompt_id)
+            state = backend.events.get_state(prompt_id)
+            if state:
+                return backend, state
+        return None, None
+
+    def stats(self):
+        with self.lock:
+            return {
+                'healthy': sum(1 for backend in self.backends if backend.healthy),
+                'affinity_hits': self.affinity_hits,
+                'backends': [backend.stats() for backend in self.backends]
+            }
+
+    def _record_failure(self, backend, error):
+        backend.failures += 1
+        backend.successes = 0
+        backend.last_error = str(error) if error else None
+        if backend.healthy and backend.failures >= COMFYUI_EJECT_FAILURES:
+            backend.healthy = False
+            logging.warning(f"Ejected ComfyUI backend {backend.url} after {backend.failures} failures: {backend.last_error}")
+
+    def probe_all(self):
+        """Probe every backend's /queue once, ejecting and re-admitting backends as needed"""
+        for backend in self.backends:
+            try:
+                depth = backend.probe()
+            except Exception as e:
+                with self.lock:
+                    backend.last_probe = time.time()
+                    self._record_failure(backend, e)
+                continue
+            with self.lock:
+                backend.queue_depth = depth
+                backend.last_probe = time.time()
+                backend.failures = 0
+                backend.successes += 1
+                if not backend.healthy and backend.successes >= COMFYUI_READMIT_SUCCESSES:
+                    backend.healthy = True
+                    logging.info(f"Re-admitted ComfyUI backend {backend.url}")
+            if backend.healthy:
+                backend.events.start()
+
+    def _probe_loop(self):
+        while True:
+            self.probe_all()
+            time.sleep(COMFYUI_HEALTH_INTERVAL)
+
+comfyui_backends = ComfyUIBackendPool(COMFYUI_API_URLS)
+# The primary backend serves the catalog, workflow validation and debug routes
+model_catalog = comfyui_backends.primary.catalog
+comfyui_uploads = comfyui_backends.primary.uploads
+comfyui_events = comfyui_backends.primary.events
+
+def preprocess_images(image_data, mask_data, max_size=1024, output_format=None, crop_to_mask=False):
+    """Decode the image and mask once, fit both to the same size and binarize the mask
+
+    Returns (image_bytes, mask_bytes, file_extension, crop, timings) where timings
+    holds milliseconds spent in each step. With crop_to_mask only the padded
+    bounding box of the mask is kept and crop holds what stitch_inpainted_crop
+    needs to put the result back; otherwise crop is None.
+    """
+    output_format = (output_format or PREPROCESS_FORMAT).lower()
+    timings = {}
+    step_started = time.perf_counter()
+
+    def finish_step(step):
+        nonlocal step_started
+        now = time.perf_counter()
+        timings[step] = round((now - step_started) * 1000, 2)
+        step_started = now
+
+    mask = Image.open(io.BytesIO(mask_data))
+    mask.load()
+    # Opening only reads the header, so the image's pixels are decoded only when needed
+    image = Image.open(io.BytesIO(image_data))
+
+    # The mask is whatever was painted: alpha if the canvas export has it, brightness otherwise
+    if mask.mode in ('RGBA', 'LA') or 'transparency' in mask.info:
+        coverage = mask.convert('RGBA').getchannel('A')
+    else:
+        coverage = mask.convert('L')
+
+    # Crop-and-stitch: keep only the padded bounding box of the painted area
+    crop = None
+    if crop_to_mask:
+        if coverage.size != image.size:
+            coverage = coverage.resize(image.size, Image.BILINEAR)
+        box = mask_crop_box(coverage)
+        if box:
+            image.load()
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            crop = {
+                'image': image,
+                'mask': coverage.point(lambda value: 255 if value > 0 else 0),
+                'box': box
+            }
+            image = image.crop(box)
+            coverage = coverage.crop(box)
+
+    width, height = image.size
+    scale = min(1.0, max_size / max(width, height))
+    target_size = (max(1, int(width * scale)), max(1, int(height * scale)))
+    # A PNG that already fits is sent to ComfyUI as-is instead of being decoded and re-encoded
+    passthrough = (crop is None and image.size == target_size
+                   and image.format == 'PNG' and output_format == 'png')
+    if not passthrough:
+        image.load()
+    finish_step('decode')
+
+    if not passthrough and image.mode != 'RGB':
+        image = image.convert('RGB')
+    finish_step('convert')
+
+    # Scale to fit max_size, and force the mask onto exactly the image's dimensions
+    if not passthrough and image.size != target_size:
+        image = image.resize(target_size, Image.LANCZOS)
+    if coverage.size != target_size:
+        coverage = coverage.resize(target_size, Image.BILINEAR)
+    finish_step('resize')
+
+    # Any painted pixel is inpainted; a 0/255 L-mode mask also compresses far better
+    mask = coverage.point(lambda value: 255 if value > 0 else 0)
+    finish_step('binarize')
+
+    image_output = io.BytesIO()
+    mask_output = io.BytesIO()
+    if output_format == 'webp':
+        image.save(image_output, format='WEBP', lossless=True, method=0)
+        mask.save(mask_output, format='WEBP', lossless=True, method=0)
+        extension = 'webp'
+    else:
+        # Fast zlib level; the PNGs only travel over the local link to ComfyUI
+        if not passthrough:
+            image.save(image_output, format='PNG', compress_level=1)
+        mask.save(mask_output, format='PNG', compress_level=1)
+        extension = 'png'
+    finish_step('encode')
+
+    timings['total'] = round(sum(timings.values()), 2)
+    image_bytes = image_data if passthrough else image_output.getvalue()
+    return image_bytes, mask_output.getvalue(), extension, crop, timings
+
+def mask_crop_box(coverage, padding=None, min_size=None, max_area=None):
+    """Padded bounding box of the painted area as (left, top, right, bottom)
+
+    Small boxes grow around their centre to min_size so the model still sees
+    some context. Returns None for an empty mask or when the box covers more
+    than max_area of the image, where the crop and stitch would cost more than
+    the few pixels they save.
+    """
+    padding = MASK_CROP_PADDING if padding is None else padding
+    min_size = MASK_CROP_MIN_SIZE if min_size is None else min_size
+    max_area = MASK_CROP_MAX_AREA if max_area is None else max_area
+    bbox = coverage.point(lambda value: 255 if value > 0 else 0).getbbox()
+    if not bbox:
+        return None
+
+    def fit_axis(low, high, limit):
+        low, high = low - padding, high + padding
+        if high - low < min_size:
+            grow = min_size - (high - low)
+            low -= grow // 2
+            high += grow - grow // 2
+        # Slide the window back inside the image before clamping
+        if low < 0:
+            high -= low
+            low = 0
+        if high > limit:
+            low -= high - limit
+            high = limit
+        return max(low, 0), high
+
+    width, height = coverage.size
+    left, right = fit_axis(bbox[0], bbox[2], width)
+    top, bottom = fit_axis(bbox[1], bbox[3], height)
+    if (right - left) * (bottom - top) > max_area * width * height:
+        return None
+    return left, top, right, bottom
+
+def stitch_inpainted_crop(crop, generated_bytes):
+    """Composite an inpainted crop back into the full-resolution original and return PNG bytes"""
+    left, top, right, bottom = crop['box']
+    patch = Image.open(io.BytesIO(generated_bytes)).convert('RGB')
+    if patch.size != (right - left, bottom - top):
+        patch = patch.resize((right - left, bottom - top), Image.LANCZOS)
+    # Feather the mask edge so the patch blends into the untouched pixels
+    blend = crop['mask'].crop(crop['box']).filter(ImageFilter.GaussianBlur(MASK_CROP_FEATHER))
+    result = crop['image'].copy()
+    result.paste(patch, (left, top), blend)
+    output = io.BytesIO()
+    result.save(output, format='PNG')
+    return output.getvalue()
+
+# Built-in inpaint graph in API prompt format; per-request values go through its slots
+INPAINT_WORKFLOW = {
+    "225": {
+        "class_type": "CheckpointLoaderSimple",
+        "inputs": {
+            "ckpt_name": DEFAULT_CHECKPOINT
+        }
+    },
+    "241": {
+        "class_type": "CLIPTextEncode",
+        "inputs": {
+            "text": "a high quality image",
+            "clip": ["225", 1]
+        }
+    },
+    "19": {
+        "class_type": "CLIPTextEncode",
+        "inputs": {
+            "text": "blur, text, watermark, CGI, Unreal, Airbrushed, Digital",
+            "clip": ["225", 1]
+        }
+    },
+    "1": {
+        "class_type": "LoadImage",
+        "inputs": {
+            "image": ""
+        }
+    },
+    "2": {
+        "class_type": "LoadImage",
+        "inputs": {
+            "image": ""
+        }
+    },
+    "11": {
+        "class_type": "ImageToMask",
+        "inputs": {
+            "image": ["2", 0],
+            "channel": "red"
+        }
+    },
+    "8": {
+        "class_type": "VAEEncode",
+        "inputs": {
+            "pixels": ["1", 0],
+            "vae": ["225", 2]
+        }
+    },
+    "10": {
+        "class_type": "SetLatentNoiseMask",
+        "inputs": {
+            "samples": ["8", 0],
+            "mask": ["11", 0]
+        }
+    },
+    "12": {
+        # One VAE encode serves every variant; the sampler runs them as one batch
+        "class_type": "RepeatLatentBatch",
+        "inputs": {
+            "samples": ["10", 0],
+            "amount": 1
+        }
+    },
+    "248": {
+        "class_type": "KSampler",
+        "inputs": {
+            "model": ["225", 0],
+            "positive": ["241", 0],
+            "negative": ["19", 0],
+            "latent_image": ["12", 0],
+            "sampler_name": DEFAULT_SAMPLER_SETTINGS["sampler_name"],
+            "scheduler": DEFAULT_SAMPLER_SETTINGS["scheduler"],
+            "seed": 0,
+            "steps": DEFAULT_SAMPLER_SETTINGS["steps"],
+            "cfg": DEFAULT_SAMPLER_SETTINGS["cfg"],
+            "denoise": DEFAULT_SAMPLER_SETTINGS["denoise"]
+        }
+    },
+    "249": {
+        "class_type": "VAEDecode",
+        "inputs": {
+            "samples": ["248", 0],
+            "vae": ["225", 2]
+        }
+    },
+    "9": {
+        "class_type": "SaveImage",
+        "inputs": {
+            "images": ["249", 0],
+            "filename_prefix": "output"
+        }
+    }
+}
+
+INPAINT_WORKFLOW_SLOTS = {
+    "prompt": [("241", "text")],
+    "negative_prompt": [("19", "text")],
+    "checkpoint": [("225", "ckpt_name")],
+    "image": [("1", "image")],
+    "mask": [("2", "image")],
+    "seed": [("248", "seed")],
+    "steps": [("248", "steps")],
+    "cfg": [("248", "cfg")],
+    "denoise": [("248", "denoise")],
+    "variants": [("12", "amount")],
+    "filename_prefix": [("9", "filename_prefix")]
+}
+
+# Slots for Inpaint_Anything.json, as (node id, widget index) since input names
+# are only known once the UI graph is converted against object_info
+INPAINT_ANYTHING_SLOTS = {
+    "prompt": [("137", 0)],
+    "context": [("138", 0)],
+    "negative_prompt": [("19", 0)],
+    "image": [("4", 0)],
+    "reference_image": [("228", 0)],
+    "seed": [("248", 0)],
+    "steps": [("248", 1)]
+}
+
+# ComfyUI input types edited through widgets rather than links
+WIDGET_INPUT_TYPES = ('INT', 'FLOAT', 'STRING', 'BOOLEAN', 'COMBO')
+
+class WorkflowTemplate:
+    """An API-format ComfyUI prompt with named parameter slots that are patched per request"""
+
+    def __init__(self, name, prompt, slots, source=None):
+        self.name = name
+        self.prompt = prompt
+        self.slots = slots
+        self.source = source
+        self.conversion_problems = []
+        self.problems = []
+        self.validated_against = None
+
+    def render(self, **values):
+        """Return a prompt with the slot values applied; the template itself is never modified"""
+        unknown = set(values) - set(self.slots)
+        if unknown:
+            raise ValueError(f"Workflow {self.name} has no slots named {sorted(unknown)}")
+        # Only nodes that receive a value are copied; the rest are shared with the template
+        touched = {node_id for slot in values for node_id, _ in self.slots[slot]}
+        prompt = {
+            node_id: {'class_type': node['class_type'], 'inputs': dict(node['inputs'])} if node_id in touched else node
+            for node_id, node in self.prompt.items()
+        }
+        for slot, value in values.items():
+            for node_id, input_name in self.slots[slot]:
+                prompt[node_id]['inputs'][input_name] = value
+        return prompt
+
+    def validate(self, object_info):
+        """Check node types, required inputs, links and combo choices against object_info"""
+        slot_inputs = {(node_id, input_name) for targets in self.slots.values() for node_id, input_name in targets}
+        problems = list(self.conversion_problems)
+        for node_id, node in self.prompt.items():
+            info = object_info.get(node['class_type'])
+            if not info:
+                problems.append(f"Node {node_id}: unknown node type {node['class_type']}")
+                continue
+            required = info.get('input', {}).get('required', {})
+            optional = info.get('input', {}).get('optional', {})
+            for input_name in required:
+                if input_name not in node['inputs']:
+                    problems.append(f"Node {node_id} ({node['class_type']}): missing required input {input_name}")
+            for input_name, value in node['inputs'].items():
+                spec = required.get(input_name) or optional.get(input_name)
+                if isinstance(value, list):
+                    if str(value[0]) not in self.prompt:
+                        problems.append(f"Node {node_id} ({node['class_type']}): input {input_name} links to missing node {value[0]}")
+                elif (spec and isinstance(spec[0], list) and (node_id, input_name) not in slot_inputs
+                      and value not in spec[0]):
+                    problems.append(f"Node {node_id} ({node['class_type']}): {value!r} is not a valid {input_name}")
+        self.problems = problems
+        return problems
+
+    def describe(self):
+        return {
+            'name': self.name,
+            'source': self.source,
+            'nodes': len(self.prompt),
+            'slots': {slot: [list(target) for target in targets] for slot, targets in self.slots.items()},
+            'problems': self.problems
+        }
+
+class WorkflowRegistry:
+    """Workflow templates compiled once and shared by every request
+
+    UI-format graphs (nodes + links, as saved by the ComfyUI editor) are read
+    from disk once and converted to API prompts the first time they are used,
+    since conversion needs the widget names from ComfyUI's object_info.
+    """
+
+    def __init__(self):
+        self.templates = {}
+        self.ui_graphs = {}
+        self.lock = threading.Lock()
+
+    def register(self, template):
+        with self.lock:
+            self.templates[template.name] = template
+
+    def load_ui_graph(self, name, path, slot_widgets):
+        try:
+            with open(path, 'r') as f:
+                graph = json.load(f)
+        except Exception as e:
+            logging.warning(f"Could not load workflow {name} from {path}: {str(e)}")
+            return
+        with self.lock:
+            self.ui_graphs[name] = {'graph': graph, 'path': path, 'slot_widgets': slot_widgets}
+            self.templates.pop(name, None)
+        logging.info(f"Loaded UI workflow {name} with {len(graph.get('nodes', []))} nodes from {path}")
+
+    def graph(self, name):
+        """The raw UI-format graph, for the debug routes"""
+        entry = self.ui_graphs.get(name)
+        return entry['graph'] if entry else None
+
+    def names(self):
+        with self.lock:
+            return sorted(set(self.templates) | set(self.ui_graphs))
+
+    def get(self, name):
+        """Return the compiled template, converting/validating against the cached object_info as needed"""
+        with self.lock:
+            template = self.templates.get(name)
+            ui_entry = self.ui_graphs.get(name)
+        if template is None and ui_entry is None:
+            raise KeyError(f"Unknown workflow: {name}")
+
+        try:
+            catalog = model_catalog.get()
+        except Exception as e:
+            if template is None:
+                raise Exception(f"Cannot convert workflow {name} without ComfyUI object info: {str(e)}")
+            # Built-in templates work without validation
+            return template
+
+        if template is None:
+            template = self._convert_ui_graph(name, ui_entry, catalog['object_info'])
+            with self.lock:
+                template = self.templates.setdefault(name, template)
+
+        # Revalidate only when the catalog has been refetched
+        if template.validated_against != catalog['fetched_at']:
+            problems = template.validate(catalog['object_info'])
+            template.validated_against = catalog['fetched_at']
+            for problem in problems:
+                logging.warning(f"Workflow {name}: {problem}")
+        return template
+
+    def _convert_ui_graph(self, name, ui_entry, object_info):
+        graph = ui_entry['graph']
+        nodes = {node['id']: node for node in graph.get('nodes', [])}
+        links = {link[0]: link for link in graph.get('links', [])}
+        prompt = {}
+        widget_names = {}
+        problems = []
+
+        def resolve_link(link_id):
+            """Follow reroutes and bypassed nodes back to a real output, or a primitive's value"""
+            link = links.get(link_id)
+            if not link:
+                return None
+            origin = nodes.get(link[1])
+            if not origin or origin.get('mode') == 2:
+                return None
+            if origin['type'] == 'Reroute':
+                return resolve_link(origin['inputs'][0].get('link'))
+            if origin['type'] == 'PrimitiveNode':
+                return ('value', (origin.get('widgets_values') or [None])[0])
+            if origin.get('mode') == 4:
+                # A bypassed node passes through its first input of the same type
+                for node_input in origin.get('inputs', []):
+                    if node_input.get('type') == link[5] and node_input.get('link') is not None:
+                        return resolve_link(node_input['link'])
+                return None
+            return ('link', [str(origin['id']), link[2]])
+
+        for node in graph.get('nodes', []):
+            node_type = node['type']
+            if node.get('mode') in (2, 4) or node_type in ('Reroute', 'PrimitiveNode', 'Note', 'MarkdownNote'):
+                continue
+            if node_type.startswith('workflow>'):
+                problems.append(f"Node {node['id']}: group node {node_type} is not expanded and was skipped")
+                continue
+            info = object_info.get(node_type)
+            if not info:
+                problems.append(f"Node {node['id']}: unknown node type {node_type}")
+                continue
+
+            linked = {node_input['name']: node_input['link'] for node_input in node.get('inputs', [])
+                      if node_input.get('link') is not None}
+            widget_values = node.get('widgets_values') or []
+            if isinstance(widget_values, dict):
+                widget_values = []
+            widget_index = 0
+            names = []
+            inputs = {}
+            input_specs = list(info.get('input', {}).get('required', {}).items())
+            input_specs += list(info.get('input', {}).get('optional', {}).items())
+            for input_name, spec in input_specs:
+                input_type = spec[0]
+                options = spec[1] if len(spec) > 1 and isinstance(spec[1], dict) else {}
+                if isinstance(input_type, list) or input_type in WIDGET_INPUT_TYPES:
+                    names.append(input_name)
+                    value = widget_values[widget_index] if widget_index < len(widget_values) else None
+                    widget_index += 1
+                    # Seed widgets carry an extra control_after_generate value in the UI
+                    if input_type == 'INT' and (options.get('control_after_generate') or input_name in ('seed', 'noise_seed')):
+                        widget_index += 1
+                    if value is not None:
+                        inputs[input_name] = value
+                if input_name in linked:
+                    source = resolve_link(linked[input_name])
+                    if source:
+                        inputs[input_name] = source[1]
+            prompt[str(node['id'])] = {'class_type': node_type, 'inputs': inputs}
+            widget_names[str(node['id'])] = names
+
+        slots = {}
+        for slot, targets in ui_entry['slot_widgets'].items():
+            slots[slot] = []
+            for node_id, widget_index in targets:
+                names = widget_names.get(str(node_id), [])
+                if widget_index < len(names):
+                    slots[slot].append((str(node_id), names[widget_index]))
+                else:
+                    problems.append(f"Slot {slot}: node {node_id} has no widget {widget_index}")
+
+        template = WorkflowTemplate(name, prompt, slots, source=ui_entry['path'])
+        template.conversion_problems = problems
+        logging.info(f"Converted UI workflow {name} to an API prompt with {len(prompt)} nodes")
+        return template
+
+workflow_registry = WorkflowRegistry()
+workflow_registry.register(WorkflowTemplate('inpaint', INPAINT_WORKFLOW, INPAINT_WORKFLOW_SLOTS, source='built-in'))
+workflow_registry.load_ui_graph('inpaint_anything',
+                                os.path.join(os.path.dirname(os.path.abspath(__file__)), "Inpaint_Anything.json"),
+                                INPAINT_ANYTHING_SLOTS)
+
+def upload_generated_image(image_bytes, firebase_filename):
+    """Upload a generated PNG to Firebase Storage and return its public URL"""
+    return run_blocking(_upload_generated_image, image_bytes, firebase_filename)
+
+def _upload_generated_image(image_bytes, firebase_filename):
+    blob = bucket.blob(firebase_filename)
+    blob.upload_from_string(
+        image_bytes,
+        content_type='image/png'
+    )
+    blob.make_public()
+    logging.info(f"Image uploaded to Firebase: {blob.public_url}")
+    return blob.public_url
+
+def process_workflow(image_data, mask_data, prompt='', negative_prompt='', seed=None, variants=1,
+                     crop_to_mask=False, cache_keys=None):
+    try:
+        # Decode, resize and binarize the image and mask in one pass
+        image_data, mask_data, extension, crop, preprocess_timings = run_blocking(
+            preprocess_images, image_data, mask_data, crop_to_mask=crop_to_mask)
+        logging.info(f"Preprocessed image and mask in {preprocess_timings['total']}ms: {preprocess_timings}")
+        if crop:
+            logging.info(f"Inpainting only the masked region {crop['box']} of a {crop['image'].size} image")
         
-        # Get the PDF value
-        pdf_value = buffer.getvalue()
-        buffer.close()
+        # Timestamp used to name the ComfyUI output and Firebase upload
+        timestamp = str(int(time.time() * 1000))
         
-        # Return the PDF
-        return send_file(
-            io.BytesIO(pdf_value),
-            mimetype='application/pdf',
-            as_attachment=True,
-            download_name='consensus_submissions_report.pdf',
-            etag=False,
-            last_modified=None,
-            max_age=None
-        )
+        # Pick the least-loaded healthy ComfyUI instance, preferring one with the checkpoint warm
+        checkpoint_name = DEFAULT_CHECKPOINT
+        backend = comfyui_backends.acquire(checkpoint_name)
+        try:
+            return run_workflow_on_backend(backend, image_data, mask_data, extension, crop, preprocess_timings,
+                                           timestamp, checkpoint_name, prompt, negative_prompt, seed, variants,
+                                           cache_keys)
+        except requests.exceptions.RequestException as e:
+            comfyui_backends.release(backend, failed=True, error=e)
+            backend = None
+            logging.error(f"Network error while communicating with ComfyUI: {str(e)}")
+            raise Exception(f"Failed to communicate with ComfyUI: {str(e)}")
+        finally:
+            if backend is not None:
+                comfyui_backends.release(backend)
         
     except Exception as e:
-        logging.error(f"Error generating report: {str(e)}")
+        logging.error(f"Error in process_workflow: {str(e)}")
         logging.error(traceback.format_exc())
-        return jsonify({"error": str(e)}), 500
+        raise
 
-@app.route('/api/vote-data')
-def get_vote_data():
-    """Endpoint to provide vote data for the report generation."""
+def run_workflow_on_backend(backend, image_data, mask_data, extension, crop, preprocess_timings, timestamp,
+                            checkpoint_name, prompt, negative_prompt, seed, variants, cache_keys):
+    """Upload the inputs to one ComfyUI backend, run the inpaint prompt there and publish the results"""
+    # Hand the image and mask to ComfyUI straight from memory
+    image_name = backend.uploads.upload(image_data, 'image', extension)
+    mask_name = backend.uploads.upload(mask_data, 'mask', extension)
+
+    # Check the checkpoint against this backend's model catalog
     try:
-        # Get votes from Firebase Realtime Database
-        votes_ref = db.reference('votes')
-        votes_data = votes_ref.get()
-        if votes_data is None:
-            votes_data = {"votes": {}}
+        available_checkpoints = backend.catalog.get()['models']['checkpoints']
         
-        return jsonify(votes_data)
+        if not available_checkpoints and backend.local:
+            # If no checkpoints found in API, try to get them from the filesystem
+            checkpoint_dir = os.path.join(COMFYUI_MODELS_PATH, "checkpoints")
+            if os.path.exists(checkpoint_dir):
+                available_checkpoints = [f for f in os.listdir(checkpoint_dir) if f.endswith('.safetensors')]
+                logging.info(f"Found checkpoints in filesystem: {available_checkpoints}")
+        if not available_checkpoints:
+            raise Exception("No checkpoint models found in ComfyUI")
+        if checkpoint_name not in available_checkpoints:
+            logging.warning(f"Checkpoint {checkpoint_name} is not listed by {backend.url}")
+        logging.info(f"Using checkpoint model: {checkpoint_name}")
     except Exception as e:
-        logging.error(f"Error getting vote data from Firebase: {str(e)}")
-        logging.error(traceback.format_exc())
-        
-        # Fallback to local file if Firebase fails
-        try:
-            votes_file_path = os.path.join(os.path.dirname(__file__), 'votes.json')
-            if os.path.exists(votes_file_path):
-                with open(votes_file_path, 'r') as f:
-                    votes_data = json.load(f)
-            else:
-                votes_data = {"votes": {}}
-            
-            return jsonify(votes_data)
-        except Exception as fallback_error:
-            logging.error(f"Error getting vote data from fallback file: {str(fallback_error)}")
-            return jsonify({"votes": {}}), 500
+        logging.error(f"Error getting models: {str(e)}")
+        logging.info(f"Using fallback checkpoint model: {checkpoint_name}")
+    
+    # Patch the per-request values into the pre-built inpaint template
+    workflow = workflow_registry.get('inpaint').render(
+        prompt=prompt if prompt else "a high quality image",
+        negative_prompt=negative_prompt if negative_prompt else "blur, text, watermark, CGI, Unreal, Airbrushed, Digital",
+        checkpoint=checkpoint_name,
+        image=image_name,
+        mask=mask_name,
+        seed=seed if seed is not None else int(time.time()),
+        variants=variants,
+        filename_prefix=f"output_{timestamp}"
+    )
 
-@app.route('/api/save-votes', methods=['POST'])
-def save_votes():
-    """Save votes from the client to Firebase."""
+    # Send the workflow to ComfyUI
+    logging.info(f"Sending inpaint workflow to ComfyUI ({len(workflow)} nodes, {variants} variant(s))")
+    
+    backend.events.start()
+    response = requests.post(f"{backend.url}/prompt", json={
+        "prompt": workflow,
+        # Route execution events for this prompt to our event listener
+        "client_id": backend.events.client_id
+    })
+    if response.status_code != 200:
+        error_msg = f"ComfyUI API error: {response.text}"
+        logging.error(error_msg)
+        raise Exception(error_msg)
+    
+    result = response.json()
+    logging.info(f"ComfyUI response: {result}")
+    
+    # Wait for the image to be generated
+    prompt_id = result.get('prompt_id')
+    if not prompt_id:
+        raise Exception("No prompt ID received from ComfyUI")
+    backend.events.track(prompt_id)
+    
+    # Wait for the event listener to report the prompt as finished
+    state = backend.events.wait_for_prompt(prompt_id, COMFYUI_JOB_TIMEOUT)
+    if state['status'] == 'error':
+        error = state.get('error') or {}
+        raise Exception(f"ComfyUI execution failed: {error.get('message', 'unknown error')}")
+    
+    outputs = state['outputs']
+    if not ('9' in outputs and outputs['9'].get('images')):
+        raise Exception("Workflow completed but no images found")
+    
+    # Read the generated images from ComfyUI's output directory, or over HTTP for remote backends
+    generated = [(image_info['filename'], backend.fetch_output(image_info))
+                 for image_info in outputs['9']['images'][:variants]]
+    if crop:
+        # Put each inpainted crop back into the full-resolution frame
+        generated = [(filename, run_blocking(stitch_inpainted_crop, crop, image_bytes))
+                     for filename, image_bytes in generated]
+    images = [image_bytes for _, image_bytes in generated]
+    
+    # Upload all variants to Firebase Storage at once
     try:
-        data = request.get_json()
-        if not data or 'votes' not in data:
-            logging.error("No vote data provided in request")
-            return jsonify({"error": "No vote data provided"}), 400
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(generated)) as executor:
+            image_urls = list(executor.map(
+                lambda item: upload_generated_image(item[1], f"generated_images/{timestamp}_{item[0]}"),
+                generated
+            ))
         
-        logging.info(f"Received vote data: {data}")
-        
-        try:
-            # Save to Firebase Realtime Database
-            votes_ref = db.reference('votes')
-            votes_ref.set(data['votes'])
-            logging.info(f"Successfully saved {len(data['votes'])} votes to Firebase")
-        except Exception as firebase_error:
-            logging.error(f"Firebase error: {str(firebase_error)}")
-            logging.error(traceback.format_exc())
-            # Continue to save to local file even if Firebase fails
+        for key, image_bytes, image_url in zip(cache_keys or [], images, image_urls):
+            result_cache.put(key, image_bytes, image_url)
         
-        # Save to local file as backup
-        try:
-            votes_file_path = os.path.join(os.path.dirname(__file__), 'votes.json')
-            os.makedirs(os.path.dirname(votes_file_path), exist_ok=True)
-            with open(votes_file_path, 'w') as f:
-                json.dump(data, f, indent=2)
-            logging.info(f"Successfully saved votes to local file: {votes_file_path}")
-        except Exception as file_error:
-            logging.error(f"Error saving votes to backup file: {str(file_error)}")
-            logging.error(traceback.format_exc())
-            
-        return jsonify({"success": True, "message": "Votes saved successfully"})
+        result = {
+            'image_url': image_urls[0],
+            'success': True,
+            'timings': {'preprocess_ms': preprocess_timings}
+        }
+        if variants > 1:
+            result['image_urls'] = image_urls
+        return result
         
     except Exception as e:
-        logging.error(f"Error in save_votes endpoint: {str(e)}")
-        logging.error(traceback.format_exc())
-        return jsonify({"error": f"Failed to save votes: {str(e)}"}), 500
-
-def resize_image_if_needed(image_data, max_size=1024):
-    """Resize image if it exceeds max_size while maintaining aspect ratio"""
-    try:
-        # Convert bytes to PIL Image
-        image = Image.open(io.BytesIO(image_data))
+        logging.error(f"Error uploading to Firebase: {str(e)}")
+        logging.warning("Falling back to direct image return via base64")
         
-        # Get current dimensions
-        width, height = image.size
+        for key, image_bytes in zip(cache_keys or [], images):
+            result_cache.put(key, image_bytes)
         
-        # Calculate scaling factor if image is too large
-        if width > max_size or height > max_size:
-            scale = max_size / max(width, height)
-            new_width = int(width * scale)
-            new_height = int(height * scale)
-            
-            # Resize image
-            image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            
-            # Convert back to bytes
-            output = io.BytesIO()
-            image.save(output, format='PNG')
-            return output.getvalue()
-            
-        return image_data
-    except Exception as e:
-        logging.error(f"Error resizing image: {str(e)}")
-        return image_data
+        # Return the image as base64
+        result = {
+            'image': images[0],
+            'success': True,
+            'firebase_error': str(e),
+            'timings': {'preprocess_ms': preprocess_timings}
+        }
+        if variants > 1:
+            result['images'] = images
+        return result
 
-def process_workflow(image_data, mask_data, prompt='', negative_prompt=''):
-    try:
-        # Resize images if needed
-        image_data = resize_image_if_needed(image_data)
-        mask_data = resize_image_if_needed(mask_data)
-        
-        # Create unique temporary filenames using timestamp
-        timestamp = str(int(time.time() * 1000))
-        base_dir = os.path.dirname(__file__)
-        temp_image_path = os.path.join(base_dir, f"temp_image_{timestamp}.png")
-        temp_mask_path = os.path.join(base_dir, f"temp_mask_{timestamp}.png")
-        output_path = os.path.join(COMFYUI_OUTPUT_PATH, f"output_{timestamp}.png")
-        
-        temp_files = [temp_image_path, temp_mask_path]
+class ResultCache:
+    """On-disk LRU of generated PNGs and their Firebase URLs, keyed by a hash of the request"""
 
-        try:
-            # Save the binary data to temporary files
-            with open(temp_image_path, 'wb') as f:
-                f.write(image_data)
-            with open(temp_mask_path, 'wb') as f:
-                f.write(mask_data)
+    def __init__(self, directory, max_entries):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.index_path = os.path.join(directory, 'index.json')
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._load_index()
+
+    @staticmethod
+    def make_key(image_data, mask_data, prompt, negative_prompt, checkpoint, sampler_settings, seed, variants=1,
+                 crop_to_mask=False):
+        digest = hashlib.sha256()
+        for part in (image_data, mask_data):
+            digest.update(hashlib.sha256(part).digest())
+        settings = {
+            'prompt': prompt,
+            'negative_prompt': negative_prompt,
+            'checkpoint': checkpoint,
+            'sampler': sampler_settings,
+            'seed': seed,
+            'variants': variants,
+            'crop_to_mask': crop_to_mask
+        }
+        digest.update(json.dumps(settings, sort_keys=True).encode('utf-8'))
+        return digest.hexdigest()
+
+    @staticmethod
+    def variant_keys(key, variants):
+        """Per-image keys for a batched request; a single image keeps the base key"""
+        return [key] if variants == 1 else [f"{key}-{index}" for index in range(variants)]
 
-            # First, get available models
+    def get_many(self, keys):
+        """Return cached results for every key, or None if any of them is missing"""
+        results = []
+        for key in keys:
+            cached = self.get(key)
+            if not cached:
+                return None
+            results.append(cached)
+        return results
+
+    def get(self, key):
+        """Return {'image_url', 'image'} for a cached result, or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if not entry:
+                self.misses += 1
+                return None
             try:
-                response = requests.get(f"{COMFYUI_API_URL}/object_info")
-                if response.status_code != 200:
-                    raise Exception(f"Failed to get available models: {response.text}")
-                
-                available_models = response.json()
-                logging.info(f"Available models from API: {available_models}")
-                
-                # Get the first available checkpoint model
-                checkpoint_info = available_models.get("CheckpointLoaderSimple", {})
-                available_checkpoints = checkpoint_info.get("input", {}).get("required", {}).get("ckpt_name", [])
-                
-                if not available_checkpoints:
-                    # If no checkpoints found in API, try to get them from the filesystem
-                    checkpoint_dir = os.path.join(COMFYUI_MODELS_PATH, "checkpoints")
-                    if os.path.exists(checkpoint_dir):
-                        available_checkpoints = [f for f in os.listdir(checkpoint_dir) if f.endswith('.safetensors')]
-                        logging.info(f"Found checkpoints in filesystem: {available_checkpoints}")
-                    else:
-                        raise Exception("No checkpoint models found in ComfyUI")
-                
-                # Use a specific model name that's commonly available
-                checkpoint_name = "juggernautXL_juggXIByRundiffusion.safetensors"
-                logging.info(f"Using checkpoint model: {checkpoint_name}")
-            except Exception as e:
-                logging.error(f"Error getting models: {str(e)}")
-                # Fallback to a default model if available
-                checkpoint_name = "juggernautXL_juggXIByRundiffusion.safetensors"
-                logging.info(f"Using fallback checkpoint model: {checkpoint_name}")
-            
-            # Define the workflow with the available model
-            workflow = {
-                "225": {
-                    "class_type": "CheckpointLoaderSimple",
-                    "inputs": {
-                        "ckpt_name": "juggernautXL_juggXIByRundiffusion.safetensors"
-                    }
-                },
-                "241": {
-                    "class_type": "CLIPTextEncode",
-                    "inputs": {
-                        "text": prompt if prompt else "a high quality image",
-                        "clip": ["225", 1]
-                    }
-                },
-                "19": {
-                    "class_type": "CLIPTextEncode",
-                    "inputs": {
-                        "text": negative_prompt if negative_prompt else "blur, text, watermark, CGI, Unreal, Airbrushed, Digital",
-                        "clip": ["225", 1]
-                    }
-                },
-                "1": {
-                    "class_type": "LoadImage",
-                    "inputs": {
-                        "image": temp_image_path
-                    }
-                },
-                "2": {
-                    "class_type": "LoadImage",
-                    "inputs": {
-                        "image": temp_mask_path
-                    }
-                },
-                "11": {
-                    "class_type": "ImageToMask",
-                    "inputs": {
-                        "image": ["2", 0],
-                        "channel": "red"
-                    }
-                },
-                "8": {
-                    "class_type": "VAEEncode",
-                    "inputs": {
-                        "pixels": ["1", 0],
-                        "vae": ["225", 2]
-                    }
-                },
-                "10": {
-                    "class_type": "SetLatentNoiseMask",
-                    "inputs": {
-                        "samples": ["8", 0],
-                        "mask": ["11", 0]
-                    }
-                },
-                "248": {
-                    "class_type": "KSampler",
-                    "inputs": {
-                        "model": ["225", 0],
-                        "positive": ["241", 0],
-                        "negative": ["19", 0],
-                        "latent_image": ["10", 0],
-                        "sampler_name": "dpmpp_2m",  # Changed from euler to dpmpp_2m for better quality
-                        "scheduler": "karras",  # Changed from normal to karras for better quality
-                        "seed": int(time.time()),
-                        "steps": 30,  # Increased from 20 to 30 for better detail
-                        "cfg": 8.5,  # Increased from 7 to 8.5 for better prompt adherence
-                        "denoise": 0.85  # Reduced from 1 to 0.85 for better preservation of original image context
-                    }
-                },
-                "249": {
-                    "class_type": "VAEDecode",
-                    "inputs": {
-                        "samples": ["248", 0],
-                        "vae": ["225", 2]
+                with open(os.path.join(self.directory, entry['file']), 'rb') as f:
+                    image_bytes = f.read()
+            except OSError:
+                # The PNG was removed behind our back; treat as a miss
+                del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return {'image_url': entry.get('image_url'), 'image': image_bytes}
+
+    def put(self, key, image_bytes, image_url=None):
+        try:
+            with self.lock:
+                os.makedirs(self.directory, exist_ok=True)
+                filename = f"{key}.png"
+                with open(os.path.join(self.directory, filename), 'wb') as f:
+                    f.write(image_bytes)
+                self.entries[key] = {
+                    'file': filename,
+                    'image_url': image_url,
+                    'created_at': time.time()
+                }
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    _, evicted = self.entries.popitem(last=False)
+                    evicted_path = os.path.join(self.directory, evicted['file'])
+                    if os.path.exists(evicted_path):
+                        os.remove(evicted_path)
+                self._save_index()
+        except Exception as e:
+            logging.error(f"Error writing result cache entry: {str(e)}")
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None
+            }
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path, 'r') as f:
+                entries = json.load(f)
+            # The index is written least recently used first
+            for key, entry in entries:
+                self.entries[key] = entry
+            logging.info(f"Loaded {len(self.entries)} cached generation results")
+        except Exception as e:
+            logging.error(f"Error loading result cache index: {str(e)}")
+
+    def _save_index(self):
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(list(self.entries.items()), f)
+        os.replace(temp_path, self.index_path)
+
+result_cache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_ENTRIES)
+
+class GenerationJobQueue:
+    """Bounded worker pool that runs process_workflow off the request threads
+
+    Queued jobs are scheduled fairly rather than first-come first-served:
+    lanes are served in GENERATION_LANES priority order, sessions within a
+    lane take turns, and a session never has more than max_in_flight jobs
+    running, so one user resubmitting cannot starve the rest of the room.
+    """
+
+    def __init__(self, num_workers, max_queue, max_in_flight=1, cancel_superseded=True):
+        self.num_workers = num_workers
+        self.max_queue = max_queue
+        self.max_in_flight = max_in_flight
+        self.cancel_superseded = cancel_superseded
+        # lane -> user key -> job ids in submission order; users rotate to the back once served
+        self.lanes = {lane: collections.OrderedDict() for lane in GENERATION_LANES}
+        self.queued = 0
+        self.running_by_user = collections.Counter()
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.work_available = threading.Condition(self.lock)
+        self.workers = []
+        self.busy_workers = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.cancelled = 0
+        self.wait_times = collections.deque(maxlen=200)
+        self.run_times = collections.deque(maxlen=200)
+        self.lane_wait_times = {lane: collections.deque(maxlen=200) for lane in GENERATION_LANES}
+
+    def start(self):
+        with self.lock:
+            if self.workers:
+                return
+            for index in range(self.num_workers):
+                worker = threading.Thread(target=self._worker_loop,
+                                          name=f"generation-worker-{index}",
+                                          daemon=True)
+                worker.start()
+                self.workers.append(worker)
+        logging.info(f"Started {self.num_workers} generation workers")
+
+    def submit(self, image_data, mask_data, prompt='', negative_prompt='', socket_id=None, binary=False,
+               user_key=None, lane='participant', room=None, supersede=True, **options):
+        """Queue a generation job and return its id without waiting for ComfyUI
+
+        Binary jobs keep result images as raw PNG bytes instead of base64.
+        Finished images are shared with the session room (everyone when None).
+        Jobs are scheduled per user_key (the session id by default) within
+        their lane; the user's older queued jobs are cancelled when
+        superseding is enabled and supersede is set. Raises queue.Full when the queue is at capacity.
+        Extra keyword options are passed through to process_workflow.
+        """
+        if lane not in self.lanes:
+            raise ValueError(f"Unknown generation lane: {lane}")
+        self.start()
+        user_key = user_key or socket_id or 'anonymous'
+        job_id = uuid.uuid4().hex
+        job = {
+            'id': job_id,
+            'status': 'queued',
+            'socket_id': socket_id,
+            'room': room,
+            'user_key': user_key,
+            'lane': lane,
+            'binary': binary,
+            'prompt': prompt,
+            'negative_prompt': negative_prompt,
+            'image_data': image_data,
+            'mask_data': mask_data,
+            'options': options,
+            'submitted_at': time.time(),
+            'started_at': None,
+            'finished_at': None,
+            'result': None,
+            'error': None
+        }
+        with self.lock:
+            self._prune_finished_jobs()
+            superseded = self._cancel_queued(user_key, job_id) if self.cancel_superseded and supersede else []
+            full = self.queued >= self.max_queue
+            if full:
+                self.rejected += 1
+            else:
+                self.jobs[job_id] = job
+                self.lanes[lane].setdefault(user_key, collections.deque()).append(job_id)
+                self.queued += 1
+                self.work_available.notify()
+            depth = self.queued
+        for cancelled in superseded:
+            self._notify_cancelled(cancelled, None if full else job_id)
+        if full:
+            raise queue.Full()
+        logging.info(f"Queued generation job {job_id} in the {lane} lane (queue depth {depth})")
+        return job_id
+
+    def queue_depth(self):
+        with self.lock:
+            return self.queued
+
+    def get_job(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if not job:
+                return None
+            return self._describe_job(job)
+
+    def stats(self):
+        with self.lock:
+            statuses = collections.Counter(job['status'] for job in self.jobs.values())
+            return {
+                'queue_depth': self.queued,
+                'queue_capacity': self.max_queue,
+                'max_in_flight_per_user': self.max_in_flight,
+                'lanes': {
+                    lane: {
+                        'queued': sum(len(job_ids) for job_ids in users.values()),
+                        'users': len(users),
+                        'wait_seconds': _latency_summary(self.lane_wait_times[lane])
                     }
+                    for lane, users in self.lanes.items()
                 },
-                "9": {
-                    "class_type": "SaveImage",
-                    "inputs": {
-                        "images": ["249", 0],
-                        "filename_prefix": f"output_{timestamp}"
-                    }
-                }
+                'workers': self.num_workers,
+                'busy_workers': self.busy_workers,
+                'worker_utilization': round(self.busy_workers / self.num_workers, 2) if self.num_workers else 0,
+                'jobs': dict(statuses),
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'cancelled': self.cancelled,
+                'wait_seconds': _latency_summary(self.wait_times),
+                'run_seconds': _latency_summary(self.run_times)
             }
 
-            # Send the workflow to ComfyUI
-            logging.info("Sending workflow to ComfyUI")
-            logging.debug(f"Workflow configuration: {json.dumps(workflow, indent=2)}")
-            
+    def _worker_loop(self):
+        while True:
+            with self.work_available:
+                job = self._next_job()
+                while job is None:
+                    self.work_available.wait()
+                    job = self._next_job()
+                job['status'] = 'running'
+                job['started_at'] = time.time()
+                image_data = job.pop('image_data')
+                mask_data = job.pop('mask_data')
+                self.running_by_user[job['user_key']] += 1
+                self.busy_workers += 1
             try:
-                response = requests.post(f"{COMFYUI_API_URL}/prompt", json={"prompt": workflow})
-                if response.status_code != 200:
-                    error_msg = f"ComfyUI API error: {response.text}"
-                    logging.error(error_msg)
-                    raise Exception(error_msg)
-                
-                result = response.json()
-                logging.info(f"ComfyUI response: {result}")
-                
-                # Wait for the image to be generated
-                prompt_id = result.get('prompt_id')
-                if not prompt_id:
-                    raise Exception("No prompt ID received from ComfyUI")
-                
-                # Poll for the result
-                max_attempts = 60
-                attempt = 0
-                while attempt < max_attempts:
-                    history_response = requests.get(f"{COMFYUI_API_URL}/history/{prompt_id}")
-                    if history_response.status_code == 200:
-                        history = history_response.json()
-                        if prompt_id in history:
-                            outputs = history[prompt_id].get('outputs', {})
-                            if '9' in outputs and outputs['9'].get('images'):
-                                image_data = outputs['9']['images'][0]
-                                # Update the image path to look in ComfyUI's output directory
-                                comfyui_output_dir = os.path.join(COMFYUI_MODELS_PATH, "..", "output")
-                                image_path = os.path.join(comfyui_output_dir, image_data['filename'])
-                                
-                                logging.info(f"Looking for generated image at: {image_path}")
-                                
-                                # Read the generated image
-                                with open(image_path, 'rb') as f:
-                                    image_bytes = f.read()
-                                
-                                # Upload to Firebase Storage
-                                try:
-                                    # Generate a unique filename
-                                    firebase_filename = f"generated_images/{timestamp}_{image_data['filename']}"
-                                    blob = bucket.blob(firebase_filename)
-                                    
-                                    # Upload the image
-                                    blob.upload_from_string(
-                                        image_bytes,
-                                        content_type='image/png'
-                                    )
-                                    
-                                    # Get the public URL
-                                    blob.make_public()
-                                    image_url = blob.public_url
-                                    
-                                    logging.info(f"Image uploaded to Firebase: {image_url}")
-                                    
-                                    # Clean up temporary files
-                                    for file in temp_files:
-                                        if os.path.exists(file):
-                                            os.remove(file)
-                                    
-                                    return {
-                                        'image_url': image_url,
-                                        'success': True
-                                    }
-                                    
-                                except Exception as e:
-                                    logging.error(f"Error uploading to Firebase: {str(e)}")
-                                    logging.warning("Falling back to direct image return via base64")
-                                    
-                                    # Return the image directly as base64
-                                    # Clean up temporary files first
-                                    for file in temp_files:
-                                        if os.path.exists(file):
-                                            os.remove(file)
-                                    
-                                    # Return the image as base64
-                                    return {
-                                        'image': image_bytes,
-                                        'success': True,
-                                        'firebase_error': str(e)
-                                    }
-                    
-                    time.sleep(1)
-                    attempt += 1
-                    logging.info(f"Waiting for image generation... Attempt {attempt}/{max_attempts}")
-                
-                raise Exception("Timeout waiting for image generation")
-                
-            except requests.exceptions.RequestException as e:
-                logging.error(f"Network error while communicating with ComfyUI: {str(e)}")
-                raise Exception(f"Failed to communicate with ComfyUI: {str(e)}")
-            
-        finally:
-            # Clean up temporary files
-            for file in temp_files:
-                if os.path.exists(file):
-                    os.remove(file)
-        
+                result = process_workflow(image_data, mask_data, job['prompt'], job['negative_prompt'],
+                                          **job['options'])
+                self._finish_job(job, result)
+            except Exception as e:
+                self._fail_job(job, e)
+            finally:
+                with self.work_available:
+                    self.busy_workers -= 1
+                    self.running_by_user[job['user_key']] -= 1
+                    if self.running_by_user[job['user_key']] <= 0:
+                        del self.running_by_user[job['user_key']]
+                    # The user's next job may have been held back by the in-flight cap
+                    self.work_available.notify_all()
+
+    def _next_job(self):
+        """Pop the next runnable job: highest lane first, round-robin across users within a lane"""
+        for lane, users in self.lanes.items():
+            for user_key in list(users):
+                if self.running_by_user[user_key] >= self.max_in_flight:
+                    continue
+                job_ids = users[user_key]
+                job_id = job_ids.popleft()
+                if job_ids:
+                    users.move_to_end(user_key)
+                else:
+                    del users[user_key]
+                self.queued -= 1
+                return self.jobs[job_id]
+        return None
+
+    def _cancel_queued(self, user_key, superseded_by=None):
+        """Drop a user's queued jobs from every lane; call with the lock held"""
+        cancelled = []
+        for users in self.lanes.values():
+            for job_id in users.pop(user_key, ()):
+                job = self.jobs[job_id]
+                job['status'] = 'cancelled'
+                job['finished_at'] = time.time()
+                job['superseded_by'] = superseded_by
+                job.pop('image_data', None)
+                job.pop('mask_data', None)
+                self.queued -= 1
+                self.cancelled += 1
+                cancelled.append(job)
+        return cancelled
+
+    def _notify_cancelled(self, job, superseded_by=None):
+        logging.info(f"Cancelled queued generation job {job['id']}"
+                     + (f" (superseded by {superseded_by})" if superseded_by else ""))
+        if job['socket_id']:
+            socketio.emit('generation_cancelled', {
+                'job_id': job['id'],
+                'superseded_by': superseded_by
+            }, to=job['socket_id'])
+
+    def _finish_job(self, job, result):
+        # Binary jobs keep raw PNG bytes for /api/jobs/<job_id>/image and binary socket
+        # attachments; everything else is kept JSON-friendly for the status endpoint
+        if not job['binary']:
+            if isinstance(result.get('image'), bytes):
+                result['image'] = base64.b64encode(result['image']).decode('utf-8')
+            if result.get('images'):
+                result['images'] = [base64.b64encode(image).decode('utf-8') for image in result['images']]
+        with self.lock:
+            job['status'] = 'completed'
+            job['result'] = result
+            self._record_timings(job)
+            self.completed += 1
+        logging.info(f"Generation job {job['id']} completed in {job['finished_at'] - job['submitted_at']:.1f}s")
+
+        payload = {
+            'job_id': job['id'],
+            'user_id': job['socket_id'],
+            'prompt': job['prompt'],
+            'negative_prompt': job['negative_prompt'],
+            'timestamp': int(time.time() * 1000)
+        }
+        payload.update(result)
+        if result.get('image_url'):
+            # The whole session sees the new image, same as the client-side image_generated relay
+            socketio.emit('image_generated', payload, to=job['room'])
+        elif job['socket_id']:
+            # The inline image fallback is too heavy to broadcast; only the requester gets it
+            # (binary jobs send it as a raw binary attachment rather than base64)
+            socketio.emit('image_generated', payload, to=job['socket_id'])
+
+    def _fail_job(self, job, error):
+        logging.error(f"Generation job {job['id']} failed: {str(error)}")
+        with self.lock:
+            job['status'] = 'failed'
+            job['error'] = str(error)
+            self._record_timings(job)
+            self.failed += 1
+        if job['socket_id']:
+            socketio.emit('generation_failed', {
+                'job_id': job['id'],
+                'error': str(error)
+            }, to=job['socket_id'])
+
+    def _record_timings(self, job):
+        job['finished_at'] = time.time()
+        self.wait_times.append(job['started_at'] - job['submitted_at'])
+        self.lane_wait_times[job['lane']].append(job['started_at'] - job['submitted_at'])
+        self.run_times.append(job['finished_at'] - job['started_at'])
+
+    def _prune_finished_jobs(self):
+        cutoff = time.time() - GENERATION_JOB_RETENTION
+        expired = [job_id for job_id, job in self.jobs.items()
+                   if job['finished_at'] and job['finished_at'] < cutoff]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+    def get_job_image(self, job_id, index=0):
+        """Return the raw PNG bytes of a finished job's image, or None"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            result = job['result'] if job else None
+        if not result:
+            return None
+        images = result.get('images') or ([result['image']] if result.get('image') else [])
+        if not 0 <= index < len(images):
+            return None
+        image = images[index]
+        return image if isinstance(image, bytes) else base64.b64decode(image)
+
+    def _describe_job(self, job):
+        result = job['result']
+        if result and job['binary'] and isinstance(result.get('image'), bytes):
+            # Point at the raw image endpoint instead of inlining bytes
+            result = {key: value for key, value in result.items() if key not in ('image', 'images')}
+            count = len(job['result'].get('images') or [None])
+            result['image_path'] = f"/api/jobs/{job['id']}/image"
+            if count > 1:
+                result['image_paths'] = [f"/api/jobs/{job['id']}/image?index={index}" for index in range(count)]
+        description = {
+            'job_id': job['id'],
+            'status': job['status'],
+            'lane': job['lane'],
+            'submitted_at': job['submitted_at'],
+            'started_at': job['started_at'],
+            'finished_at': job['finished_at'],
+            'result': result,
+            'error': job['error']
+        }
+        if job['started_at']:
+            description['wait_seconds'] = round(job['started_at'] - job['submitted_at'], 3)
+        if job.get('superseded_by'):
+            description['superseded_by'] = job['superseded_by']
+        if job['started_at'] and job['finished_at']:
+            description['run_seconds'] = round(job['finished_at'] - job['started_at'], 3)
+        return description
+
+def _latency_summary(samples):
+    """Summarize recent latency samples (seconds) as count/p50/p95/max"""
+    if not samples:
+        return {'count': 0, 'p50': None, 'p95': None, 'max': None}
+    ordered = sorted(samples)
+    def pick(fraction):
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))], 3)
+    return {
+        'count': len(ordered),
+        'p50': pick(0.5),
+        'p95': pick(0.95),
+        'max': round(ordered[-1], 3)
+    }
+
+generation_queue = GenerationJobQueue(GENERATION_WORKERS, GENERATION_QUEUE_MAX,
+                                      GENERATION_MAX_IN_FLIGHT_PER_USER, GENERATION_CANCEL_SUPERSEDED)
+
+def cached_result_response(cached, prompt, negative_prompt, socket_id, room, binary_keys=None):
+    """Build the /api/process result for a cache hit and share it like a finished job
+
+    With binary_keys (binary requests), inline images are linked by path,
+    as binary jobs do, instead of being sent as base64.
+    """
+    image_urls = [entry['image_url'] for entry in cached]
+    if all(image_urls):
+        result = {'image_url': image_urls[0], 'success': True}
+        if len(cached) > 1:
+            result['image_urls'] = image_urls
+        socketio.emit('image_generated', dict(result,
+            job_id=None,
+            user_id=socket_id,
+            prompt=prompt,
+            negative_prompt=negative_prompt,
+            cached=True,
+            timestamp=int(time.time() * 1000)
+        ), to=room, skip_sid=socket_id)
+        return result
+    if binary_keys:
+        paths = [f"/api/result-cache/{key}" for key in binary_keys]
+        result = {'image_path': paths[0], 'success': True}
+        if len(paths) > 1:
+            result['image_paths'] = paths
+        return result
+    images = [base64.b64encode(entry['image']).decode('utf-8') for entry in cached]
+    result = {'image': images[0], 'success': True}
+    if len(cached) > 1:
+        result['images'] = images
+    return result
+
+@app.route('/api/result-cache/<key>')
+def get_cached_result_image(key):
+    """Raw PNG of a cached result, linked from binary cache hits"""
+    try:
+        cached = result_cache.get(key)
+        if not cached:
+            return jsonify({"error": f"No cached image {key}"}), 404
+        return Response(cached['image'], mimetype='image/png')
     except Exception as e:
-        logging.error(f"Error in process_workflow: {str(e)}")
-        logging.error(traceback.format_exc())
-        raise
+        logging.error(f"Error getting cached image {key}: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/jobs/<job_id>')
+def get_generation_job(job_id):
+    try:
+        job = generation_queue.get_job(job_id)
+        if not job:
+            return jsonify({"error": f"Job {job_id} not found"}), 404
+        return jsonify(job)
+    except Exception as e:
+        logging.error(f"Error getting job {job_id}: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/jobs/<job_id>/image')
+def get_generation_job_image(job_id):
+    try:
+        try:
+            index = int(request.args.get('index', 0))
+        except ValueError:
+            return jsonify({"error": "index must be a whole number"}), 400
+        image_bytes = generation_queue.get_job_image(job_id, index)
+        if image_bytes is None:
+            return jsonify({"error": f"No image for job {job_id}"}), 404
+        return Response(image_bytes, mimetype='image/png')
+    except Exception as e:
+        logging.error(f"Error getting image for job {job_id}: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/queue-status')
+def get_queue_status():
+    try:
+        status = generation_queue.stats()
+        status['uploads'] = comfyui_uploads.stats()
+        status['backends'] = comfyui_backends.stats()
+        status['result_cache'] = result_cache.stats()
+        status['submission_writes'] = dict(submission_writer.stats, queued=submission_writer.queue.qsize())
+        return jsonify(status)
+    except Exception as e:
+        logging.error(f"Error getting queue status: {str(e)}")
+        return jsonify({"error": str(e)}), 500
 
 @app.route('/api/connected-users')
 def get_connected_users():
     try:
+        # ?session= narrows the list to one session's room
+        room = request.args.get('session')
+        users = session_users(session_code(room)) if room else connected_users
         users_info = []
-        for user_id, user_data in connected_users.items():
+        for user_id, user_data in users.items():
             users_info.append({
                 'id': user_id,
                 'color': user_data['color'],
                 'brush_size': user_data['brush_size'],
-                'connected_at': user_data['connected_at']
+                'connected_at': user_data['connected_at'],
+                'session': user_data.get('room')
             })
         return jsonify({
-            'total_users': len(connected_users),
+            'total_users': len(users),
+            'sessions': connected_users.sessions(),
             'users': users_info
         })
     except Exception as e:
@@ -1808,7 +5411,7 @@ def api_analyze_submissions():
     """API endpoint to get AI analysis of submissions"""
     try:
         # Get all submissions
-        submissions = load_submissions_from_csv()
+        submissions = load_submissions()
         
         # If no submissions, create sample data for testing
         if not submissions:
@@ -2323,21 +5926,52 @@ def generate_cluster_report():
         return jsonify({"error": str(e)}), 500
 
 @socketio.on('get_submissions')
-def handle_get_submissions():
+def handle_get_submissions(data=None):
+    """Send the requesting client a page of submissions
+
+    data may carry `since` (the sync_token from an earlier sync, so only
+    newer submissions are sent), `cursor` (the next_cursor of the previous
+    page) and `limit`. The reply has `next_cursor` while more pages remain,
+    and, on the last page, the `sync_token` to pass as `since` next time.
+    `total` counts the submissions after the position; `reset` tells the
+    client its token was stale and the count starts from scratch. With
+    limit 0 only the count and token are sent.
+    """
     try:
-        # Load submissions from CSV
-        submissions = load_submissions_from_csv()
-        logger.info(f"Sending {len(submissions)} submissions to client")
+        data = data or {}
+        limit = max(0, min(int(data.get('limit', SUBMISSIONS_SYNC_PAGE)), SUBMISSIONS_PAGE_MAX))
+        if submission_store is None:
+            submissions = load_submissions_from_csv()
+            logger.info(f"Sending {len(submissions) if limit else 0} submissions to client")
+            emit('submissions_list', {'submissions': submissions if limit else [], 'total': len(submissions),
+                                      'next_cursor': None, 'sync_token': None, 'reset': True})
+            return
+        
+        # Cursors and sync tokens are both "<generation>.<last id>"; a missing or stale one means start over
+        position = data.get('cursor') or data.get('since')
+        after_id = submission_store.parse_sync_token(position) if position else None
+        reset = after_id is None
+        
+        # Take the token first so a submission saved meanwhile is sent again rather than missed
+        token = submission_store.sync_token()
+        submissions, total = submission_store.query(limit=limit, after_id=after_id or 0)
+        more = limit > 0 and total > len(submissions)
+        logger.info(f"Sending {len(submissions)} of {total} new submissions to client")
         
         # Send submissions to the requesting client
         emit('submissions_list', {
-            'submissions': submissions
+            'submissions': submissions,
+            'next_cursor': submission_store.sync_token(submissions[-1]['id']) if more else None,
+            'sync_token': None if more else token,
+            'total': total,
+            'reset': reset
         })
     except Exception as e:
         logger.error(f"Error handling get_submissions request: {str(e)}")
         logger.error(traceback.format_exc())
         emit('submissions_list', {
-            'submissions': []
+            'submissions': [],
+            'error': str(e)
         })
 
 if __name__ == '__main__':
@@ -0,0 +1,142 @@
+"""Benchmark for preprocess_images, the step that runs before every ComfyUI upload
+
+Builds a synthetic canvas export (a noisy gradient photo plus an RGBA stroke
+layer) at each size and times, on the same inputs:
+
+- baseline: the resize_image_if_needed the server used before, copied below.
+  It decodes each file separately and, when a side is over 1024px,
+  LANCZOS-resizes it and re-encodes it as a default-compression PNG. It ran
+  once for the image and once for the mask, and left the RGBA mask as it was.
+- png / webp: preprocess_images with each output format.
+- png+crop: preprocess_images with crop_to_mask.
+
+    python bench_preprocess.py
+    python bench_preprocess.py --sizes 800x600 1600x1200 --runs 9
+
+The "strokes" mask is a patch of strokes in the upper-left part of the
+frame. The "full" mask crosses the whole canvas corner to corner, so its
+crop box covers more than MASK_CROP_MAX_AREA of the frame and cropping is
+skipped. Each row reports the median time and the bytes uploaded.
+"""
+import argparse
+import io
+import json
+import logging
+import statistics
+import sys
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+import app
+
+def resize_image_if_needed(image_data, max_size=1024):
+    """Resize image if it exceeds max_size while maintaining aspect ratio"""
+    try:
+        # Convert bytes to PIL Image
+        image = Image.open(io.BytesIO(image_data))
+
+        # Get current dimensions
+        width, height = image.size
+
+        # Calculate scaling factor if image is too large
+        if width > max_size or height > max_size:
+            scale = max_size / max(width, height)
+            new_width = int(width * scale)
+            new_height = int(height * scale)
+
+            # Resize image
+            image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+
+            # Convert back to bytes
+            output = io.BytesIO()
+            image.save(output, format='PNG')
+            return output.getvalue()
+
+        return image_data
+    except Exception as e:
+        logging.error(f"Error resizing image: {str(e)}")
+        return image_data
+
+def baseline(image_data, mask_data):
+    return resize_image_if_needed(image_data), resize_image_if_needed(mask_data)
+
+def synthetic_photo(width, height):
+    rng = np.random.default_rng(0)
+    gradient = np.linspace(0, 255, width * height * 3).reshape(height, width, 3)
+    pixels = (gradient * 0.6 + rng.integers(0, 100, (height, width, 3))).clip(0, 255).astype(np.uint8)
+    return Image.fromarray(pixels).filter(ImageFilter.GaussianBlur(1))
+
+def synthetic_mask(width, height, shape):
+    """Stroke layer as script.js exports it: translucent user colour on a transparent canvas"""
+    mask = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(mask)
+    colour = (0, 0, 255, 26)
+    if shape == 'full':
+        draw.line([(5, 5), (width - 5, height - 5)], fill=colour, width=30)
+        draw.line([(width - 5, 5), (5, height - 5)], fill=colour, width=30)
+    else:
+        for i in range(12):
+            draw.line([(width * (0.1 + i * 0.01), height * 0.2), (width * (0.2 + i * 0.01), height * 0.45)],
+                      fill=colour, width=30)
+    return mask
+
+def png_bytes(image):
+    output = io.BytesIO()
+    image.save(output, format='PNG')
+    return output.getvalue()
+
+def median_ms(fn, runs):
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - started) * 1000)
+    return round(statistics.median(timings), 1)
+
+def benchmark(width, height, runs):
+    image_data = png_bytes(synthetic_photo(width, height))
+    cases = {
+        'baseline': baseline,
+        'png': lambda image, mask: app.preprocess_images(image, mask, output_format='png'),
+        'webp': lambda image, mask: app.preprocess_images(image, mask, output_format='webp'),
+        'png+crop': lambda image, mask: app.preprocess_images(image, mask, output_format='png',
+                                                              crop_to_mask=True)
+    }
+    results = []
+    for shape in ('strokes', 'full'):
+        mask_data = png_bytes(synthetic_mask(width, height, shape))
+        for case, fn in cases.items():
+            outputs = fn(image_data, mask_data)
+            results.append({
+                'size': f"{width}x{height}",
+                'mask': shape,
+                'case': case,
+                'crop_box': outputs[3]['box'] if case == 'png+crop' and outputs[3] else None,
+                'upload_bytes': len(outputs[0]) + len(outputs[1]),
+                'median_ms': median_ms(lambda: fn(image_data, mask_data), runs)
+            })
+    return results
+
+def parse_size(value):
+    try:
+        width, height = (int(part) for part in value.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected WIDTHxHEIGHT, got {value!r}")
+    return width, height
+
+def main():
+    parser = argparse.ArgumentParser(description="Time preprocess_images against the old per-file resize")
+    parser.add_argument('--sizes', nargs='+', type=parse_size, default=[(800, 600), (1600, 1200)])
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    results = []
+    for width, height in args.sizes:
+        results.extend(benchmark(width, height, args.runs))
+    print(json.dumps(results, indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,187 @@
+"""Load test for the realtime drawing server.
+
+Opens N headless Socket.IO clients in one session. Each client draws at a
+fixed rate, sending binary brush segments the same way script.js does. The
+test reports how long a segment takes to reach the other clients in
+brush_frame broadcasts, with p50/p99 over every sender/receiver pair:
+
+    python serve.py &
+    python loadtest.py --url http://127.0.0.1:3000 --clients 50 --rate 60 --duration 20
+
+Each segment's end x is its sequence number on a 65535-wide canvas, which
+the wire format carries exactly. That lets a receiver match every point in
+a frame back to the moment it was sent.
+"""
+import argparse
+import collections
+import json
+import statistics
+import struct
+import sys
+import threading
+import time
+import uuid
+
+import socketio
+
+# Mirrors the binary drawing wire format in app.py
+DRAWING_WIRE_VERSION = 1
+WIRE_SEGMENT = 1
+WIRE_STROKE_FRAME = 2
+WIRE_HEADER = struct.Struct('<BB')
+WIRE_SEGMENT_BODY = struct.Struct('<BHHH4H')
+WIRE_STROKE_HEADER = struct.Struct('<BBHHHH')
+CANVAS_SIZE = 65535
+
+def encode_segment(seq, row, brush_size=5):
+    return WIRE_HEADER.pack(DRAWING_WIRE_VERSION, WIRE_SEGMENT) + WIRE_SEGMENT_BODY.pack(
+        0, brush_size * 4, CANVAS_SIZE, CANVAS_SIZE, seq, row, seq - 1, row)
+
+def frame_points(data):
+    """(sender, end x) for every segment carried by a brush_frame; sender is a user index or a sid"""
+    if isinstance(data, dict):
+        # JSON frames (BINARY_DRAWING_EVENTS=0) name the sender by sid
+        for stroke in data.get('strokes', []):
+            for x in stroke['points'][2::2]:
+                yield stroke['user_id'], int(round(x))
+        return
+    version, event_type = WIRE_HEADER.unpack_from(data, 0)
+    if version != DRAWING_WIRE_VERSION or event_type != WIRE_STROKE_FRAME:
+        return
+    offset = WIRE_HEADER.size
+    (count,) = struct.unpack_from('<H', data, offset)
+    offset += 2
+    for _ in range(count):
+        user_index, _, _, _, _, point_count = WIRE_STROKE_HEADER.unpack_from(data, offset)
+        offset += WIRE_STROKE_HEADER.size
+        values = struct.unpack_from(f'<{point_count * 2}H', data, offset)
+        offset += point_count * 4
+        # The first point of each stroke is the previous segment's end, already counted
+        for x in values[2::2]:
+            yield user_index, x
+
+class LoadTest:
+    def __init__(self, url, clients, rate, duration, session, transport):
+        self.url = url
+        self.client_count = clients
+        self.rate = rate
+        self.duration = duration
+        self.session = session or f"loadtest-{uuid.uuid4().hex[:8]}"
+        self.transport = transport
+        self.clients = []
+        self.sent_at = {}  # (sid, seq) -> send time
+        self.sid_by_index = {}
+        self.latencies = []
+        self.received = collections.Counter()
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def connect(self):
+        for _ in range(self.client_count):
+            client = socketio.Client(reconnection=False)
+            client.on('brush_frame', self._frame_handler(client))
+            client.on('users_list', self._on_users_list)
+            client.connect(f"{self.url}?session={self.session}", transports=[self.transport])
+            self.clients.append(client)
+        # Let the last users_list arrive so every user index maps to a sid
+        deadline = time.time() + 10
+        while len(self.sid_by_index) < self.client_count and time.time() < deadline:
+            time.sleep(0.05)
+
+    def _on_users_list(self, data):
+        with self.lock:
+            for user in data.get('users', []):
+                if user.get('index') is not None:
+                    self.sid_by_index[user['index']] = user['id']
+
+    def _frame_handler(self, client):
+        def on_frame(data):
+            now = time.perf_counter()
+            own_sid = client.get_sid()
+            with self.lock:
+                for sender, seq in frame_points(data):
+                    sid = sender if isinstance(sender, str) else self.sid_by_index.get(sender)
+                    if sid == own_sid:
+                        # Frames go to the whole room; clients ignore their own strokes
+                        continue
+                    sent = self.sent_at.get((sid, seq))
+                    if sent is None:
+                        self.errors += 1
+                        continue
+                    self.latencies.append((now - sent) * 1000)
+                    self.received[own_sid] += 1
+        return on_frame
+
+    def _draw(self, client, row):
+        interval = 1.0 / self.rate
+        next_send = time.perf_counter()
+        end = next_send + self.duration
+        seq = 1
+        while next_send < end and seq < CANVAS_SIZE:
+            with self.lock:
+                self.sent_at[(client.get_sid(), seq)] = time.perf_counter()
+            client.emit('brush_stroke', encode_segment(seq, row))
+            seq += 1
+            next_send += interval
+            time.sleep(max(0, next_send - time.perf_counter()))
+        return seq - 1
+
+    def run(self):
+        self.connect()
+        sent = [0] * len(self.clients)
+
+        def draw(i):
+            sent[i] = self._draw(self.clients[i], (i * 97) % CANVAS_SIZE)
+
+        threads = [threading.Thread(target=draw, args=(i,), daemon=True) for i in range(len(self.clients))]
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Allow the last frames to drain
+        time.sleep(1)
+        elapsed = time.time() - started
+        for client in self.clients:
+            client.disconnect()
+        return self.report(sum(sent), elapsed)
+
+    def report(self, sent, elapsed):
+        expected = sent * (self.client_count - 1)
+        latencies = sorted(self.latencies)
+        result = {
+            'clients': self.client_count,
+            'rate_hz': self.rate,
+            'duration_s': round(elapsed, 1),
+            'segments_sent': sent,
+            'deliveries_expected': expected,
+            'deliveries_received': len(latencies),
+            'delivery_ratio': round(len(latencies) / expected, 4) if expected else None,
+            'unmatched_points': self.errors
+        }
+        if latencies:
+            result.update({
+                'p50_ms': round(statistics.median(latencies), 1),
+                'p99_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))], 1),
+                'max_ms': round(latencies[-1], 1)
+            })
+        return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure brush stroke broadcast latency with N headless clients")
+    parser.add_argument('--url', default='http://127.0.0.1:3000')
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--rate', type=float, default=60, help="brush segments per second per client")
+    parser.add_argument('--duration', type=float, default=10, help="seconds of drawing")
+    parser.add_argument('--session', help="session code to draw in (default: a fresh one)")
+    parser.add_argument('--transport', choices=['websocket', 'polling'], default='websocket')
+    args = parser.parse_args()
+    if args.clients < 2:
+        parser.error("need at least 2 clients to measure broadcasts")
+
+    result = LoadTest(args.url, args.clients, args.rate, args.duration, args.session, args.transport).run()
+    print(json.dumps(result, indent=2))
+    return 0 if result['deliveries_received'] else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
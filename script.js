@@ -57,6 +57,7 @@ let mouseX = null; // Track mouse X position globally
 let mouseY = null; // Track mouse Y position globally
 let socket;
 let userId = null; // Initialize userId globally
+let socketToken = null; // Issued by the server on connect; proves HTTP requests come from this socket
 let userColor;
 const connectedUsers = new Map();
 
@@ -68,6 +69,10 @@ let generatedImageUrl;
 let submissionsModal;
 let submissionsMarkers = [];
 let submissionClusters = {}; // Object to store submission clusters by location
+let serverClusters = []; // Clusters of server submissions computed by /api/submissions?zoom= for the current view
+let serverClusterMarkers = [];
+let serverClusterRequest = 0; // Lets a slower response for an old viewport be ignored
+let submissionsSyncToken = null; // Newest submission this client has seen; passed as `since` on reconnect
 let submissionVotes = {}; // Object to store votes for submissions
 
 // Add these global variables at the top
@@ -97,6 +102,9 @@ const userColors = {
 };
 let currentUserColor = userColors.self;
 let connectedUserColors = new Map(); // Map to track other users' colors
+const userIdsByIndex = new Map(); // Small user index from binary drawing events -> socket id
+let presenceVersion = null; // Version of the last presence snapshot or delta applied
+let presenceResyncPending = false;
 
 // Add this near the top with other global variables
 const userDrawingBubbles = new Map();
@@ -353,41 +361,11 @@ function loadSubmissions() {
             }
         }
         
-        // If connected to server, request server submissions
-        if (socket && socket.connected) {
-            console.log('Requesting submissions from server');
-            socket.emit('get_submissions');
-            
-            // Listen for submissions from server (one-time listener)
-            socket.once('submissions_list', (data) => {
-                console.log('Received submissions from server:', data.submissions.length);
-                
-                // Clear existing markers for refresh
-                submissionsMarkers.forEach(marker => marker.setMap(null));
-                submissionsMarkers = [];
-                
-                // Group server submissions by location
-                data.submissions.forEach(submission => {
-                    // Check if we already have this submission locally (avoid duplicates)
-                    const isDuplicate = localSubmissions.some(
-                        local => local.imageUrl === submission.imageUrl && 
-                               local.submittedAt === submission.submittedAt
-                    );
-                    
-                    if (!isDuplicate) {
-                        groupSubmissionByLocation(submission);
-                    }
-                });
-                
-                // Create cluster markers after all submissions are processed
-                createClusterMarkers();
-                
-                // Update heatmap with new data
-                if (window.submissionsHeatmap) {
-                    updateHeatmapData();
-                }
-            });
+        // Server submissions arrive as clusters for the visible part of the map, reloaded whenever it stops moving
+        if (submissionsMap && !submissionsMap.serverClustersListener) {
+            submissionsMap.serverClustersListener = submissionsMap.addListener('idle', loadServerClusters);
         }
+        loadServerClusters();
     } catch (error) {
         console.error('Error loading submissions:', error);
         
@@ -443,6 +421,54 @@ function groupSubmissionByLocation(submission) {
     submissionClusters[locationKey].submissions.push(submission);
 }
 
+// Fetch server-side clusters for the map's current viewport and zoom
+function loadServerClusters() {
+    if (!submissionsMap || !submissionsMap.getBounds()) {
+        return;
+    }
+    const bounds = submissionsMap.getBounds();
+    const southWest = bounds.getSouthWest();
+    const northEast = bounds.getNorthEast();
+    const bbox = [southWest.lat(), southWest.lng(), northEast.lat(), northEast.lng()]
+        .map(value => value.toFixed(6)).join(',');
+    const request = ++serverClusterRequest;
+    fetch(`/api/submissions?bbox=${bbox}&zoom=${submissionsMap.getZoom()}`)
+        .then(response => response.json())
+        .then(data => {
+            if (request !== serverClusterRequest || data.error) {
+                return;
+            }
+            console.log(`Received ${data.clusters.length} clusters covering ${data.total} submissions`);
+            serverClusterMarkers.forEach(marker => marker.setMap(null));
+            serverClusters = data.clusters.map(cluster => ({
+                location: { lat: cluster.lat, lng: cluster.lng },
+                count: cluster.count,
+                bounds: cluster.bounds,
+                submissions: []  // Fetched when the cluster is opened
+            }));
+            serverClusterMarkers = serverClusters.map((cluster, index) => createClusterMarker(cluster, index, false));
+            if (window.submissionsHeatmap) {
+                updateHeatmapData();
+            }
+        })
+        .catch(error => console.error('Error loading submission clusters:', error));
+}
+
+// Load a server cluster's submissions (they are bounded by the cluster's extent) before showing it
+function openServerCluster(cluster, marker) {
+    if (cluster.submissions.length || !cluster.bounds) {
+        showClusterSubmissions(cluster, marker);
+        return;
+    }
+    fetch(`/api/submissions?bbox=${cluster.bounds.join(',')}&limit=500`)
+        .then(response => response.json())
+        .then(data => {
+            cluster.submissions = data.submissions || [];
+            showClusterSubmissions(cluster, marker);
+        })
+        .catch(error => console.error('Error loading cluster submissions:', error));
+}
+
 // Function to create markers for clusters
 function createClusterMarkers() {
     if (!submissionsMap) {
@@ -452,94 +478,99 @@ function createClusterMarkers() {
     
     console.log('Creating cluster markers for', Object.keys(submissionClusters).length, 'clusters');
     
+    // Process each cluster
+    Object.values(submissionClusters).forEach((cluster, index) => {
+        submissionsMarkers.push(createClusterMarker(cluster, index));
+        console.log('Added cluster marker to submissionsMarkers array, new length:', submissionsMarkers.length);
+    });
+}
+
+// Create one animated cluster marker; server clusters carry a count and load their submissions on click
+function createClusterMarker(cluster, index, bounce = true) {
     // Array of vibrant colors for markers
     const markerColors = ['#FF5733', '#33FF57', '#3357FF', '#FF33F5', '#F5FF33', '#33FFF5', '#FF3333'];
     
-    // Process each cluster
-    Object.values(submissionClusters).forEach((cluster, index) => {
-        const position = new google.maps.LatLng(
-            cluster.location.lat,
-            cluster.location.lng
-        );
-        
-        // Determine cluster size for visual representation
-        const submissionCount = cluster.submissions.length;
-        const size = Math.min(150, Math.max(80, 60 + (submissionCount * 10))); // Even bigger size between 80-150px
-        
-        // Get color based on index (cycle through colors)
-        const color = markerColors[index % markerColors.length];
-        
-        console.log('Creating cluster for', submissionCount, 'submissions at', position.toString(), 'with size', size);
-        
-        // Create a custom animated marker for the cluster
-        const marker = new google.maps.Marker({
-            position: position,
-            map: submissionsMap,
-            title: `${submissionCount} submission${submissionCount !== 1 ? 's' : ''}`,
-            icon: {
-                path: google.maps.SymbolPath.CIRCLE,
-                fillColor: color,
-                fillOpacity: 0.7,
-                strokeColor: '#ffffff',
-                strokeWeight: 3,
-                scale: size / 10, // Scale the circle based on submission count
-            },
-            label: {
-                text: submissionCount.toString(),
-                color: 'white',
-                fontSize: '18px',
-                fontWeight: 'bold'
-            },
-            animation: google.maps.Animation.BOUNCE, // Add bounce animation
-            optimized: false // Required for some animations to work properly
-        });
-        
-        // Stop the bouncing after a shorter time
-        setTimeout(() => {
-            marker.setAnimation(null);
-        }, 1500);
-        
-        // Add pulsating effect via scale changes with faster animation
-        let direction = 1;
-        let currentScale = size / 10;
-        const scaleFactor = 0.1; // Doubled for faster animation
-        const minScale = (size / 10) * 0.9;
-        const maxScale = (size / 10) * 1.1;
-        
-        // Create pulsating effect with faster interval
-        const pulse = setInterval(() => {
-            try {
-                if (!marker.getMap()) {
-                    clearInterval(pulse);
-                    return;
-                }
-                
-                // Update scale based on direction
-                currentScale += scaleFactor * direction;
-                
-                // Check if we need to change direction
-                if (currentScale >= maxScale) direction = -1;
-                if (currentScale <= minScale) direction = 1;
-                
-                // Apply new scale
-                const icon = marker.getIcon();
-                icon.scale = currentScale;
-                marker.setIcon(icon);
-    } catch (error) {
-                console.error('Error in pulse animation:', error);
+    const position = new google.maps.LatLng(
+        cluster.location.lat,
+        cluster.location.lng
+    );
+    
+    // Determine cluster size for visual representation
+    const submissionCount = cluster.count || cluster.submissions.length;
+    const size = Math.min(150, Math.max(80, 60 + (submissionCount * 10))); // Even bigger size between 80-150px
+    
+    // Get color based on index (cycle through colors)
+    const color = markerColors[index % markerColors.length];
+    
+    console.log('Creating cluster for', submissionCount, 'submissions at', position.toString(), 'with size', size);
+    
+    // Create a custom animated marker for the cluster
+    const marker = new google.maps.Marker({
+        position: position,
+        map: submissionsMap,
+        title: `${submissionCount} submission${submissionCount !== 1 ? 's' : ''}`,
+        icon: {
+            path: google.maps.SymbolPath.CIRCLE,
+            fillColor: color,
+            fillOpacity: 0.7,
+            strokeColor: '#ffffff',
+            strokeWeight: 3,
+            scale: size / 10, // Scale the circle based on submission count
+        },
+        label: {
+            text: submissionCount.toString(),
+            color: 'white',
+            fontSize: '18px',
+            fontWeight: 'bold'
+        },
+        animation: bounce ? google.maps.Animation.BOUNCE : null, // Add bounce animation
+        optimized: false // Required for some animations to work properly
+    });
+    
+    // Stop the bouncing after a shorter time
+    setTimeout(() => {
+        marker.setAnimation(null);
+    }, 1500);
+    
+    // Add pulsating effect via scale changes with faster animation
+    let direction = 1;
+    let currentScale = size / 10;
+    const scaleFactor = 0.1; // Doubled for faster animation
+    const minScale = (size / 10) * 0.9;
+    const maxScale = (size / 10) * 1.1;
+    
+    // Create pulsating effect with faster interval
+    const pulse = setInterval(() => {
+        try {
+            if (!marker.getMap()) {
                 clearInterval(pulse);
+                return;
             }
-        }, 50); // Faster interval for more fluid animation
-        
-        // Add click event to show submissions in the cluster
-        marker.addListener('click', () => {
-            console.log('Cluster clicked:', cluster);
-            showClusterSubmissions(cluster, marker);
-        });
-        
-        submissionsMarkers.push(marker);
-        console.log('Added cluster marker to submissionsMarkers array, new length:', submissionsMarkers.length);
+            
+            // Update scale based on direction
+            currentScale += scaleFactor * direction;
+            
+            // Check if we need to change direction
+            if (currentScale >= maxScale) direction = -1;
+            if (currentScale <= minScale) direction = 1;
+            
+            // Apply new scale
+            const icon = marker.getIcon();
+            icon.scale = currentScale;
+            marker.setIcon(icon);
+        } catch (error) {
+            console.error('Error in pulse animation:', error);
+            clearInterval(pulse);
+        }
+    }, 50); // Faster interval for more fluid animation
+    
+    // Add click event to show submissions in the cluster
+    marker.addListener('click', () => {
+        console.log('Cluster clicked:', cluster);
+        openServerCluster(cluster, marker);
     });
+    
+    return marker;
 }
 
 // Function to show submissions in a cluster
@@ -1715,14 +1746,15 @@ function handleMouseMove(e) {
         
         // Emit brush stroke to other users
         if (socket && socket.connected) {
-            socket.emit('brush_stroke', {
+            // Sent as a 17-byte binary attachment (see encodeBrushSegment)
+            socket.emit('brush_stroke', encodeBrushSegment({
                 x, y, lastX, lastY,
                 brushSize: scaledBrushSize,
                 tool: currentTool,
                 canvasWidth: maskCanvas.width,
                 canvasHeight: maskCanvas.height,
                 isFromModal: imageLoadedFromModal
-            });
+            }));
         }
         
         // Update cursor with current mouse position
@@ -2218,115 +2250,120 @@ function initializeWebSocket() {
             transports: ['websocket'],
             upgrade: false,
             reconnection: true,
-            reconnectionAttempts: 5
+            reconnectionAttempts: 5,
+            // Groups only see each other's drawing when they share a session code
+            query: { session: sessionCode }
         });
 
         socket.on('connect', () => {
             console.log('Connected to server');
             updateConnectionStatus(true);
             userId = socket.id;
-            // Request submissions when connected
-            socket.emit('get_submissions');
-        });
-
-        socket.on('user_connected', (data) => {
-            console.log('User connected:', data);
-            // Store the color for this user
-            connectedUserColors.set(data.user_id, data.color);
-            if (data.user_id !== socket.id) {  // Only add other users to connectedUsers
-                connectedUsers.set(data.user_id, {
-                    color: data.color,
-                    brush_size: data.brush_size
+            // The map loads its own clusters; only ask how many submissions were missed while disconnected
+            socket.emit('get_submissions', { since: submissionsSyncToken, limit: 0 });
+            // Facilitators get the priority generation lane for this session
+            if (facilitatorKey) {
+                socket.emit('register_facilitator', { key: facilitatorKey }, (response) => {
+                    if (response && response.error) {
+                        console.warn('Facilitator registration failed:', response.error);
+                    }
                 });
             }
-            updateUsersList();
         });
 
         socket.on('users_list', (data) => {
+            // Full presence snapshot; deltas continue from data.version
             console.log('Received users list:', data);
+            if (data.session) {
+                sessionCode = data.session;
+            }
+            presenceVersion = data.version;
+            presenceResyncPending = false;
             connectedUsers.clear();
             connectedUserColors.clear();
-            data.users.forEach(user => {
-                // Store color for all users including self
-                connectedUserColors.set(user.id, user.color);
-                if (user.id !== socket.id) {  // Only add other users to connectedUsers
-                    connectedUsers.set(user.id, {
-                        color: user.color,
-                        brush_size: user.brush_size,
-                        connected_at: user.connected_at
-                    });
-                }
-            });
+            userIdsByIndex.clear();
+            data.users.forEach(addPresenceUser);
             updateUsersList();
         });
 
-        socket.on('brush_stroke', (data) => {
-            console.log('Received brush stroke:', data);
-            if (!maskCanvas || !maskCtx) return;
-
-            // Get the user's color
-            const userColor = data.color || '#FF0000';
-            const brushSize = data.brushSize || 5;
-            const isEraser = data.tool === 'eraser';
+        socket.on('socket_token', (data) => {
+            socketToken = data.token;
+        });
 
-            // Set up the drawing context
-            if (isEraser) {
-                maskCtx.globalCompositeOperation = 'destination-out';
-                maskCtx.strokeStyle = 'rgba(0, 0, 0, 1)';
-            } else {
-                maskCtx.globalCompositeOperation = 'source-over';
-                const fixedAlpha = 0.1;
-                const r = parseInt(userColor.slice(1, 3), 16);
-                const g = parseInt(userColor.slice(3, 5), 16);
-                const b = parseInt(userColor.slice(5, 7), 16);
-                maskCtx.strokeStyle = `rgba(${r}, ${g}, ${b}, ${fixedAlpha})`;
+        socket.on('submissions_list', (data) => {
+            if (data.error) {
+                console.error('Error syncing submissions:', data.error);
+                return;
+            }
+            // Submissions saved while this client was away: refresh the map clusters once
+            const missed = submissionsSyncToken !== null && (data.reset || data.total > 0);
+            submissionsSyncToken = data.sync_token || null;
+            if (missed) {
+                console.log(`${data.total} submissions were added while disconnected`);
+                loadServerClusters();
             }
+        });
 
-            // Draw the stroke
-            maskCtx.beginPath();
-            maskCtx.moveTo(data.x, data.y);
-            maskCtx.lineTo(data.lastX, data.lastY);
-            maskCtx.lineWidth = brushSize;
-            maskCtx.lineCap = 'round';
-            maskCtx.lineJoin = 'round';
-            maskCtx.stroke();
+        socket.on('submission_added', (data) => {
+            // Pushed to every client when someone saves, instead of everyone re-pulling the list
+            submissionsSyncToken = data.sync_token;
+            loadServerClusters();
+        });
 
-            // Reset composite operation
-            maskCtx.globalCompositeOperation = 'source-over';
+        socket.on('user_joined', (data) => {
+            if (acceptPresenceDelta(data)) {
+                addPresenceUser(data.user);
+                updateUsersList();
+            }
+        });
 
-            // Store the user's last position
-            const user = connectedUsers.get(data.user_id);
-            if (user) {
-                user.lastX = data.x;
-                user.lastY = data.y;
-                
-                // Update the bubble position if it exists
-                const bubble = userDrawingBubbles.get(data.user_id);
-                if (bubble && maskCanvas) {
-                    const rect = maskCanvas.getBoundingClientRect();
-                    const scaleX = maskCanvas.width / rect.width;
-                    const scaleY = maskCanvas.height / rect.height;
-                    
-                    // Convert canvas coordinates to screen coordinates
-                    const screenX = rect.left + (data.x / scaleX);
-                    const screenY = rect.top + (data.y / scaleY);
-                    
-                    bubble.style.left = `${screenX}px`;
-                    bubble.style.top = `${screenY}px`;
+        socket.on('user_left', (data) => {
+            if (acceptPresenceDelta(data)) {
+                connectedUsers.delete(data.user_id);
+                connectedUserColors.delete(data.user_id);
+                if (userIdsByIndex.get(data.index) === data.user_id) {
+                    userIdsByIndex.delete(data.index);
                 }
+                updateUsersList();
             }
         });
 
-        socket.on('brush_size_updated', (data) => {
-            console.log('Brush size updated:', data);
-            if (data.user_id !== socket.id) {
+        socket.on('user_updated', (data) => {
+            if (acceptPresenceDelta(data)) {
                 const user = connectedUsers.get(data.user_id);
                 if (user) {
-                    user.brush_size = data.size;
+                    Object.assign(user, data.changes);
                 }
             }
         });
 
+        socket.on('brush_stroke', (data) => {
+            // Per-segment relay, used when the server has stroke batching turned off
+            drawRemoteStroke({
+                ...data,
+                points: [data.lastX, data.lastY, data.x, data.y]
+            });
+        });
+
+        socket.on('brush_frame', (frame) => {
+            // One frame carries every user's strokes since the last server tick
+            if (frame instanceof ArrayBuffer) {
+                frame = decodeDrawingEvent(frame);
+            }
+            frame.strokes.forEach((stroke) => {
+                if (stroke.user_id !== socket.id) {
+                    drawRemoteStroke(stroke);
+                }
+            });
+        });
+
+        socket.on('frame_sync', (framesSent, ack) => {
+            // Acknowledged only after every brush_frame before it, so the server can tell when this client falls behind
+            if (typeof ack === 'function') {
+                ack(framesSent);
+            }
+        });
+
         socket.on('location_updated', (data) => {
             console.log('Received location update:', data);
             if (data.location && data.panorama_id && data.heading) {
@@ -2374,6 +2411,14 @@ function initializeWebSocket() {
 
         socket.on('image_generated', (data) => {
             console.log('Received generated image:', data);
+            // Our own queued job is displayed by generateImage
+            if (data.job_id && settleGenerationJob(data.job_id, data)) {
+                return;
+            }
+            if (data.image_urls && data.image_urls.length > 1) {
+                showGeneratedVariants(data.image_urls, document.getElementById('preview-container'));
+                return;
+            }
             if (data.image_url) {
                 // Create a new image and load it
                 const img = new Image();
@@ -2433,11 +2478,24 @@ function initializeWebSocket() {
             }
         });
 
+        socket.on('generation_failed', (data) => {
+            console.error('Generation job failed:', data);
+            settleGenerationJob(data.job_id, null, data.error || 'Generation failed');
+        });
+
+        socket.on('generation_cancelled', (data) => {
+            console.log('Generation job cancelled:', data);
+            settleGenerationJob(data.job_id, null, supersededError(data.superseded_by));
+        });
+
         socket.on('disconnect', () => {
             updateConnectionStatus(false);
         });
 
         socket.on('user_drawing', (data) => {
+            if (data instanceof ArrayBuffer) {
+                data = decodeDrawingEvent(data);
+            }
             const { user_id, color, is_drawing } = data;
             
             if (is_drawing) {
@@ -2477,6 +2535,9 @@ function initializeWebSocket() {
         });
 
         socket.on('mask_cleared', (data) => {
+            if (data instanceof ArrayBuffer) {
+                data = decodeDrawingEvent(data);
+            }
             const { user_id, color } = data;
             console.log(`User ${user_id} cleared the mask`);
             
@@ -2485,6 +2546,14 @@ function initializeWebSocket() {
                 maskCtx.clearRect(0, 0, maskCanvas.width, maskCanvas.height);
             }
         });
+
+        socket.on('mask_state', (state) => {
+            // Everything drawn before we joined: a snapshot plus the strokes since it was taken
+            console.log(`Received shared mask state (seq ${state.seq}, ${state.strokes.length} strokes after snapshot)`);
+            applyMaskState(state).catch((error) => {
+                console.error('Error applying shared mask state:', error);
+            });
+        });
     } catch (error) {
         console.error('Error initializing WebSocket:', error);
     }
@@ -2513,6 +2582,37 @@ function updateConnectionStatus(isConnected) {
 }
 
 // Update the users list display
+function addPresenceUser(user) {
+    // Store color for all users including self
+    connectedUserColors.set(user.id, user.color);
+    userIdsByIndex.set(user.index, user.id);
+    if (user.id !== socket.id) {  // Only add other users to connectedUsers
+        connectedUsers.set(user.id, {
+            color: user.color,
+            brush_size: user.brush_size,
+            connected_at: user.connected_at,
+            index: user.index
+        });
+    }
+}
+
+function acceptPresenceDelta(data) {
+    // Apply deltas strictly in version order; a gap means one was missed, so ask for a snapshot
+    if (presenceVersion === null || data.version <= presenceVersion) {
+        return false;
+    }
+    if (data.version !== presenceVersion + 1) {
+        if (!presenceResyncPending) {
+            presenceResyncPending = true;
+            console.warn(`Presence version gap (${presenceVersion} -> ${data.version}), resyncing`);
+            socket.emit('request_presence');
+        }
+        return false;
+    }
+    presenceVersion = data.version;
+    return true;
+}
+
 function updateUsersList() {
     const connectedUsersBtn = document.getElementById('connectedUsersBtn');
     if (!connectedUsersBtn) return;
@@ -3748,31 +3848,32 @@ async function generateImage() {
                 return; // Stop execution
             }
             
-            // Get image and mask data
-            const imageData = imageCanvas.toDataURL('image/png');
-            const maskData = maskCanvas.toDataURL('image/png');
-            
-            // Convert base64 data URLs to base64 strings (remove the header)
-            const imageBase64 = imageData.split(',')[1];
-            const maskBase64 = maskData.split(',')[1];
+            // Get image and mask data as PNG blobs (no base64 round trip)
+            const [imageBlob, maskBlob] = await Promise.all([
+                new Promise(resolve => imageCanvas.toBlob(resolve, 'image/png')),
+                new Promise(resolve => maskCanvas.toBlob(resolve, 'image/png'))
+            ]);
             
             // Prepare data for the API
-            const requestData = {
-                image: imageBase64,
-                mask: maskBase64,
-                prompt: prompt,
-                negative_prompt: avoidPrompt
-            };
+            const requestData = new FormData();
+            requestData.append('image', imageBlob, 'image.png');
+            requestData.append('mask', maskBlob, 'mask.png');
+            requestData.append('prompt', prompt);
+            requestData.append('negative_prompt', avoidPrompt);
+            if (socket && socket.connected && socketToken) {
+                requestData.append('socket_id', socket.id);
+                requestData.append('socket_token', socketToken);
+            }
+            requestData.append('deterministic', deterministicGeneration);
+            requestData.append('variants', generationVariants);
+            requestData.append('crop_to_mask', cropToMask);
             
             console.log('Sending generation request to API...');
             
-            // Send the request to the server
-            const response = await fetch('/api/process', {
+            // Send the request to the server as multipart form data
+            const response = await fetch('/api/process-binary', {
                 method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-                body: JSON.stringify(requestData)
+                body: requestData
             });
             
             if (!response.ok) {
@@ -3789,13 +3890,34 @@ async function generateImage() {
                 }
             }
             
-            const result = await response.json();
+            const job = await response.json();
+            
+            if (job.error) {
+                throw new Error(job.error);
+            }
+            
+            let result;
+            if (job.status === 'completed') {
+                // Identical deterministic request served from the result cache
+                console.log('Generation served from result cache');
+                result = job.result;
+            } else {
+                // The server queues the job; wait for the worker to push the result
+                console.log(`Generation job ${job.job_id} queued at position ${job.queue_position}`);
+                if (previewContainer) {
+                    previewContainer.innerHTML = `<div class="loading">Queued for generation (position ${job.queue_position})...</div>`;
+                }
+                result = await waitForGenerationJob(job.job_id);
+            }
             
             if (result.error) {
                 throw new Error(result.error);
             }
             
-            if (result.image_url) {
+            if (result.image_urls && result.image_urls.length > 1) {
+                console.log(`Generated ${result.image_urls.length} variants`);
+                showGeneratedVariants(result.image_urls, previewContainer);
+            } else if (result.image_url) {
                 console.log('Image generated successfully:', result.image_url);
                 
                 // Use the proxy-image route to avoid CORS issues
@@ -3819,16 +3941,7 @@ async function generateImage() {
                         submitBtn.disabled = false;
                     }
                     
-                    // Emit the generated image to other users with all necessary data
-                    if (socket && socket.connected) {
-                        socket.emit('image_generated', {
-                            image_url: result.image_url,
-                            prompt: prompt,
-                            negative_prompt: avoidPrompt,
-                            user_id: socket.id,
-                            timestamp: new Date().toISOString()
-                        });
-                    }
+                    // The server already broadcast image_generated to the other users
                 };
                 
                 img.onerror = function(e) {
@@ -3843,8 +3956,8 @@ async function generateImage() {
                 img.style.maxWidth = '100%';
                 img.style.maxHeight = '100%';
                 
-            } else if (result.image) {
-                console.log('Image generated successfully (base64)');
+            } else if (result.image || result.image_path) {
+                console.log('Image generated successfully (inline image)');
                 
                 // Display the generated image (base64 format)
                 const img = new Image();
@@ -3878,7 +3991,7 @@ async function generateImage() {
                     }
                 };
                 
-                img.src = 'data:image/png;base64,' + result.image;
+                img.src = generatedImageSource(result);
                 img.style.maxWidth = '100%';
                 img.style.maxHeight = '100%';
                 
@@ -3887,6 +4000,11 @@ async function generateImage() {
             }
             
         } catch (apiError) {
+            if (apiError.superseded) {
+                // A newer request from this session replaced this one; it owns the preview now
+                console.log('Generation request superseded by a newer one');
+                return;
+            }
             console.error('Error calling API:', apiError);
             
             // Show error in preview container
@@ -3919,6 +4037,287 @@ async function generateImage() {
     }
 }
 
+// Binary drawing events, mirroring the wire format in app.py: a version byte and a type byte,
+// then little-endian fields. Coordinates are uint16 fractions of the canvas size, brush sizes
+// uint16 quarter pixels, and users are the small index from the users list instead of the sid.
+const DRAWING_WIRE_VERSION = 1;
+const WIRE_SEGMENT = 1;
+const WIRE_STROKE_FRAME = 2;
+const WIRE_USER_DRAWING = 3;
+const WIRE_MASK_CLEARED = 4;
+const WIRE_FLAG_ERASER = 0x01;
+const WIRE_FLAG_FROM_MODAL = 0x02;
+
+function quantizeCoordinate(value, extent) {
+    return Math.max(0, Math.min(65535, Math.round(value / Math.max(extent, 1) * 65535)));
+}
+
+function encodeBrushSegment(segment) {
+    const view = new DataView(new ArrayBuffer(17));
+    const width = segment.canvasWidth;
+    const height = segment.canvasHeight;
+    view.setUint8(0, DRAWING_WIRE_VERSION);
+    view.setUint8(1, WIRE_SEGMENT);
+    view.setUint8(2, (segment.tool === 'eraser' ? WIRE_FLAG_ERASER : 0) | (segment.isFromModal ? WIRE_FLAG_FROM_MODAL : 0));
+    view.setUint16(3, Math.max(0, Math.min(65535, Math.round(segment.brushSize * 4))), true);
+    view.setUint16(5, width, true);
+    view.setUint16(7, height, true);
+    view.setUint16(9, quantizeCoordinate(segment.x, width), true);
+    view.setUint16(11, quantizeCoordinate(segment.y, height), true);
+    view.setUint16(13, quantizeCoordinate(segment.lastX, width), true);
+    view.setUint16(15, quantizeCoordinate(segment.lastY, height), true);
+    return view.buffer;
+}
+
+// Decode a binary brush_frame, user_drawing or mask_cleared into its JSON form
+function decodeDrawingEvent(buffer) {
+    const view = new DataView(buffer);
+    const version = view.getUint8(0);
+    if (version !== DRAWING_WIRE_VERSION) {
+        throw new Error(`Unsupported drawing wire version ${version}`);
+    }
+    const type = view.getUint8(1);
+    const userFor = (index) => {
+        const userId = userIdsByIndex.get(index);
+        return { user_id: userId, color: connectedUserColors.get(userId) };
+    };
+    if (type === WIRE_STROKE_FRAME) {
+        const strokes = [];
+        const count = view.getUint16(2, true);
+        let offset = 4;
+        for (let i = 0; i < count; i++) {
+            const flags = view.getUint8(offset + 1);
+            const width = view.getUint16(offset + 4, true);
+            const height = view.getUint16(offset + 6, true);
+            const pointCount = view.getUint16(offset + 8, true);
+            const stroke = {
+                ...userFor(view.getUint8(offset)),
+                tool: flags & WIRE_FLAG_ERASER ? 'eraser' : 'brush',
+                isFromModal: Boolean(flags & WIRE_FLAG_FROM_MODAL),
+                brushSize: view.getUint16(offset + 2, true) / 4,
+                canvasWidth: width,
+                canvasHeight: height,
+                points: []
+            };
+            offset += 10;
+            for (let p = 0; p < pointCount; p++) {
+                stroke.points.push(view.getUint16(offset, true) * width / 65535);
+                stroke.points.push(view.getUint16(offset + 2, true) * height / 65535);
+                offset += 4;
+            }
+            strokes.push(stroke);
+        }
+        return { strokes };
+    }
+    if (type === WIRE_USER_DRAWING) {
+        return { ...userFor(view.getUint8(2)), is_drawing: view.getUint8(3) === 1 };
+    }
+    if (type === WIRE_MASK_CLEARED) {
+        return userFor(view.getUint8(2));
+    }
+    throw new Error(`Unknown drawing event type ${type}`);
+}
+
+// Paint the server's grayscale mask snapshot onto the mask canvas, then replay the stroke tail
+async function applyMaskState(state) {
+    if (!maskCanvas || !maskCtx) return;
+
+    const bitmap = await createImageBitmap(new Blob([state.snapshot], { type: 'image/png' }));
+    const snapshotCanvas = document.createElement('canvas');
+    snapshotCanvas.width = state.width;
+    snapshotCanvas.height = state.height;
+    const snapshotCtx = snapshotCanvas.getContext('2d');
+    snapshotCtx.drawImage(bitmap, 0, 0);
+
+    // Painted pixels become the default translucent red used for remote strokes
+    const pixels = snapshotCtx.getImageData(0, 0, state.width, state.height);
+    for (let i = 0; i < pixels.data.length; i += 4) {
+        const painted = pixels.data[i] > 0;
+        pixels.data[i] = 255;
+        pixels.data[i + 1] = 0;
+        pixels.data[i + 2] = 0;
+        pixels.data[i + 3] = painted ? 26 : 0;
+    }
+    snapshotCtx.putImageData(pixels, 0, 0);
+
+    maskCtx.clearRect(0, 0, maskCanvas.width, maskCanvas.height);
+    maskCtx.drawImage(snapshotCanvas, 0, 0, maskCanvas.width, maskCanvas.height);
+    state.strokes.forEach(drawRemoteStroke);
+}
+
+// Draw another user's stroke, given as a flat [x0, y0, x1, y1, ...] polyline
+function drawRemoteStroke(data) {
+    if (!maskCanvas || !maskCtx) return;
+
+    // Get the user's color
+    const userColor = data.color || '#FF0000';
+    const brushSize = data.brushSize || 5;
+    const isEraser = data.tool === 'eraser';
+
+    // Set up the drawing context
+    if (isEraser) {
+        maskCtx.globalCompositeOperation = 'destination-out';
+        maskCtx.strokeStyle = 'rgba(0, 0, 0, 1)';
+    } else {
+        maskCtx.globalCompositeOperation = 'source-over';
+        const fixedAlpha = 0.1;
+        const r = parseInt(userColor.slice(1, 3), 16);
+        const g = parseInt(userColor.slice(3, 5), 16);
+        const b = parseInt(userColor.slice(5, 7), 16);
+        maskCtx.strokeStyle = `rgba(${r}, ${g}, ${b}, ${fixedAlpha})`;
+    }
+
+    // Draw the stroke
+    const points = data.points;
+    maskCtx.beginPath();
+    maskCtx.moveTo(points[0], points[1]);
+    for (let i = 2; i < points.length; i += 2) {
+        maskCtx.lineTo(points[i], points[i + 1]);
+    }
+    maskCtx.lineWidth = brushSize;
+    maskCtx.lineCap = 'round';
+    maskCtx.lineJoin = 'round';
+    maskCtx.stroke();
+
+    // Reset composite operation
+    maskCtx.globalCompositeOperation = 'source-over';
+
+    // Store the user's last position
+    const lastX = points[points.length - 2];
+    const lastY = points[points.length - 1];
+    const user = connectedUsers.get(data.user_id);
+    if (user) {
+        user.lastX = lastX;
+        user.lastY = lastY;
+        
+        // Update the bubble position if it exists
+        const bubble = userDrawingBubbles.get(data.user_id);
+        if (bubble && maskCanvas) {
+            const rect = maskCanvas.getBoundingClientRect();
+            const scaleX = maskCanvas.width / rect.width;
+            const scaleY = maskCanvas.height / rect.height;
+            
+            // Convert canvas coordinates to screen coordinates
+            const screenX = rect.left + (lastX / scaleX);
+            const screenY = rect.top + (lastY / scaleY);
+            
+            bubble.style.left = `${screenX}px`;
+            bubble.style.top = `${screenY}px`;
+        }
+    }
+}
+
+// Generation jobs waiting for a result, keyed by job id
+const pendingGenerationJobs = new Map();
+
+// Opt-in fixed-seed generation so repeated identical requests hit the server's result cache
+let deterministicGeneration = localStorage.getItem('deterministicGeneration') === 'true';
+
+// Number of variations generated per request (the server batches them into one job)
+let generationVariants = parseInt(localStorage.getItem('generationVariants') || '1', 10);
+
+// Opt-in crop-and-stitch: only the masked region is sent through the inpainting model
+let cropToMask = localStorage.getItem('cropToMask') === 'true';
+
+// Session code for the shared canvas, from ?session= in the URL (remembered for later visits)
+let sessionCode = new URLSearchParams(window.location.search).get('session') || localStorage.getItem('sessionCode') || '';
+if (sessionCode) {
+    localStorage.setItem('sessionCode', sessionCode);
+}
+
+// Shared facilitator key; when set, this session's generations jump the participant queue
+let facilitatorKey = localStorage.getItem('facilitatorKey');
+
+// Error for a queued job the server dropped because the same session submitted again
+function supersededError(supersededBy) {
+    const error = new Error('Replaced by a newer generation request');
+    error.superseded = true;
+    error.supersededBy = supersededBy;
+    return error;
+}
+
+// Image source for an inline result: raw bytes from a binary socket attachment,
+// a job image path from status polling, or base64 from the JSON endpoint
+function generatedImageSource(result) {
+    if (result.image instanceof ArrayBuffer || result.image instanceof Blob) {
+        return URL.createObjectURL(new Blob([result.image], { type: 'image/png' }));
+    }
+    if (result.image_path) {
+        return result.image_path;
+    }
+    return 'data:image/png;base64,' + result.image;
+}
+
+// Show a grid of generated variants; clicking one selects it for sharing
+function showGeneratedVariants(imageUrls, previewContainer) {
+    if (!previewContainer) return;
+    previewContainer.innerHTML = '';
+    const grid = document.createElement('div');
+    grid.className = 'variant-grid';
+    grid.style.display = 'grid';
+    grid.style.gridTemplateColumns = 'repeat(2, 1fr)';
+    grid.style.gap = '4px';
+
+    imageUrls.forEach((imageUrl, index) => {
+        const img = new Image();
+        img.crossOrigin = 'anonymous';
+        img.src = `/proxy-image?url=${encodeURIComponent(imageUrl)}`;
+        img.title = `Variant ${index + 1}`;
+        img.style.maxWidth = '100%';
+        img.style.cursor = 'pointer';
+        img.addEventListener('click', () => {
+            grid.querySelectorAll('img').forEach(other => other.style.outline = 'none');
+            img.style.outline = '3px solid #2196F3';
+            generatedImageUrl = imageUrl;
+            const submitBtn = document.getElementById('submit-to-map-btn');
+            if (submitBtn) {
+                submitBtn.disabled = false;
+            }
+        });
+        grid.appendChild(img);
+    });
+
+    previewContainer.appendChild(grid);
+}
+
+// Resolve a queued generation job from a socket event or a status poll
+function settleGenerationJob(jobId, result, error) {
+    const pending = pendingGenerationJobs.get(jobId);
+    if (!pending) return false;
+    pendingGenerationJobs.delete(jobId);
+    clearInterval(pending.pollInterval);
+    if (error) {
+        pending.reject(error instanceof Error ? error : new Error(error));
+    } else {
+        pending.resolve(result);
+    }
+    return true;
+}
+
+// Wait for a queued generation job to finish
+function waitForGenerationJob(jobId) {
+    return new Promise((resolve, reject) => {
+        // Poll the job status as a fallback in case the socket event is missed
+        const pollInterval = setInterval(async () => {
+            try {
+                const response = await fetch(`/api/jobs/${jobId}`);
+                if (!response.ok) return;
+                const job = await response.json();
+                if (job.status === 'completed') {
+                    settleGenerationJob(jobId, job.result);
+                } else if (job.status === 'failed') {
+                    settleGenerationJob(jobId, null, job.error || 'Generation failed');
+                } else if (job.status === 'cancelled') {
+                    settleGenerationJob(jobId, null, supersededError(job.superseded_by));
+                }
+            } catch (error) {
+                console.warn('Error polling generation job:', error);
+            }
+        }, 5000);
+        pendingGenerationJobs.set(jobId, { resolve, reject, pollInterval });
+    });
+}
+
 // Function to add a submission marker to the map
 function addSubmissionMarker(submission) {
     if (!submissionsMap || !submission.location) return;
@@ -4314,9 +4713,9 @@ function initializeHeatmap(map) {
         
         // Get heatmap data from all submissions
         const heatmapData = [];
-        Object.values(submissionClusters).forEach(cluster => {
+        Object.values(submissionClusters).concat(serverClusters).forEach(cluster => {
             // Weight location based on number of submissions
-            const weight = Math.min(10, cluster.submissions.length); // Cap weight at 10
+            const weight = Math.min(10, cluster.count || cluster.submissions.length); // Cap weight at 10
             
             // Add weighted point
             heatmapData.push({
@@ -4367,9 +4766,9 @@ function updateHeatmapData() {
         
         // Get heatmap data from all submissions
         const heatmapData = [];
-        Object.values(submissionClusters).forEach(cluster => {
+        Object.values(submissionClusters).concat(serverClusters).forEach(cluster => {
             // Weight location based on number of submissions
-            const weight = Math.min(10, cluster.submissions.length); // Cap weight at 10
+            const weight = Math.min(10, cluster.count || cluster.submissions.length); // Cap weight at 10
             
             // Add weighted point
             heatmapData.push({
@@ -0,0 +1,44 @@
+"""Production entry point for the CoDesign Canvas server.
+
+Runs Flask-SocketIO on an event loop (eventlet by default, or gevent) instead
+of one OS thread per client, with debug mode and the reloader off:
+
+    python serve.py                        # eventlet on 0.0.0.0:3000
+    SOCKETIO_ASYNC_MODE=gevent python serve.py
+    HOST=127.0.0.1 PORT=8000 python serve.py
+
+`python app.py` is still the development server.
+"""
+import os
+
+os.environ.setdefault('SOCKETIO_ASYNC_MODE', 'eventlet')
+ASYNC_MODE = os.environ['SOCKETIO_ASYNC_MODE']
+
+# The standard library has to be patched before app (and requests, redis, ...) import it,
+# so that ComfyUI/Firebase HTTP calls and queue workers yield to the event loop
+if ASYNC_MODE == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+elif ASYNC_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+import logging
+
+import app as codesign
+
+# app.py logs every request and Socket.IO packet for development; at load that costs more than the broadcasts
+logging.getLogger().setLevel(os.getenv('LOG_LEVEL', 'INFO'))
+for name in ('socketio.server', 'engineio.server', 'werkzeug'):
+    logging.getLogger(name).setLevel(logging.WARNING)
+
+if __name__ == '__main__':
+    host = os.getenv('HOST', '0.0.0.0')
+    port = int(os.getenv('PORT', '3000'))
+    logging.info(f"Starting production server ({ASYNC_MODE}) on {host}:{port}")
+    codesign.socketio.run(codesign.app,
+                          host=host,
+                          port=port,
+                          debug=False,
+                          use_reloader=False,
+                          log_output=False)
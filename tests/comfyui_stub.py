@@ -0,0 +1,158 @@
+"""A minimal stand-in for a ComfyUI server, for tests
+
+Serves the HTTP routes app.py uses (/queue, /object_info, /upload/image,
+/prompt, /history/<id>, /view) and the /ws event stream, with just enough
+of the WebSocket protocol to push JSON events to websocket-client.
+"""
+import base64
+import email
+import email.policy
+import hashlib
+import json
+import socket
+import struct
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+class StubComfyUI:
+    def __init__(self, checkpoints=('sd_xl_base_1.0.safetensors',)):
+        self.checkpoints = list(checkpoints)
+        self.queue_pending = 0
+        self.fail_requests = False  # Answer every HTTP request with a 500
+        self.uploads = []  # (name, subfolder, bytes) in arrival order
+        self.prompts = {}  # prompt_id -> submitted workflow
+        self.history = {}  # prompt_id -> /history entry
+        self.ws_clients = []
+        self.ws_connected = threading.Event()
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class())
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.disconnect_events()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def send_event(self, event_type, data):
+        """Push one JSON event to every connected /ws client"""
+        payload = json.dumps({'type': event_type, 'data': data}).encode('utf-8')
+        if len(payload) < 126:
+            header = struct.pack('!BB', 0x81, len(payload))
+        else:
+            header = struct.pack('!BBH', 0x81, 126, len(payload))
+        with self.lock:
+            clients = list(self.ws_clients)
+        for connection in clients:
+            connection.sendall(header + payload)
+
+    def disconnect_events(self):
+        with self.lock:
+            clients, self.ws_clients = self.ws_clients, []
+            self.ws_connected.clear()
+        for connection in clients:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def finish_prompt(self, prompt_id, outputs=None):
+        """Record a prompt as finished in /history, the way ComfyUI does once it has run"""
+        self.history[prompt_id] = {
+            'status': {'status_str': 'success', 'completed': True, 'messages': []},
+            'outputs': outputs or {'9': {'images': [{'filename': f'{prompt_id}.png', 'subfolder': '', 'type': 'output'}]}}
+        }
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                path = urlparse(self.path).path
+                if path == '/ws':
+                    return self._websocket()
+                if stub.fail_requests:
+                    return self._json({'error': 'stub failure'}, 500)
+                if path == '/queue':
+                    return self._json({'queue_running': [], 'queue_pending': [[n] for n in range(stub.queue_pending)]})
+                if path == '/object_info':
+                    return self._json({'CheckpointLoaderSimple': {'input': {'required': {'ckpt_name': [stub.checkpoints]}}}})
+                if path.startswith('/history/'):
+                    prompt_id = path[len('/history/'):]
+                    entry = stub.history.get(prompt_id)
+                    return self._json({prompt_id: entry} if entry else {})
+                if path == '/view':
+                    return self._send(b'\x89PNG stub', 'image/png')
+                self._json({'error': 'not found'}, 404)
+
+            def do_POST(self):
+                path = urlparse(self.path).path
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if stub.fail_requests:
+                    return self._json({'error': 'stub failure'}, 500)
+                if path == '/upload/image':
+                    fields = self._multipart(body)
+                    filename, data = fields['image']
+                    subfolder = fields.get('subfolder', (None, b''))[1].decode('utf-8')
+                    with stub.lock:
+                        stub.uploads.append((filename, subfolder, data))
+                    return self._json({'name': filename, 'subfolder': subfolder, 'type': 'input'})
+                if path == '/prompt':
+                    prompt_id = uuid.uuid4().hex
+                    with stub.lock:
+                        stub.prompts[prompt_id] = json.loads(body)
+                    return self._json({'prompt_id': prompt_id, 'number': len(stub.prompts)})
+                self._json({'error': 'not found'}, 404)
+
+            def _multipart(self, body):
+                """form field name -> (filename, bytes)"""
+                message = email.message_from_bytes(
+                    f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode('utf-8') + body,
+                    policy=email.policy.HTTP)
+                return {part.get_param('name', header='content-disposition'): (part.get_filename(), part.get_payload(decode=True))
+                        for part in message.iter_parts()}
+
+            def _websocket(self):
+                accept = base64.b64encode(hashlib.sha1(
+                    (self.headers['Sec-WebSocket-Key'] + WEBSOCKET_GUID).encode('utf-8')).digest()).decode('ascii')
+                self.send_response(101, 'Switching Protocols')
+                self.send_header('Upgrade', 'websocket')
+                self.send_header('Connection', 'Upgrade')
+                self.send_header('Sec-WebSocket-Accept', accept)
+                self.end_headers()
+                with stub.lock:
+                    stub.ws_clients.append(self.connection)
+                    stub.ws_connected.set()
+                # Hold the connection open until the client goes away; its frames are ignored
+                try:
+                    while self.connection.recv(4096):
+                        pass
+                except OSError:
+                    pass
+                self.close_connection = True
+
+            def _json(self, payload, status=200):
+                self._send(json.dumps(payload).encode('utf-8'), 'application/json', status)
+
+            def _send(self, body, content_type, status=200):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
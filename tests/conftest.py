@@ -0,0 +1,62 @@
+"""Shared fixtures for the test suite
+
+app.py reads API keys from config.py and Firebase credentials at import
+time. The tests never talk to Firebase or OpenAI, so both are replaced
+before the app is imported, and its on-disk state goes to a temp folder.
+"""
+import os
+import sys
+import tempfile
+import types
+from unittest import mock
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+STATE_DIR = tempfile.mkdtemp(prefix='codesign-tests-')
+os.environ.setdefault('SUBMISSIONS_DB', os.path.join(STATE_DIR, 'submissions.db'))
+os.environ.setdefault('RESULT_CACHE_DIR', os.path.join(STATE_DIR, 'result_cache'))
+os.environ.setdefault('COMFYUI_HEALTH_INTERVAL', '1')
+
+@pytest.fixture(scope='session')
+def codesign():
+    """The app module, imported once with Firebase and OpenAI kept offline"""
+    pytest.importorskip('firebase_admin')
+    pytest.importorskip('openai')
+    try:
+        import config  # noqa: F401
+    except ImportError:
+        # config.py is created per install from config.template.py
+        sys.modules['config'] = types.SimpleNamespace(config={
+            'OPENAI_API_KEY': 'test',
+            'HUGGING_FACE_API_KEY': 'test'
+        })
+    with mock.patch('firebase_admin.credentials.Certificate'), \
+            mock.patch('firebase_admin.initialize_app'), \
+            mock.patch('firebase_admin.db.reference'), \
+            mock.patch('firebase_admin.storage.bucket'):
+        import app
+    return app
+
+@pytest.fixture
+def start_comfyui():
+    """Starts stub ComfyUI servers on free local ports; all are stopped after the test"""
+    from comfyui_stub import StubComfyUI
+    servers = []
+
+    def start(**kwargs):
+        server = StubComfyUI(**kwargs)
+        server.start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
+
+@pytest.fixture
+def comfyui(start_comfyui):
+    """A stub ComfyUI server on a free local port"""
+    return start_comfyui()
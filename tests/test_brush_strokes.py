@@ -0,0 +1,55 @@
+import pytest
+
+SEGMENT = {'x': 120.5, 'y': 80, 'lastX': 110, 'lastY': 75.25, 'brushSize': 12, 'tool': 'brush',
+           'canvasWidth': 800, 'canvasHeight': 600, 'isFromModal': False}
+
+@pytest.mark.parametrize('changes', [
+    {'x': None},
+    {'lastX': 'left'},
+    {'y': float('nan')},
+    {'lastY': float('inf')},
+    {'brushSize': True},
+    {'canvasWidth': 800.5},
+    {'canvasWidth': None},
+    {'canvasHeight': 0},
+    {'canvasHeight': 70000},
+], ids=str)
+def test_invalid_segments_are_rejected(codesign, changes):
+    with pytest.raises(ValueError):
+        codesign.parse_brush_segment(dict(SEGMENT, **changes))
+
+def test_missing_fields_are_rejected(codesign):
+    for field in ('x', 'lastX', 'canvasWidth'):
+        segment = dict(SEGMENT)
+        del segment[field]
+        with pytest.raises(ValueError):
+            codesign.parse_brush_segment(segment)
+    with pytest.raises(ValueError):
+        codesign.parse_brush_segment(['not', 'a', 'segment'])
+
+def test_segment_is_coerced_to_wire_types(codesign):
+    segment = codesign.parse_brush_segment(dict(SEGMENT, canvasWidth=800.0, tool='spray', isFromModal=1, extra='x'))
+
+    assert segment == dict(SEGMENT, canvasWidth=800, tool='brush', isFromModal=True)
+    assert type(segment['canvasWidth']) is int
+    # Anything parse_brush_segment accepts can be packed
+    codesign.encode_segment(segment)
+
+def test_bad_segment_does_not_cost_the_room_its_frame(codesign):
+    sender = codesign.socketio.test_client(codesign.app)
+    receiver = codesign.socketio.test_client(codesign.app)
+    try:
+        receiver.get_received()
+        sender.emit('brush_stroke', dict(SEGMENT, canvasWidth=800.5))
+        sender.emit('brush_stroke', {'y': 1})
+        sender.emit('brush_stroke', SEGMENT)
+        codesign.stroke_aggregator.flush()
+
+        frames = [message['args'][0] for message in receiver.get_received() if message['name'] == 'brush_frame']
+        strokes = [codesign.decode_drawing_event(frame)['strokes'] if isinstance(frame, bytes) else frame['strokes']
+                   for frame in frames]
+        assert [len(points) for stroke_list in strokes for points in
+                (stroke['points'] for stroke in stroke_list)] == [4]
+    finally:
+        sender.disconnect()
+        receiver.disconnect()
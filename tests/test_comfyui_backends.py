@@ -0,0 +1,143 @@
+import hashlib
+
+import pytest
+
+CHECKPOINT = 'sd_xl_base_1.0.safetensors'
+
+@pytest.fixture
+def make_pool(codesign, monkeypatch):
+    def make(*servers):
+        pool = codesign.ComfyUIBackendPool([server.url for server in servers])
+        # Tests drive probes themselves with probe_all()
+        monkeypatch.setattr(pool, 'start', lambda: None)
+        return pool
+    return make
+
+def backend_for(pool, server):
+    return next(backend for backend in pool.backends if backend.url == server.url)
+
+def test_upload_is_content_addressed(codesign, comfyui):
+    uploader = codesign.ComfyUIUploader(comfyui.url)
+    data = b'\x89PNG image bytes'
+
+    name = uploader.upload(data, 'image', 'png')
+
+    digest = hashlib.sha256(data).hexdigest()
+    assert name == f"codesign/image_{digest[:32]}.png"
+    assert comfyui.uploads == [(f"image_{digest[:32]}.png", 'codesign', data)]
+
+def test_identical_uploads_are_deduplicated(codesign, comfyui):
+    uploader = codesign.ComfyUIUploader(comfyui.url)
+
+    first = uploader.upload(b'same bytes', 'mask')
+    second = uploader.upload(b'same bytes', 'mask')
+    uploader.upload(b'other bytes', 'mask')
+
+    assert first == second
+    assert len(comfyui.uploads) == 2
+    assert uploader.stats() == {'uploads': 2, 'deduplicated': 1, 'tracked': 2}
+
+def test_upload_failure_raises(codesign, comfyui):
+    comfyui.fail_requests = True
+    uploader = codesign.ComfyUIUploader(comfyui.url)
+
+    with pytest.raises(Exception, match="upload failed"):
+        uploader.upload(b'bytes')
+    assert uploader.stats()['tracked'] == 0
+
+def test_routes_to_least_loaded_backend(start_comfyui, make_pool):
+    busy, idle = start_comfyui(), start_comfyui()
+    busy.queue_pending = 3
+    pool = make_pool(busy, idle)
+    pool.probe_all()
+
+    backend = pool.acquire()
+
+    assert backend.url == idle.url
+    assert backend_for(pool, busy).queue_depth == 3
+
+def test_uploads_go_to_the_routed_backend(start_comfyui, make_pool):
+    first, second = start_comfyui(), start_comfyui()
+    first.queue_pending = 1
+    pool = make_pool(first, second)
+    pool.probe_all()
+
+    backend = pool.acquire()
+    backend.uploads.upload(b'image bytes')
+
+    assert [len(first.uploads), len(second.uploads)] == [0, 1]
+
+def test_skips_backends_without_the_checkpoint(start_comfyui, make_pool):
+    missing = start_comfyui(checkpoints=['other.safetensors'])
+    stocked = start_comfyui(checkpoints=[CHECKPOINT])
+    pool = make_pool(missing, stocked)
+    for backend in pool.backends:
+        backend.catalog.refresh()
+
+    for _ in range(3):
+        backend = pool.acquire(CHECKPOINT)
+        assert backend.url == stocked.url
+        pool.release(backend)
+
+def test_prefers_backend_with_checkpoint_warm(start_comfyui, make_pool):
+    pool = make_pool(start_comfyui(), start_comfyui())
+    pool.probe_all()
+
+    first = pool.acquire(CHECKPOINT)
+    pool.release(first)
+    second = pool.acquire(CHECKPOINT)
+
+    assert second is first
+    assert pool.affinity_hits == 1
+
+def test_failing_backend_is_ejected_and_readmitted(codesign, start_comfyui, make_pool):
+    flaky, healthy = start_comfyui(), start_comfyui()
+    pool = make_pool(flaky, healthy)
+    flaky.fail_requests = True
+
+    for _ in range(codesign.COMFYUI_EJECT_FAILURES):
+        pool.probe_all()
+
+    assert not backend_for(pool, flaky).healthy
+    for _ in range(3):
+        backend = pool.acquire()
+        assert backend.url == healthy.url
+        pool.release(backend)
+
+    flaky.fail_requests = False
+    for _ in range(codesign.COMFYUI_READMIT_SUCCESSES):
+        pool.probe_all()
+    assert backend_for(pool, flaky).healthy
+
+def test_failover_when_backend_goes_away(codesign, start_comfyui, make_pool):
+    gone, healthy = start_comfyui(), start_comfyui()
+    pool = make_pool(gone, healthy)
+    gone.stop()
+
+    # Network failures reported by jobs count the same as failed probes
+    for _ in range(codesign.COMFYUI_EJECT_FAILURES):
+        backend = backend_for(pool, gone)
+        pool.release(backend, failed=True, error=ConnectionError("refused"))
+
+    assert not backend_for(pool, gone).healthy
+    assert pool.acquire().url == healthy.url
+    assert pool.stats()['healthy'] == 1
+
+def test_no_healthy_backends(codesign, comfyui, make_pool):
+    pool = make_pool(comfyui)
+    comfyui.fail_requests = True
+    for _ in range(codesign.COMFYUI_EJECT_FAILURES):
+        pool.probe_all()
+
+    with pytest.raises(Exception, match="No healthy ComfyUI backends"):
+        pool.acquire()
+
+def test_find_prompt_asks_every_backend(start_comfyui, make_pool):
+    first, second = start_comfyui(), start_comfyui()
+    pool = make_pool(first, second)
+    second.finish_prompt('p1')
+
+    backend, state = pool.find_prompt('p1')
+
+    assert backend.url == second.url
+    assert state['status'] == 'completed'
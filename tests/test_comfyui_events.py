@@ -0,0 +1,86 @@
+import time
+
+import pytest
+
+def connected_listener(codesign, comfyui):
+    if codesign.websocket is None:
+        pytest.skip("websocket-client is not installed")
+    listener = codesign.ComfyUIEventListener(comfyui.url)
+    listener.start()
+    deadline = time.time() + 5
+    while not listener.connected and time.time() < deadline:
+        time.sleep(0.01)
+    assert listener.connected
+    assert comfyui.ws_connected.wait(5)
+    return listener
+
+def test_events_complete_prompt(codesign, comfyui):
+    listener = connected_listener(codesign, comfyui)
+    listener.track('p1')
+    comfyui.send_event('execution_start', {'prompt_id': 'p1'})
+    comfyui.send_event('progress', {'prompt_id': 'p1', 'value': 3, 'max': 20})
+    comfyui.send_event('executed', {'prompt_id': 'p1', 'node': 9, 'output': {'images': [{'filename': 'out.png'}]}})
+    comfyui.send_event('executing', {'prompt_id': 'p1', 'node': None})
+
+    state = listener.wait_for_prompt('p1', timeout=5)
+    assert state['status'] == 'completed'
+    assert state['progress'] == {'value': 3, 'max': 20}
+    assert state['outputs']['9']['images'][0]['filename'] == 'out.png'
+
+def test_execution_error_is_reported(codesign, comfyui):
+    listener = connected_listener(codesign, comfyui)
+    listener.track('p2')
+    comfyui.send_event('execution_error', {
+        'prompt_id': 'p2',
+        'node_id': '3',
+        'node_type': 'KSampler',
+        'exception_type': 'RuntimeError',
+        'exception_message': 'out of memory'
+    })
+
+    state = listener.wait_for_prompt('p2', timeout=5)
+    assert state['status'] == 'error'
+    assert state['error']['node_type'] == 'KSampler'
+    assert state['error']['message'] == 'out of memory'
+
+def test_missed_events_reconciled_from_history_while_connected(codesign, comfyui, monkeypatch):
+    monkeypatch.setattr(codesign, 'COMFYUI_HISTORY_RECONCILE_INTERVAL', 0.2)
+    listener = connected_listener(codesign, comfyui)
+    listener.track('p3')
+    # The prompt finishes without any event reaching the stream
+    comfyui.finish_prompt('p3')
+
+    started = time.time()
+    state = listener.wait_for_prompt('p3', timeout=10)
+    assert state['status'] == 'completed'
+    assert '9' in state['outputs']
+    assert time.time() - started < 2
+
+def test_history_polled_while_stream_is_down(codesign, comfyui):
+    listener = codesign.ComfyUIEventListener(comfyui.url)
+    listener.track('p4')
+    comfyui.finish_prompt('p4')
+
+    state = listener.wait_for_prompt('p4', timeout=5)
+    assert state['status'] == 'completed'
+
+def test_wait_times_out(codesign, comfyui, monkeypatch):
+    monkeypatch.setattr(codesign, 'COMFYUI_HISTORY_RECONCILE_INTERVAL', 0.1)
+    listener = connected_listener(codesign, comfyui)
+    listener.track('p5')
+
+    with pytest.raises(Exception, match="Timeout"):
+        listener.wait_for_prompt('p5', timeout=0.5)
+
+def test_reconnect_reconciles_in_flight_prompts(codesign, comfyui):
+    listener = connected_listener(codesign, comfyui)
+    listener.track('p6')
+    comfyui.disconnect_events()
+    comfyui.finish_prompt('p6')
+
+    # The listener reconnects after its backoff and checks /history for prompts still in flight
+    assert comfyui.ws_connected.wait(5)
+    deadline = time.time() + 5
+    while listener.get_state('p6')['status'] != 'completed' and time.time() < deadline:
+        time.sleep(0.05)
+    assert listener.get_state('p6')['status'] == 'completed'
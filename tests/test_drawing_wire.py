@@ -0,0 +1,129 @@
+import json
+import os
+import shutil
+import subprocess
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'drawing_wire.json')
+# script.js's codec runs in node against the same fixture; the decoder names users through these maps
+JS_HARNESS = """
+const userIdsByIndex = new Map([[3, 'user-3'], [7, 'user-7']]);
+const connectedUserColors = new Map([['user-3', '#FF0000'], ['user-7', '#00FF00']]);
+const cases = JSON.parse(require('fs').readFileSync(0, 'utf8'));
+const fromHex = (hex) => {
+    const bytes = Buffer.from(hex, 'hex');
+    return bytes.buffer.slice(bytes.byteOffset, bytes.byteOffset + bytes.length);
+};
+console.log(JSON.stringify(cases.map((c) => c.type === 'brush_stroke'
+    ? { name: c.name, hex: Buffer.from(encodeBrushSegment(c.event)).toString('hex') }
+    : { name: c.name, decoded: decodeDrawingEvent(fromHex(c.hex)) })));
+"""
+
+with open(FIXTURE) as f:
+    CASES = json.load(f)
+
+def encode(codesign, case):
+    event = case['event']
+    if case['type'] == 'brush_stroke':
+        return codesign.encode_segment(event)
+    if case['type'] == 'brush_frame':
+        return codesign.encode_stroke_frame(event['strokes'])
+    if case['type'] == 'user_drawing':
+        return codesign.encode_user_drawing(event['user_index'], event['is_drawing'])
+    return codesign.encode_mask_cleared(event['user_index'])
+
+def assert_coordinates_close(decoded, expected, extents):
+    # Coordinates travel as uint16 fractions of the canvas, so they come back within one step
+    for index, (value, original) in enumerate(zip(decoded, expected)):
+        extent = extents[index % 2]
+        assert abs(value - min(max(original, 0), extent)) <= extent / 65535 + 0.01
+
+@pytest.mark.parametrize('case', CASES, ids=[case['name'] for case in CASES])
+def test_python_encoder_matches_fixture(codesign, case):
+    assert encode(codesign, case).hex() == case['hex']
+
+@pytest.mark.parametrize('case', CASES, ids=[case['name'] for case in CASES])
+def test_round_trip(codesign, case):
+    event = case['event']
+    decoded = codesign.decode_drawing_event(encode(codesign, case))
+    assert decoded['type'] == case['type']
+    if case['type'] == 'brush_stroke':
+        for field in ('brushSize', 'tool', 'canvasWidth', 'canvasHeight', 'isFromModal'):
+            assert decoded[field] == event[field]
+        extents = (event['canvasWidth'], event['canvasHeight'])
+        assert_coordinates_close([decoded[key] for key in ('x', 'y', 'lastX', 'lastY')],
+                                 [event[key] for key in ('x', 'y', 'lastX', 'lastY')], extents)
+    elif case['type'] == 'brush_frame':
+        assert len(decoded['strokes']) == len(event['strokes'])
+        for stroke, original in zip(decoded['strokes'], event['strokes']):
+            for field in ('user_index', 'brushSize', 'tool', 'canvasWidth', 'canvasHeight', 'isFromModal'):
+                assert stroke[field] == original[field]
+            assert_coordinates_close(stroke['points'], original['points'],
+                                     (original['canvasWidth'], original['canvasHeight']))
+    else:
+        assert {key: value for key, value in decoded.items() if key != 'type'} == event
+
+def test_coordinates_outside_canvas_are_clamped(codesign):
+    segment = {'x': -40, 'y': 900, 'lastX': 10, 'lastY': 10, 'brushSize': 5,
+               'canvasWidth': 800, 'canvasHeight': 600}
+    decoded = codesign.decode_drawing_event(codesign.encode_segment(segment))
+    assert decoded['x'] == 0
+    assert decoded['y'] == 600
+
+def test_unknown_version_and_type_are_rejected(codesign):
+    with pytest.raises(ValueError, match="version"):
+        codesign.decode_drawing_event(bytes([99, codesign.WIRE_SEGMENT]) + bytes(15))
+    with pytest.raises(ValueError, match="type"):
+        codesign.decode_drawing_event(bytes([codesign.DRAWING_WIRE_VERSION, 42]))
+
+@pytest.mark.skipif(shutil.which('node') is None, reason="node is not installed")
+def test_script_js_codec_matches_fixture(codesign):
+    with open(os.path.join(ROOT, 'script.js'), encoding='utf-8') as f:
+        script = f.read()
+    start = script.index('const DRAWING_WIRE_VERSION')
+    end = script.index('function decodeDrawingEvent')
+    end = script.index('\n}\n', end) + 3
+    result = subprocess.run(['node', '-e', script[start:end] + JS_HARNESS], input=json.dumps(CASES),
+                            capture_output=True, text=True, timeout=30, check=True)
+    by_name = {case['name']: case for case in CASES}
+    for output in json.loads(result.stdout):
+        case = by_name[output['name']]
+        if case['type'] == 'brush_stroke':
+            assert output['hex'] == case['hex']
+            continue
+        expected = codesign.decode_drawing_event(bytes.fromhex(case['hex']))
+        decoded = output['decoded']
+        if case['type'] == 'brush_frame':
+            for stroke, python_stroke in zip(decoded['strokes'], expected['strokes']):
+                assert stroke['user_id'] == f"user-{python_stroke['user_index']}"
+                for field in ('brushSize', 'tool', 'canvasWidth', 'canvasHeight', 'isFromModal'):
+                    assert stroke[field] == python_stroke[field]
+                assert stroke['points'] == pytest.approx(python_stroke['points'], abs=0.01)
+        else:
+            assert decoded['user_id'] == f"user-{expected['user_index']}"
+            if case['type'] == 'user_drawing':
+                assert decoded['is_drawing'] == expected['is_drawing']
+
+def test_users_without_an_index_fall_back_to_json_frames(codesign, monkeypatch):
+    users = codesign.MemoryPresenceStore()
+    users['indexed'] = {'color': '#FF0000', 'brush_size': 5, 'connected_at': '', 'room': 'r', 'index': 0}
+    users['unindexed'] = {'color': '#00FF00', 'brush_size': 5, 'connected_at': '', 'room': 'r', 'index': None}
+    monkeypatch.setattr(codesign, 'connected_users', users)
+    sent = []
+    monkeypatch.setattr(codesign.socketio, 'emit', lambda event, payload, **kwargs: sent.append(payload))
+    aggregator = codesign.StrokeAggregator(25)
+    monkeypatch.setattr(aggregator, 'start', lambda: None)
+    segment = {'x': 20, 'y': 20, 'lastX': 10, 'lastY': 10, 'brushSize': 5, 'tool': 'brush',
+               'canvasWidth': 800, 'canvasHeight': 600, 'isFromModal': False}
+    for user_id, color in (('indexed', '#FF0000'), ('unindexed', '#00FF00'), ('gone', '#0000FF')):
+        aggregator.add('r', user_id, color, segment, recipients=2)
+
+    aggregator.flush()
+
+    binary = [frame for frame in sent if isinstance(frame, bytes)]
+    fallback = [frame for frame in sent if isinstance(frame, dict)]
+    assert [stroke['user_index'] for stroke in codesign.decode_drawing_event(binary[0])['strokes']] == [0]
+    assert [stroke['user_id'] for stroke in fallback[0]['strokes']] == ['unindexed']
+    assert len(sent) == 2
@@ -0,0 +1,88 @@
+import base64
+import threading
+import time
+
+import pytest
+
+PNG = bytes.fromhex('89504e470d0a1a0a0000000d49484452000000010000000108060000001f15c4890000000d4944415478da63f8cfc0f01f0005000201a5e2c1c90000000049454e44ae426082')
+
+class Workflow:
+    """Stands in for process_workflow; jobs block until released, then succeed or raise error"""
+
+    def __init__(self):
+        self.released = threading.Event()
+        self.error = None
+
+    def __call__(self, image_data, mask_data, *args, **kwargs):
+        self.released.wait(5)
+        if self.error:
+            raise Exception(self.error)
+        return {'image': b'generated'}
+
+@pytest.fixture
+def workflow(codesign, monkeypatch):
+    """A one-worker, one-slot generation queue running a stand-in workflow"""
+    workflow = Workflow()
+    jobs = codesign.GenerationJobQueue(1, 1)
+    monkeypatch.setattr(codesign, 'process_workflow', workflow)
+    monkeypatch.setattr(codesign, 'generation_queue', jobs)
+    yield workflow
+    # Drain before process_workflow is restored, so no job reaches the real one
+    workflow.released.set()
+    deadline = time.time() + 5
+    while time.time() < deadline and (jobs.stats()['queue_depth'] or jobs.stats()['busy_workers']):
+        time.sleep(0.01)
+
+@pytest.fixture
+def client(codesign):
+    return codesign.app.test_client()
+
+def post(client, address='127.0.0.1', **fields):
+    body = {'image': base64.b64encode(PNG).decode('ascii'), 'mask': base64.b64encode(PNG).decode('ascii'), **fields}
+    return client.post('/api/process', json=body, environ_base={'REMOTE_ADDR': address})
+
+def wait_for_status(client, job_id, *statuses):
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        job = client.get(f'/api/jobs/{job_id}').get_json()
+        if job['status'] in statuses:
+            return job
+        time.sleep(0.01)
+    pytest.fail(f"job {job_id} never reached {statuses}")
+
+def test_process_returns_before_the_job_runs(client, workflow):
+    response = post(client, prompt='a bench')
+
+    assert response.status_code == 202
+    job_id = response.get_json()['job_id']
+    wait_for_status(client, job_id, 'running')
+
+    workflow.released.set()
+    job = wait_for_status(client, job_id, 'completed')
+    assert base64.b64decode(job['result']['image']) == b'generated'
+    assert job['wait_seconds'] >= 0 and job['run_seconds'] >= 0
+
+def test_full_queue_is_rejected(client, workflow):
+    # Separate clients, so none of these jobs supersedes another
+    running = post(client, '10.0.0.1').get_json()['job_id']
+    wait_for_status(client, running, 'running')
+    queued = post(client, '10.0.0.2')
+
+    rejected = post(client, '10.0.0.3')
+
+    assert queued.status_code == 202
+    assert rejected.status_code == 503
+    status = client.get('/api/queue-status').get_json()
+    assert (status['queue_depth'], status['busy_workers'], status['rejected']) == (1, 1, 1)
+
+def test_failed_job_reports_its_error(client, workflow):
+    workflow.error = "ComfyUI is down"
+    workflow.released.set()
+
+    job = wait_for_status(client, post(client).get_json()['job_id'], 'failed')
+
+    assert job['error'] == "ComfyUI is down"
+    assert client.get('/api/queue-status').get_json()['failed'] == 1
+
+def test_unknown_job_is_404(client):
+    assert client.get('/api/jobs/missing').status_code == 404
@@ -0,0 +1,86 @@
+import base64
+import io
+
+import pytest
+
+PNG = bytes.fromhex('89504e470d0a1a0a0000000d49484452000000010000000108060000001f15c4890000000d4944415478da63f8cfc0f01f0005000201a5e2c1c90000000049454e44ae426082')
+
+@pytest.fixture
+def queued(codesign, monkeypatch):
+    """Options of every job handed to the generation queue"""
+    jobs = []
+
+    def submit(*args, **kwargs):
+        jobs.append(kwargs)
+        return f"job-{len(jobs)}"
+    monkeypatch.setattr(codesign.generation_queue, 'submit', submit)
+    return jobs
+
+@pytest.fixture
+def client(codesign):
+    return codesign.app.test_client()
+
+def post_json(client, **fields):
+    body = {'image': base64.b64encode(PNG).decode('ascii'), 'mask': base64.b64encode(PNG).decode('ascii'), **fields}
+    return client.post('/api/process', json=body)
+
+def post_binary(client, **fields):
+    data = {'image': (io.BytesIO(PNG), 'image.png'), 'mask': (io.BytesIO(PNG), 'mask.png'), **fields}
+    return client.post('/api/process-binary', data=data, content_type='multipart/form-data')
+
+@pytest.mark.parametrize('post', [post_json, post_binary])
+@pytest.mark.parametrize('fields', [{'variants': 'many'}, {'variants': '2.5'}, {'seed': 'random', 'deterministic': 'true'}])
+def test_non_numeric_options_are_rejected(client, queued, post, fields):
+    response = post(client, **fields)
+    assert response.status_code == 400
+    assert 'whole numbers' in response.get_json()['error']
+    assert queued == []
+
+@pytest.mark.parametrize('post', [post_json, post_binary])
+@pytest.mark.parametrize('requested, expected', [('0', 1), ('3', 3), ('99', None), ('', 1)])
+def test_variants_are_clamped(codesign, client, queued, post, requested, expected):
+    response = post(client, variants=requested)
+    assert response.status_code == 202
+    assert queued[-1]['variants'] == (expected or codesign.MAX_VARIANTS)
+
+def test_deterministic_request_uses_the_requested_seed(codesign, client, queued):
+    response = post_json(client, seed='42', deterministic='true')
+    assert response.status_code == 202
+    assert queued[-1]['seed'] == 42
+    assert queued[-1]['cache_keys']
+
+def test_job_image_index_must_be_numeric(client):
+    assert client.get('/api/jobs/unknown/image?index=first').status_code == 400
+    assert client.get('/api/jobs/unknown/image?index=-1').status_code == 404
+
+@pytest.mark.parametrize('variants', ['1', '2'])
+def test_binary_cache_hit_links_raw_images(codesign, client, queued, monkeypatch, variants):
+    def get_many(keys):
+        # Serve a hit, and store the images under the keys the request asked for
+        for key in keys:
+            codesign.result_cache.put(key, PNG)
+        return [{'image_url': None, 'image': PNG} for _ in keys]
+    monkeypatch.setattr(codesign.result_cache, 'get_many', get_many)
+
+    response = post_binary(client, deterministic='true', variants=variants)
+
+    body = response.get_json()
+    assert response.status_code == 200 and body['cached']
+    assert 'image' not in body['result'] and 'images' not in body['result']
+    paths = body['result'].get('image_paths', [body['result']['image_path']])
+    assert len(paths) == int(variants)
+    for path in paths:
+        image = client.get(path)
+        assert image.mimetype == 'image/png'
+        assert image.data == PNG
+    assert queued == []
+
+def test_json_cache_hit_still_inlines_base64(codesign, client, queued, monkeypatch):
+    monkeypatch.setattr(codesign.result_cache, 'get_many', lambda keys: [{'image_url': None, 'image': PNG}])
+
+    body = post_json(client, deterministic='true').get_json()
+
+    assert base64.b64decode(body['result']['image']) == PNG
+
+def test_unknown_cached_image(client):
+    assert client.get('/api/result-cache/missing').status_code == 404
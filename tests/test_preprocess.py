@@ -0,0 +1,76 @@
+import io
+
+from PIL import Image, ImageDraw
+
+def png_bytes(image):
+    output = io.BytesIO()
+    image.save(output, format='PNG')
+    return output.getvalue()
+
+def stroke_mask(size, box):
+    mask = Image.new('RGBA', size, (0, 0, 0, 0))
+    ImageDraw.Draw(mask).rectangle(box, fill=(0, 0, 255, 26))
+    return mask
+
+def test_small_mask_is_cropped_with_padding(codesign):
+    coverage = stroke_mask((2000, 1500), (900, 700, 949, 749)).getchannel('A')
+
+    box = codesign.mask_crop_box(coverage, padding=64, min_size=256)
+
+    assert box == (797, 597, 1053, 853)
+
+def test_crop_is_skipped_when_the_box_covers_most_of_the_frame(codesign):
+    coverage = stroke_mask((800, 600), (100, 200, 500, 500)).getchannel('A')
+
+    assert codesign.mask_crop_box(coverage, padding=64, min_size=512, max_area=0.5) is None
+    assert codesign.mask_crop_box(coverage, padding=64, min_size=512, max_area=0.6) == (36, 88, 565, 600)
+
+def test_large_mask_keeps_the_png_passthrough(codesign):
+    image_data = png_bytes(Image.new('RGB', (800, 600), (10, 120, 200)))
+    mask_data = png_bytes(stroke_mask((800, 600), (100, 200, 500, 500)))
+
+    image_bytes, _, extension, crop, _ = codesign.preprocess_images(
+        image_data, mask_data, output_format='png', crop_to_mask=True)
+
+    assert crop is None
+    assert image_bytes is image_data
+    assert extension == 'png'
+
+def preprocess(codesign, image, mask, **kwargs):
+    image_bytes, mask_bytes, extension, _, timings = codesign.preprocess_images(
+        png_bytes(image), png_bytes(mask), **kwargs)
+    return Image.open(io.BytesIO(image_bytes)), Image.open(io.BytesIO(mask_bytes)), extension, timings
+
+def test_image_and_mask_come_out_the_same_size(codesign):
+    image = Image.new('RGB', (1600, 1200), (10, 120, 200))
+    # A mask exported at a different resolution is forced onto the image's size
+    mask = stroke_mask((800, 600), (100, 100, 200, 200))
+
+    image, mask, _, _ = preprocess(codesign, image, mask, output_format='png')
+
+    assert image.size == mask.size == (1024, 768)
+
+def test_translucent_strokes_become_a_binary_mask(codesign):
+    mask = stroke_mask((800, 600), (100, 100, 199, 199))
+
+    _, mask, _, _ = preprocess(codesign, Image.new('RGB', (800, 600)), mask, output_format='png')
+
+    assert mask.mode == 'L'
+    assert {value for _, value in mask.getcolors()} == {0, 255}
+    assert mask.getbbox() == (100, 100, 200, 200)
+
+def test_webp_output_is_lossless(codesign):
+    original = Image.effect_noise((800, 600), 64).convert('RGB')
+
+    image, mask, extension, _ = preprocess(codesign, original, stroke_mask((800, 600), (10, 10, 20, 20)),
+                                           output_format='webp')
+
+    assert extension == 'webp'
+    assert image.format == mask.format == 'WEBP'
+    assert image.convert('RGB').tobytes() == original.tobytes()
+
+def test_timings_cover_every_step(codesign):
+    _, _, _, timings = preprocess(codesign, Image.new('RGB', (1600, 1200)),
+                                  stroke_mask((1600, 1200), (0, 0, 10, 10)), output_format='png')
+
+    assert set(timings) == {'decode', 'convert', 'resize', 'binarize', 'encode', 'total'}
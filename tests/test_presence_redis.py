@@ -0,0 +1,168 @@
+"""RedisPresenceStore as two server processes see it, sharing one (fake) Redis"""
+import threading
+
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+
+@pytest.fixture
+def stores(codesign):
+    if codesign.redis is None:
+        pytest.skip("redis is not installed")
+    server = fakeredis.FakeServer()
+
+    def worker():
+        return codesign.RedisPresenceStore('redis://fake', prefix='test',
+                                           client=fakeredis.FakeRedis(server=server, decode_responses=True))
+    return worker(), worker()
+
+def connect(store, sid, room, color='#FF0000'):
+    store[sid] = {'color': color, 'brush_size': 5, 'connected_at': '', 'room': None, 'index': None}
+    store.join(room, sid)
+    store.update_user(sid, room=room, index=store.claim_index(room, sid))
+    return store[sid]['index']
+
+def test_workers_share_users_and_rooms(stores):
+    first, second = stores
+    connect(first, 'a', 'main')
+    connect(second, 'b', 'main')
+    connect(second, 'c', 'other')
+
+    for store in stores:
+        assert set(store.room_users('main')) == {'a', 'b'}
+        assert store.sessions() == {'main': 2, 'other': 1}
+        assert len(store) == 3
+    assert second['a']['color'] == '#FF0000'
+
+def test_indexes_are_unique_across_workers(stores):
+    first, second = stores
+    indexes = [connect(first if n % 2 else second, f'user-{n}', 'main') for n in range(10)]
+    assert sorted(indexes) == list(range(10))
+
+def test_updates_are_seen_by_the_other_worker(stores):
+    first, second = stores
+    connect(first, 'a', 'main')
+    first.update_user('a', brush_size=12)
+    assert second['a']['brush_size'] == 12
+
+def test_disconnect_removes_user_everywhere(stores):
+    first, second = stores
+    index = connect(first, 'a', 'main')
+    first.leave('main', 'a')
+    first.release_index('main', index, 'a')
+    del first['a']
+
+    assert 'a' not in second
+    assert second.sessions() == {}
+
+def test_published_events_reach_every_worker(stores):
+    first, second = stores
+    received = []
+    arrived = threading.Event()
+
+    def on_mask(message):
+        received.append(message)
+        arrived.set()
+
+    second.subscribe('mask', on_mask)
+    first.publish('mask', {'room': 'main', 'clear': True})
+
+    assert arrived.wait(5)
+    assert received == [{'room': 'main', 'clear': True}]
+
+def test_users_of_a_crashed_worker_are_reaped(stores):
+    crashed, survivor = stores
+    index = connect(crashed, 'ghost', 'main')
+    connect(survivor, 'alive', 'main')
+    # The crashed process stops heartbeating and its key expires
+    survivor.client.delete(survivor._key('process', crashed.process_id))
+
+    assert survivor.reap() == [('ghost', 'main', index)]
+    assert set(survivor.room_users('main')) == {'alive'}
+    assert 'ghost' not in survivor
+    assert len(survivor) == 1
+    # The ghost's index can be handed out again
+    assert survivor.claim_index('main', 'newcomer') == index
+
+def test_live_workers_are_not_reaped(stores):
+    first, second = stores
+    connect(first, 'a', 'main')
+    connect(second, 'b', 'main')
+    first.heartbeat()
+
+    assert second.reap() == []
+    assert first.reap() == []
+    assert len(first) == 2
+
+def test_each_ghost_is_reaped_once(codesign, stores):
+    crashed, survivor = stores
+    third = codesign.RedisPresenceStore('redis://fake', prefix='test', client=survivor.client)
+    connect(crashed, 'ghost', 'main')
+    survivor.client.delete(survivor._key('process', crashed.process_id))
+
+    reaped = survivor.reap() + third.reap()
+
+    assert [sid for sid, _, _ in reaped] == ['ghost']
+
+def test_empty_room_is_dropped_when_its_last_user_is_reaped(stores):
+    crashed, survivor = stores
+    connect(crashed, 'ghost', 'lonely')
+    survivor.client.delete(survivor._key('process', crashed.process_id))
+
+    survivor.reap()
+
+    assert survivor.sessions() == {}
+
+def mask_event(n, x0, x1, tool='brush'):
+    return {'room': 'main', 'user_id': 'a', 'color': '#FF0000', 'id': f'event-{n}',
+            'segment': {'lastX': x0, 'lastY': 50, 'x': x1, 'y': 50, 'brushSize': 4, 'tool': tool,
+                        'isFromModal': False, 'canvasWidth': 100, 'canvasHeight': 100}}
+
+def draw(store, masks, event):
+    """Log and publish an event as publish_mask_event does, delivering it to the running worker"""
+    store.publish_logged('mask', 'mask:main', event, reset=bool(event.get('clear')))
+    masks.apply_event(event)
+
+@pytest.fixture
+def masks(codesign, stores):
+    if codesign.np is None:
+        pytest.skip("numpy is not installed")
+    return [codesign.SharedMaskStore(100, 50, store) for store in stores]
+
+def test_late_worker_rebuilds_the_mask_from_the_shared_log(stores, masks):
+    running, late = masks
+    draw(stores[0], running, mask_event(1, 10, 40))
+    draw(stores[0], running, {'room': 'main', 'clear': True, 'id': 'event-2'})
+    draw(stores[0], running, mask_event(3, 10, 40))
+    draw(stores[0], running, mask_event(4, 20, 30, tool='eraser'))
+
+    assert 'main' not in late.rooms
+    late.state('main')
+
+    assert (late.rooms['main']['raster'] == running.rooms['main']['raster']).all()
+    assert late.rooms['main']['raster'][50, 15] == 255 and late.rooms['main']['raster'][50, 25] == 0
+
+def test_compacted_log_still_rebuilds_the_mask(stores, masks):
+    running, late = masks
+    for n in range(5):
+        draw(stores[0], running, mask_event(n, 10 + n * 10, 20 + n * 10))
+    assert running.compact('main')
+    draw(stores[0], running, mask_event(5, 30, 60, tool='eraser'))
+
+    snapshot, events = stores[1].read_log('mask:main')
+
+    assert snapshot['last_id'] == 'event-4' and [event['id'] for event in events] == ['event-5']
+    late.state('main')
+    assert (late.rooms['main']['raster'] == running.rooms['main']['raster']).all()
+
+def test_events_already_in_the_log_are_not_applied_twice(stores, masks):
+    running, late = masks
+    draw(stores[0], running, mask_event(1, 10, 40))
+    late.state('main')
+    seq = late.rooms['main']['seq']
+
+    # Pub/sub delivers the event the log already held, then a new one
+    late.apply_event(mask_event(1, 10, 40))
+    late.apply_event(mask_event(2, 50, 60))
+
+    assert late.rooms['main']['seq'] == seq + 1
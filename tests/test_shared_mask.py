@@ -0,0 +1,68 @@
+import io
+import threading
+
+import pytest
+from PIL import Image
+
+def segment(x0, y0, x1, y1, tool='brush'):
+    return {'lastX': x0, 'lastY': y0, 'x': x1, 'y': y1, 'brushSize': 4, 'tool': tool, 'isFromModal': False,
+            'canvasWidth': 100, 'canvasHeight': 100}
+
+@pytest.fixture
+def store(codesign):
+    if codesign.np is None:
+        pytest.skip("numpy is not installed")
+    return codesign.SharedMaskStore(100, 50)
+
+def pixels(snapshot):
+    return Image.open(io.BytesIO(snapshot)).convert('L')
+
+def test_late_joiner_gets_snapshot_then_tail(store):
+    store.apply_segment('main', 'a', '#FF0000', segment(10, 10, 20, 10))
+    first = store.state('main')
+    store.apply_segment('main', 'a', '#FF0000', segment(20, 10, 30, 10))
+
+    second = store.state('main')
+
+    assert pixels(first['snapshot']).getpixel((15, 10)) == 255
+    assert second['snapshot'] == first['snapshot']
+    assert (second['snapshot_seq'], second['seq']) == (1, 2)
+    assert [stroke['points'] for stroke in second['strokes']] == [[20, 10, 30, 10]]
+
+def test_strokes_are_applied_while_a_snapshot_encodes(codesign, store, monkeypatch):
+    store.apply_segment('main', 'a', '#FF0000', segment(10, 10, 20, 10))
+    encode = codesign.SharedMaskStore._encode
+
+    def encode_while_drawing(raster):
+        # Another client draws on a separate thread; it must not wait for the encode
+        drawer = threading.Thread(target=store.apply_segment,
+                                  args=('main', 'b', '#00FF00', segment(50, 50, 60, 60)))
+        drawer.start()
+        drawer.join(5)
+        assert not drawer.is_alive()
+        return encode(raster)
+    monkeypatch.setattr(codesign.SharedMaskStore, '_encode', staticmethod(encode_while_drawing))
+
+    state = store.state('main')
+
+    # The snapshot is the raster as copied; the stroke drawn meanwhile comes as the tail
+    assert pixels(state['snapshot']).getpixel((55, 55)) == 0
+    assert (state['snapshot_seq'], state['seq']) == (1, 2)
+    assert [stroke['user_id'] for stroke in state['strokes']] == ['b']
+
+def test_clear_during_encode_keeps_the_stale_snapshot_out(codesign, store, monkeypatch):
+    store.apply_segment('main', 'a', '#FF0000', segment(10, 10, 20, 10))
+    encode = codesign.SharedMaskStore._encode
+
+    def encode_then_clear(raster):
+        snapshot = encode(raster)
+        store.clear('main')
+        return snapshot
+    monkeypatch.setattr(codesign.SharedMaskStore, '_encode', staticmethod(encode_then_clear))
+    store.state('main')
+    monkeypatch.setattr(codesign.SharedMaskStore, '_encode', staticmethod(encode))
+
+    state = store.state('main')
+
+    assert pixels(state['snapshot']).getpixel((15, 10)) == 0
+    assert state['strokes'] == []
@@ -0,0 +1,68 @@
+import pytest
+
+@pytest.fixture
+def probes(codesign, monkeypatch):
+    """frame_sync probes sent, as [sid, frames sent, ack callback]"""
+    sent = []
+
+    def emit(event, payload, to=None, callback=None, **kwargs):
+        assert event == 'frame_sync'
+        sent.append([to, payload, callback])
+    monkeypatch.setattr(codesign.socketio, 'emit', emit)
+    return sent
+
+@pytest.fixture
+def limiter(codesign, monkeypatch):
+    limiter = codesign.SocketEventLimiter({}, slow_backlog=4, ack_every=2)
+    monkeypatch.setattr(limiter, 'start', lambda: None)
+    return limiter
+
+def test_backlog_counts_unacknowledged_frames(limiter, probes):
+    limiter.frames_sent('room', {'a', 'b'}, ['b'])
+    assert probes == [] and limiter.backlog('a') is None
+
+    limiter.frames_sent('room', {'a', 'b'}, ['b'])
+    [[sid, covered, ack]] = probes
+    assert (sid, covered) == ('a', 2)
+    limiter.frames_sent('room', {'a', 'b'}, [], count=3)
+    ack(covered)
+
+    assert limiter.backlog('a') == 3
+    assert limiter.backlog('b') is None
+
+def test_slow_consumer_is_paused_until_it_acknowledges(codesign, limiter, probes, monkeypatch):
+    resent = []
+    monkeypatch.setattr(codesign, 'emit_mask_state', lambda room, to: resent.append(to))
+    limiter.frames_sent('room', {'a'}, [], count=2)
+    probes.pop()[2]()
+    limiter.frames_sent('room', {'a'}, [], count=6)
+
+    assert limiter.slow_consumers('room', {'a'}) == ['a']
+    limiter._release_recovered()
+    assert resent == []
+
+    # The probe sent while paused is acknowledged once the client has caught up
+    probes[-1][2]()
+    limiter._release_recovered()
+
+    assert resent == ['a']
+    assert limiter.slow_consumers('room', {'a'}) == []
+
+def test_clients_that_left_the_room_are_dropped(limiter, probes):
+    limiter.frames_sent('room', {'a', 'b'}, [])
+    limiter.frames_sent('room', {'a'}, [])
+
+    assert set(limiter.frames) == {'a'}
+
+@pytest.mark.parametrize('size', [0, -3, 10000, 2.5, True, '7', None])
+def test_invalid_brush_size_is_ignored(codesign, size):
+    client = codesign.socketio.test_client(codesign.app)
+    try:
+        user_id = codesign.socketio.server.manager.sid_from_eio_sid(client.eio_sid, '/')
+        client.emit('update_brush_size', {'size': 7})
+        client.emit('update_brush_size', {'size': size})
+        client.emit('update_brush_size', size)
+
+        assert codesign.connected_users[user_id]['brush_size'] == 7
+    finally:
+        client.disconnect()
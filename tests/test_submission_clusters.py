@@ -0,0 +1,79 @@
+import csv
+
+import pytest
+
+@pytest.fixture
+def store(codesign, tmp_path):
+    csv_path = tmp_path / 'submissions.csv'
+    with open(csv_path, 'w', newline='') as f:
+        csv.writer(f).writerow(codesign.SUBMISSION_CSV_HEADERS)
+    return codesign.SubmissionStore(str(tmp_path / 'submissions.db'), str(csv_path))
+
+def append(store, *locations):
+    with open(store.csv_path, 'a', newline='') as f:
+        writer = csv.writer(f)
+        for lat, lng in locations:
+            writer.writerow(['t', lat, lng, '', '', '', '', 1, 2, 3, 4])
+
+def total(index, zoom=2):
+    return sum(cluster['count'] for cluster in index.clusters(zoom)[1])
+
+def test_new_rows_are_added_without_a_rebuild(codesign, store, monkeypatch):
+    append(store, (51.5, -0.12), (48.85, 2.35))
+    index = codesign.SubmissionClusterIndex(range(5), 64)
+    index.refresh(store)
+    monkeypatch.setattr(store, 'count', lambda: pytest.fail("refresh must not count the whole table"))
+    requested = []
+    points_after = store.points_after
+    monkeypatch.setattr(store, 'points_after', lambda last_id: requested.append(last_id) or points_after(last_id))
+
+    append(store, (40.7, -74.0))
+    index.refresh(store)
+    index.refresh(store)
+
+    assert requested == [2, 3]
+    assert total(index) == index.count == 3
+
+def test_rows_inserted_during_refresh_are_picked_up_next_time(codesign, store, monkeypatch):
+    append(store, (51.5, -0.12))
+    index = codesign.SubmissionClusterIndex(range(5), 64)
+    index.refresh(store)
+    points_after = store.points_after
+
+    def points_then_insert(last_id):
+        points = points_after(last_id)
+        # Another writer appends after the rows were read
+        append(store, (35.7, 139.7))
+        return points
+    monkeypatch.setattr(store, 'points_after', points_then_insert)
+    index.refresh(store)
+    monkeypatch.setattr(store, 'points_after', points_after)
+    index.refresh(store)
+
+    assert total(index) == 2
+
+def test_replaced_csv_rebuilds_the_index(codesign, store):
+    append(store, (51.5, -0.12), (48.85, 2.35), (40.7, -74.0))
+    index = codesign.SubmissionClusterIndex(range(5), 64)
+    index.refresh(store)
+
+    with open(store.csv_path, 'w', newline='') as f:
+        csv.writer(f).writerow(codesign.SUBMISSION_CSV_HEADERS)
+    append(store, (-33.9, 151.2))
+    index.refresh(store)
+
+    assert total(index) == 1
+    [cluster] = index.clusters(2)[1]
+    assert (cluster['lat'], cluster['lng']) == (-33.9, 151.2)
+
+def test_invalidate_forces_a_rebuild(codesign, store):
+    append(store, (51.5, -0.12))
+    index = codesign.SubmissionClusterIndex(range(5), 64)
+    index.refresh(store)
+    index.add(999, 0, 0)
+    assert total(index) == 2
+
+    index.invalidate()
+    index.refresh(store)
+
+    assert total(index) == 1
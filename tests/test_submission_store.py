@@ -0,0 +1,82 @@
+import csv
+import threading
+
+import pytest
+
+@pytest.fixture
+def store(codesign, tmp_path):
+    csv_path = tmp_path / 'submissions.csv'
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(codesign.SUBMISSION_CSV_HEADERS)
+        for n in range(5):
+            writer.writerow([f't{n}', n, n, '', f'subject {n}', '', '', 1, 2, 3, 4])
+    return codesign.SubmissionStore(str(tmp_path / 'submissions.db'), str(csv_path), connections=2)
+
+def test_statements_run_off_the_calling_thread(codesign, store, monkeypatch):
+    calls = []
+
+    def run_blocking(func, *args, **kwargs):
+        calls.append(func)
+        return func(*args, **kwargs)
+    monkeypatch.setattr(codesign, 'run_blocking', run_blocking)
+
+    submissions, total = store.query(limit=2, search='subject 3')
+
+    assert total == 1 and submissions[0]['prompts']['mainSubject'] == 'subject 3'
+    assert calls
+
+def test_connections_come_from_a_fixed_pool(codesign, store, monkeypatch):
+    opened = []
+    connect = store._connect
+    monkeypatch.setattr(store, '_connect', lambda: opened.append(1) or connect())
+
+    threads = [threading.Thread(target=store.query, kwargs={'limit': 1}) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(opened) <= 2
+    assert store.count() == 5
+
+def test_api_submissions_without_parameters_is_paged(codesign, store, monkeypatch):
+    monkeypatch.setattr(codesign, 'submission_store', store)
+    monkeypatch.setattr(codesign, 'SUBMISSIONS_PAGE_MAX', 2)
+    client = codesign.app.test_client()
+
+    body = client.get('/api/submissions').get_json()
+
+    assert (body['total'], body['limit'], body['offset']) == (5, 2, 0)
+    assert [submission['timestamp'] for submission in body['submissions']] == ['t0', 't1']
+
+def append(store, count):
+    with open(store.csv_path, 'a', newline='') as f:
+        writer = csv.writer(f)
+        for n in range(count):
+            writer.writerow(['new', n, n, '', '', '', '', 1, 2, 3, 4])
+
+def test_each_submission_is_announced_by_one_process(codesign, store):
+    # A second process on the same database
+    other = codesign.SubmissionStore(store.db_path, store.csv_path)
+    store.start_announcing()
+    other.start_announcing()
+    assert store.claim_announcement()[0] == []
+
+    append(store, 2)
+    first, token = store.claim_announcement()
+    second, _ = other.claim_announcement()
+
+    assert [submission['id'] for submission in first] == [6, 7]
+    assert token == store.sync_token()
+    assert second == []
+
+def test_reimport_announces_nothing(codesign, store):
+    store.start_announcing()
+    with open(store.csv_path, 'w', newline='') as f:
+        csv.writer(f).writerow(codesign.SUBMISSION_CSV_HEADERS)
+    append(store, 1)
+
+    assert store.claim_announcement() == ([], store.sync_token())
+    append(store, 1)
+    assert len(store.claim_announcement()[0]) == 1
@@ -0,0 +1,42 @@
+import pytest
+
+@pytest.fixture
+def client(codesign):
+    return codesign.app.test_client()
+
+@pytest.mark.parametrize('body', [
+    {'prompts': {'mainSubject': 'no location'}},
+    {'location': {'lat': 51.5}},
+    {'location': {'lat': 'north', 'lng': 0}},
+    {'location': {'lat': 'nan', 'lng': 0}},
+    {'location': {'lat': 91, 'lng': 0}},
+    {'location': {'lat': 0, 'lng': -181}},
+    {'location': [51.5, -0.12]},
+    {'location': {'lat': 1, 'lng': 2}, 'prompts': 'text'},
+    {'submissions': [{'location': {'lat': 1, 'lng': 2}}, 'not an object']},
+    {'submissions': {'location': {'lat': 1, 'lng': 2}}},
+    {'csvData': 't,north,0,u,s,c,a,1,2,3,4'},
+    {'csvData': 't,95,0,u,s,c,a,1,2,3,4'},
+    {'csvData': 42},
+    [{'location': {'lat': 1, 'lng': 2}}],
+], ids=lambda body: str(body)[:40])
+def test_invalid_submissions_are_rejected(codesign, client, monkeypatch, body):
+    written = []
+    monkeypatch.setattr(codesign.submission_writer, 'append', written.append)
+
+    response = client.post('/api/save-submission', json=body)
+
+    assert response.status_code == 400
+    assert response.get_json()['error'].startswith('Invalid submission')
+    assert written == []
+
+def test_missing_body_is_rejected(client):
+    response = client.post('/api/save-submission', data='not json', content_type='application/json')
+    assert response.status_code == 400
+
+def test_submission_row_keeps_validated_coordinates(codesign):
+    row = codesign.submission_to_row({'location': {'lat': '51.5', 'lng': -0.12}, 'timestamp': 't',
+                                      'prompts': {'mainSubject': 'bench', 'sliderValues': {'sunlight': 3}}})
+    assert row[:3] == ['t', 51.5, -0.12]
+    assert row[4] == 'bench'
+    assert row[7] == 3